@@ -4,18 +4,397 @@
 
 ## The above copyright notice and this permission notice shall be included in all copies or substantial portions of the Software.
 
+import io
 import os
+import numpy as np
 import pandas as pd
+import zstandard
+from pyarrow import feather, parquet
 
+# Binary register log: a header, followed by one fixed width record per
+# register write (clock offset since the previous write, register, value).
+REG_LOG_BIN_MAGIC = b'DSDREGLG'
+REG_LOG_BIN_VERSION = 1
+REG_LOG_BIN_HEADER_DTYPE = np.dtype([
+    ('magic', 'S8'), ('version', '<u4'), ('record_size', '<u4'), ('rows', '<u8')])
+REG_LOG_BIN_DTYPE = np.dtype([('clock_offset', '<u4'), ('reg', 'u1'), ('val', 'u1')])
+PARQUET_MAGIC = b'PAR1'
+PARQUET_EXT = 'parquet'
+# Sidecar index of an indexed dataframe: a header (naming the key, e.g. hashid or clock),
+# followed by one record per key range (sorted) with the offset and length of the zstd frame
+# holding those rows. A dataframe sorted by key has a record per frame, otherwise per key.
+DF_INDEX_EXT = 'idx'
+DF_INDEX_MAGIC = b'DSDDFIDX'
+DF_INDEX_VERSION = 2
+DF_INDEX_HEADER_DTYPE = np.dtype([
+    ('magic', 'S8'), ('version', '<u4'), ('header_length', '<u4'), ('df_size', '<u8'), ('rows', '<u8'), ('key', 'S16')])
+DF_INDEX_DTYPE = np.dtype([('first', '<i8'), ('last', '<i8'), ('offset', '<u8'), ('length', '<u8')])
+# Uncompressed CSV bytes per zstd frame of an indexed dataframe.
+DF_FRAME_BYTES = 64 * 1024
+# Rows per Parquet row group of an indexed dataframe (which has min/max statistics per row group).
+DF_ROW_GROUP_ROWS = 16 * 1024
+MAX_CLOCK = np.iinfo(np.int64).max
 
 def read_csv(*args, **kwargs):
     return pd.read_csv(*args, **kwargs, engine='pyarrow')
 
 
+def read_csv_chunks(*args, chunksize, **kwargs):
+    # pyarrow engine does not support chunksize.
+    with pd.read_csv(*args, **kwargs, chunksize=chunksize) as reader:
+        for df in reader:
+            yield df
+
+
+def has_magic(file_name, magic):
+    try:
+        with open(file_name, 'rb') as f:
+            return f.read(len(magic)) == magic
+    except (OSError, TypeError):
+        return False
+
+
+def is_reg_log_bin(snd_log_name):
+    return has_magic(snd_log_name, REG_LOG_BIN_MAGIC)
+
+
+def is_parquet(df_name):
+    return has_magic(df_name, PARQUET_MAGIC)
+
+
+# Parquet files store SID register columns in their compact nullable dtypes,
+# and other integer columns as Int64 (as they would be read from CSV).
+def write_df(df, df_name, row_group_size=None):
+    if not df_name.endswith('.' + PARQUET_EXT):
+        df.to_csv(df_name)
+        return
+    if df.index.name is not None:
+        df = df.reset_index()
+    df = df.astype({
+        col: pd.Int64Dtype() for col, dtype in df.dtypes.items()
+        if pd.api.types.is_integer_dtype(dtype) and not isinstance(dtype, pd.api.extensions.ExtensionDtype)})
+    df.to_parquet(df_name, index=False, row_group_size=row_group_size)
+
+
+# Read a dataframe written by write_df(), optionally only the given columns.
+# A long format dataframe is returned in wide format.
+def read_df(df_name, columns=None, dtype=pd.Int64Dtype()):
+    if is_long_df_file(df_name):
+        if is_parquet(df_name):
+            df = pd.read_parquet(df_name)
+        else:
+            # read as nullable, as 64 bit values with NA would otherwise be read as floats.
+            df = read_csv(df_name, dtype_backend='numpy_nullable')
+        df = long2wide_df(df)
+        if columns is not None:
+            df = df[columns]
+        return df
+    if is_parquet(df_name):
+        return pd.read_parquet(df_name, columns=columns)
+    return read_csv(df_name, dtype=dtype, usecols=columns)
+
+
+# Long format: (hashid, clock, field, value) records, with a record only when a field changes
+# within a hashid's rows (value NA, if the field changes to NA). Every row has at least
+# one record, and the file starts with one record per wide column with NA hashid, for column order.
+LONG_DF_COLS = ['hashid', 'clock', 'field', 'value']
+
+
+def is_long_df_file(df_name):
+    if is_parquet(df_name):
+        columns = parquet.read_schema(df_name).names
+    else:
+        columns = list(pd.read_csv(df_name, nrows=0).columns)
+    return columns == LONG_DF_COLS
+
+
+def wide2long_df(df):
+    if 'hashid' in df.index.names:
+        df = df.reset_index()
+    hashids = df['hashid'].to_numpy(dtype=np.int64)
+    first_rows = np.r_[True, hashids[1:] != hashids[:-1]]
+    fields = [col for col in df.columns if col not in ('hashid', 'clock')]
+    rows, field_codes, vals, nas = [], [], [], []
+    for code, field in enumerate(fields):
+        col = df[field]
+        na = col.isna().to_numpy()
+        val = col.to_numpy(dtype=np.int64, na_value=0)
+        changed = first_rows.copy()
+        changed[1:] |= (na[1:] != na[:-1]) | ((val[1:] != val[:-1]) & ~na[1:])
+        changed &= ~(first_rows & na)
+        rows.append(np.flatnonzero(changed))
+        field_codes.append(np.full(len(rows[-1]), code))
+        vals.append(val[changed])
+        nas.append(na[changed])
+    rows = np.concatenate(rows)
+    # keep rows without changes, with a record of the first field.
+    unchanged = np.setdiff1d(np.arange(len(df)), rows)
+    if len(unchanged):
+        rows = np.r_[rows, unchanged]
+        field_codes.append(np.zeros(len(unchanged), dtype=np.int64))
+        na = df[fields[0]].isna().to_numpy()[unchanged]
+        vals.append(df[fields[0]].to_numpy(dtype=np.int64, na_value=0)[unchanged])
+        nas.append(na)
+    field_codes = np.concatenate(field_codes)
+    order = np.lexsort((field_codes, rows))
+    rows = rows[order]
+    long_df = pd.DataFrame({
+        'hashid': pd.arrays.IntegerArray(hashids[rows], np.zeros(len(rows), dtype=bool)),
+        'clock': pd.arrays.IntegerArray(df['clock'].to_numpy(dtype=np.int64)[rows], np.zeros(len(rows), dtype=bool)),
+        'field': np.array(fields, dtype=object)[field_codes[order]],
+        'value': pd.arrays.IntegerArray(np.concatenate(vals)[order], np.concatenate(nas)[order])})
+    schema_df = pd.DataFrame({'field': [col for col in df.columns if col != 'hashid']}, columns=LONG_DF_COLS).astype(
+        {'hashid': pd.Int64Dtype(), 'clock': pd.Int64Dtype(), 'value': pd.Int64Dtype()})
+    return pd.concat([schema_df, long_df], ignore_index=True).set_index('hashid')
+
+
+# Wide format dataframe (with hashid column and Int64 columns) from long format.
+def long2wide_df(long_df):
+    if 'hashid' in long_df.index.names:
+        long_df = long_df.reset_index()
+    schema = long_df['hashid'].isna().to_numpy()
+    fields = long_df['field'].to_numpy()[schema].tolist()
+    long_df = long_df[~schema]
+    hashids = long_df['hashid'].to_numpy(dtype=np.int64)
+    clocks = long_df['clock'].to_numpy(dtype=np.int64)
+    row_starts = np.r_[True, (hashids[1:] != hashids[:-1]) | (clocks[1:] != clocks[:-1])][:len(hashids)]
+    rows = np.cumsum(row_starts) - 1
+    row_count = int(rows[-1]) + 1 if len(rows) else 0
+    row_records = np.flatnonzero(row_starts)
+    row_hashids = hashids[row_records]
+    first_rows = np.r_[True, row_hashids[1:] != row_hashids[:-1]][:row_count]
+    field_codes = pd.Index(fields).get_indexer(long_df['field'].to_numpy())
+    vals = long_df['value'].to_numpy(dtype=np.int64, na_value=0)
+    nas = long_df['value'].isna().to_numpy()
+    wide = {'hashid': pd.arrays.IntegerArray(row_hashids, np.zeros(row_count, dtype=bool))}
+    for code, field in enumerate(fields):
+        if field == 'clock':
+            wide[field] = pd.arrays.IntegerArray(clocks[row_records], np.zeros(row_count, dtype=bool))
+            continue
+        records = field_codes == code
+        field_vals = np.zeros(row_count, dtype=np.int64)
+        field_nas = np.ones(row_count, dtype=bool)
+        field_vals[rows[records]] = vals[records]
+        field_nas[rows[records]] = nas[records]
+        # fields not recorded keep their value from the previous row of the same hashid.
+        recorded = first_rows.copy()
+        recorded[rows[records]] = True
+        last_recorded = np.maximum.accumulate(np.where(recorded, np.arange(row_count), 0))
+        wide[field] = pd.arrays.IntegerArray(field_vals[last_recorded], field_nas[last_recorded])
+    return pd.DataFrame(wide)
+
+
+def df_index_path(df_name):
+    return '.'.join((df_name, DF_INDEX_EXT))
+
+
+# Write a dataframe, with an integer key index (rows of each key together, after any rows
+# with NA key), as CSV in independently compressed zstd frames, and a sidecar index of the
+# keys in each frame, so that read_df_hashids() or read_df_clocks() read only those frames.
+# The dataframe is still read by read_df() as any other compressed CSV.
+def write_indexed_df(df, df_name):
+    if df_name.endswith('.' + PARQUET_EXT):
+        write_df(df, df_name, row_group_size=DF_ROW_GROUP_ROWS)
+        return
+    # nothing to index (e.g. no SSFs).
+    if not df_name.endswith('.zst') or df.empty or df.index.name is None:
+        write_df(df, df_name)
+        if os.path.exists(df_index_path(df_name)):
+            os.remove(df_index_path(df_name))
+        return
+    lines = df.to_csv().encode().splitlines(keepends=True)
+    na_keys = np.asarray(pd.isna(df.index))
+    keys = df.index.to_numpy(dtype=np.int64, na_value=0)[~na_keys]
+    sorted_keys = bool(np.all(keys[1:] >= keys[:-1]))
+    data_lines = lines[1 + na_keys.sum():]
+    line_ends = np.cumsum([0] + [len(line) for line in data_lines])
+    run_starts = np.flatnonzero(np.r_[True, keys[1:] != keys[:-1]][:len(keys)]).tolist() + [len(keys)]
+    compressor = zstandard.ZstdCompressor()
+    index = []
+    with open(df_name, 'wb') as f:
+        f.write(compressor.compress(b''.join(lines[:len(lines) - len(data_lines)])))
+        header_length = f.tell()
+        frame_start = 0
+        for next_run_start in run_starts[1:]:
+            if line_ends[next_run_start] - line_ends[frame_start] < DF_FRAME_BYTES and next_run_start < len(keys):
+                continue
+            offset = f.tell()
+            f.write(compressor.compress(b''.join(data_lines[frame_start:next_run_start])))
+            frame_keys = keys[frame_start:next_run_start]
+            if sorted_keys:
+                index.append((frame_keys[0], frame_keys[-1], offset, f.tell() - offset))
+            else:
+                index.extend((key, key, offset, f.tell() - offset) for key in np.unique(frame_keys).tolist())
+            frame_start = next_run_start
+        df_size = f.tell()
+    index = np.array(index, dtype=DF_INDEX_DTYPE)
+    index = index[np.argsort(index['first'], kind='stable')]
+    header = np.zeros(1, dtype=DF_INDEX_HEADER_DTYPE)
+    header['magic'] = DF_INDEX_MAGIC
+    header['version'] = DF_INDEX_VERSION
+    header['header_length'] = header_length
+    header['df_size'] = df_size
+    header['rows'] = len(index)
+    header['key'] = df.index.name.encode()
+    with open(df_index_path(df_name), 'wb') as f:
+        header.tofile(f)
+        index.tofile(f)
+
+
+# Returns (CSV header frame length, index records) for a dataframe indexed by key, or None
+# if it has no such index (or the index is not for this version of the dataframe).
+def read_df_index(df_name, key):
+    try:
+        header = np.fromfile(df_index_path(df_name), dtype=DF_INDEX_HEADER_DTYPE, count=1)
+        df_size = os.path.getsize(df_name)
+    except (OSError, ValueError):
+        return None
+    if len(header) != 1 or header['magic'][0] != DF_INDEX_MAGIC or header['version'][0] != DF_INDEX_VERSION:
+        return None
+    if header['df_size'][0] != df_size or header['key'][0] != key.encode():
+        return None
+    index = np.fromfile(
+        df_index_path(df_name), dtype=DF_INDEX_DTYPE, offset=DF_INDEX_HEADER_DTYPE.itemsize, count=int(header['rows'][0]))
+    return (int(header['header_length'][0]), index)
+
+
+# Index records of frames with keys in any of the given (first, last) ranges.
+def df_index_records(index, firsts, lasts):
+    starts = np.searchsorted(index['last'], firsts, side='left')
+    ends = np.searchsorted(index['first'], lasts, side='right')
+    return index[np.concatenate([np.arange(i, j) for i, j in zip(starts, ends)] + [np.empty(0, dtype=np.int64)])]
+
+
+# Read only the frames of an indexed dataframe with the given index records.
+def read_df_frames(df_name, header_length, records, columns, dtype):
+    frames = sorted(set(zip(records['offset'].tolist(), records['length'].tolist())))
+    decompressor = zstandard.ZstdDecompressor()
+    with open(df_name, 'rb') as f:
+        csv = [decompressor.decompress(f.read(header_length))]
+        for offset, length in frames:
+            f.seek(offset)
+            csv.append(decompressor.decompress(f.read(length)))
+    csv = io.BytesIO(b''.join(csv))
+    if csv.getvalue().split(b'\n', 1)[0].decode().split(',') == LONG_DF_COLS:
+        df = long2wide_df(read_csv(csv, dtype_backend='numpy_nullable'))
+        if columns is not None:
+            df = df[columns]
+        return df
+    return read_csv(csv, dtype=dtype, usecols=columns)
+
+
+# Read only the rows of the given hashids from a dataframe written by write_indexed_df()
+# (or by write_df(), though then the whole dataframe is read).
+def read_df_hashids(df_name, hashids, columns=None, dtype=pd.Int64Dtype()):
+    hashids = np.unique(np.asarray(hashids, dtype=np.int64))
+    read_columns = columns
+    if columns is not None and 'hashid' not in columns:
+        read_columns = ['hashid'] + list(columns)
+    df_index = read_df_index(df_name, 'hashid')
+    if df_index is None:
+        df = read_df(df_name, columns=read_columns, dtype=dtype)
+    else:
+        header_length, index = df_index
+        df = read_df_frames(df_name, header_length, df_index_records(index, hashids, hashids), read_columns, dtype)
+    # an empty dataframe (e.g. no SSFs) may have no columns.
+    if 'hashid' not in df.columns:
+        return df
+    df = df[df['hashid'].isin(hashids)].reset_index(drop=True)
+    if columns is not None:
+        df = df[columns]
+    return df
+
+
+# Read only the rows from min_clock to max_clock (0 for no limit) from a dataframe
+# written by write_indexed_df() (or by write_df(), though then the whole dataframe is read).
+def read_df_clocks(df_name, min_clock=0, max_clock=0, columns=None, dtype=pd.Int64Dtype()):
+    if not max_clock:
+        max_clock = MAX_CLOCK
+    read_columns = columns
+    if columns is not None and 'clock' not in columns:
+        read_columns = ['clock'] + list(columns)
+    if is_parquet(df_name):
+        filters = None
+        if 'clock' in parquet.read_schema(df_name).names:
+            # row groups outside the clock range are skipped by their statistics.
+            filters = [('clock', '>=', min_clock), ('clock', '<=', max_clock)]
+        df = pd.read_parquet(df_name, columns=read_columns, filters=filters)
+    else:
+        df_index = read_df_index(df_name, 'clock')
+        if df_index is None:
+            df = read_df(df_name, columns=read_columns, dtype=dtype)
+        else:
+            header_length, index = df_index
+            df = read_df_frames(
+                df_name, header_length, df_index_records(index, [min_clock], [max_clock]), read_columns, dtype)
+    # an empty dataframe (e.g. no SSFs) may have no columns.
+    if 'clock' not in df.columns:
+        return df
+    df = df[(df['clock'] >= min_clock) & (df['clock'] <= max_clock)].reset_index(drop=True)
+    if columns is not None:
+        df = df[columns]
+    return df
+
+
+# Uncompressed Arrow file, that many processes can read without copying.
+def write_mmap_df(df, df_name):
+    feather.write_feather(df.reset_index(drop=True), df_name, compression='uncompressed')
+
+
+# Memory mapped Arrow table, from which rows can be sliced with table.slice().to_pandas().
+def read_mmap_df(df_name):
+    return feather.read_table(df_name, memory_map=True)
+
+
+# Extension of a dataframe file, e.g. zst for x.log.zst.
+def df_ext(df_name):
+    exts = os.path.basename(df_name).split('.')
+    if len(exts) > 2:
+        return exts[-1]
+    return 'zst'
+
+
+def write_reg_log_bin(bin_log_name, dfs):
+    header = np.zeros(1, dtype=REG_LOG_BIN_HEADER_DTYPE)
+    header['magic'] = REG_LOG_BIN_MAGIC
+    header['version'] = REG_LOG_BIN_VERSION
+    header['record_size'] = REG_LOG_BIN_DTYPE.itemsize
+    rows = 0
+    with open(bin_log_name, 'wb') as f:
+        header.tofile(f)
+        for df in dfs:
+            if len(df) and df['clock_offset'].max() > np.iinfo(np.uint32).max:
+                raise ValueError('clock offset too large for binary register log')
+            records = np.empty(len(df), dtype=REG_LOG_BIN_DTYPE)
+            for col in REG_LOG_BIN_DTYPE.names:
+                records[col] = df[col]
+            records.tofile(f)
+            rows += len(records)
+        header['rows'] = rows
+        f.seek(0)
+        header.tofile(f)
+    return rows
+
+
+# Returns a read only memory map of the register log's records.
+def read_reg_log_bin(bin_log_name):
+    header = np.fromfile(bin_log_name, dtype=REG_LOG_BIN_HEADER_DTYPE, count=1)
+    if len(header) != 1 or header['magic'][0] != REG_LOG_BIN_MAGIC:
+        raise ValueError('%s is not a binary register log' % bin_log_name)
+    if header['version'][0] != REG_LOG_BIN_VERSION or header['record_size'][0] != REG_LOG_BIN_DTYPE.itemsize:
+        raise ValueError('unsupported binary register log version in %s' % bin_log_name)
+    rows = int(header['rows'][0])
+    if not rows:
+        return np.empty(0, dtype=REG_LOG_BIN_DTYPE)
+    return np.memmap(
+        bin_log_name, dtype=REG_LOG_BIN_DTYPE, mode='r',
+        offset=REG_LOG_BIN_HEADER_DTYPE.itemsize, shape=(rows,))
+
+
 def out_path(snd_log_name, new_ext):
     snd_log_name = os.path.expanduser(snd_log_name)
     base = os.path.basename(snd_log_name)
-    recogized_exts = {'zst', 'xz', 'gz', 'dump', 'log', 'sid', 'txt', 'ssf', 'index_ssf'}
+    recogized_exts = {'zst', 'xz', 'gz', PARQUET_EXT, 'dump', 'regbin', 'log', 'sid', 'txt', 'ssf', 'index_ssf'}
     while True:
         dot = base.rfind('.')
         if dot <= 0:
@@ -7,20 +7,21 @@
 ## The above copyright notice and this permission notice shall be included in all copies or substantial portions of the Software.
 
 import argparse
-import pandas as pd
 
-from desidulate.fileio import read_csv, out_path
-from desidulate.sidlib import set_sid_dtype, control_labels, unique_control_labels
+from desidulate.fileio import read_df, out_path
+from desidulate.sidlib import V1_CONTROL_BITS, set_sid_dtype, control_labels, unique_control_labels
 
 parser = argparse.ArgumentParser(description='Index SSFs with waveforms')
 parser.add_argument('ssffile', help='SSF file')
 parser.add_argument('--max_clock', default=500000, type=int, help='include number of cycles')
 parser.add_argument('--max_pr_speed', default=8, type=int, help='max pr_speed')
 
+INDEX_COLS = ['hashid', 'hashid_noclock', 'clock', 'pr_speed', 'vol'] + V1_CONTROL_BITS
+
 
 def main():
     args = parser.parse_args()
-    df = set_sid_dtype(read_csv(args.ssffile, dtype=pd.Int64Dtype()))
+    df = set_sid_dtype(read_df(args.ssffile, columns=INDEX_COLS))
     if not df.empty:
         df = df[(df.clock <= args.max_clock) & (df.pr_speed <= args.max_pr_speed)]
         df = control_labels(df)
@@ -0,0 +1,32 @@
+#!/usr/bin/python3
+
+# Copyright 2020-2022 Josh Bailey (josh@vandervecken.com)
+
+## Permission is hereby granted, free of charge, to any person obtaining a copy of this software and associated documentation files (the "Software"), to deal in the Software without restriction, including without limitation the rights to use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of the Software, and to permit persons to whom the Software is furnished to do so, subject to the following conditions:
+
+## The above copyright notice and this permission notice shall be included in all copies or substantial portions of the Software.
+
+import argparse
+import logging
+from desidulate.fileio import out_path, write_reg_log_bin
+from desidulate.sidlib import read_reg_log
+
+
+def main():
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(message)s')
+
+    parser = argparse.ArgumentParser(description='Convert vicesnd.sid log into a binary register log')
+    parser.add_argument('logfile', default='vicesnd.sid', help='log file to read')
+    parser.add_argument('--binfile', default='', help='binary register log to write')
+    parser.add_argument('--chunksize', default=int(1e6), type=int, help='convert in chunks of this many register writes')
+    args = parser.parse_args()
+    binfile = args.binfile
+    if not binfile:
+        binfile = out_path(args.logfile, 'regbin')
+
+    rows = write_reg_log_bin(binfile, read_reg_log(args.logfile, chunksize=args.chunksize))
+    logging.info('wrote %u register writes to %s', rows, binfile)
+
+
+if __name__ == '__main__':
+    main()
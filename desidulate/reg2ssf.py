@@ -11,8 +11,8 @@
 
 import argparse
 import logging
-from desidulate.fileio import out_path
-from desidulate.sidlib import reg2state, state2ssfs, timer_args
+from desidulate.fileio import out_path, write_indexed_df, wide2long_df
+from desidulate.sidlib import reg2regstate, state2ssfs, timer_args
 from desidulate.sidwrap import get_sid
 
 
@@ -21,22 +21,27 @@ def main():
 
     parser = argparse.ArgumentParser(description='Convert vicesnd.sid log into SSF log files')
     parser.add_argument('logfile', default='vicesnd.sid', help='log file to read')
-    parser.add_argument('--maxstates', default=int(10 * 1e6), help='maximum number of SID states to analyze')
-    parser.add_argument('--dfext', default='zst', help='default dataframe extension')
+    parser.add_argument('--maxstates', default=int(10 * 1e6), help='maximum number of SID states to analyze (all are held in memory), or 0 for no limit')
+    parser.add_argument('--chunksize', default=0, type=int, help='if > 0, read log file in chunks of this many register writes')
+    parser.add_argument('--dfext', default='zst', help='default dataframe extension (parquet for Parquet, otherwise compressed CSV)')
+    parser.add_argument('--ssf-format', default='wide', choices=('wide', 'long'), help='write SSFs in wide format, or sparse long format (changed fields only)')
     parser.add_argument('--maxprspeed', default=1, help='max prspeed to detect')
+    parser.add_argument('--workers', default=1, type=int, help='if > 1, split voices into SSFs in parallel with this many worker processes')
     timer_args(parser)
     args = parser.parse_args()
 
     sid = get_sid(args.pal, args.cia)
-    df = reg2state(args.logfile, nrows=int(args.maxstates))
-    ssf_log_df, ssf_df = state2ssfs(sid, df, maxprspeed=args.maxprspeed, near=sid.one_sample_cycles)
-
-    for ext, filedf in (
-            ('.'.join(('log', args.dfext)), ssf_log_df),
-            ('.'.join(('ssf', args.dfext)), ssf_df)):
+    state = reg2regstate(args.logfile, nrows=int(args.maxstates), chunksize=args.chunksize)
+    ssf_log_df, ssf_df = state2ssfs(sid, state, maxprspeed=args.maxprspeed, near=sid.one_sample_cycles, workers=args.workers)
+    if args.ssf_format == 'long':
+        ssf_df = wide2long_df(ssf_df)
+
+    for ext, filedf, writer in (
+            ('.'.join(('log', args.dfext)), ssf_log_df, write_indexed_df),
+            ('.'.join(('ssf', args.dfext)), ssf_df, write_indexed_df)):
         filename = out_path(args.logfile, ext)
         logging.debug('writing %s', filename)
-        filedf.to_csv(filename)
+        writer(filedf, filename)
 
 
 if __name__ == '__main__':
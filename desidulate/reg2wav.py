@@ -9,8 +9,8 @@
 import argparse
 import logging
 from desidulate.fileio import wav_path
-from desidulate.sidlib import reg2state, timer_args
-from desidulate.sidwav import state2samples, write_wav
+from desidulate.sidlib import reg2state_chunks, timer_args
+from desidulate.sidwav import states2sample_chunks, write_wav_stream
 from desidulate.sidwrap import get_sid, SID_SAMPLE_FREQ
 
 
@@ -19,9 +19,11 @@ def main():
 
     parser = argparse.ArgumentParser(description='Convert vicesnd.sid log into a WAV file')
     parser.add_argument('logfile', default='vicesnd.sid', help='log file to read')
-    parser.add_argument('--maxstates', default=int(10 * 1e6), help='maximum number of SID states to analyze')
+    parser.add_argument('--maxstates', default=int(10 * 1e6), help='maximum number of SID states to analyze, or 0 for no limit')
+    parser.add_argument('--chunksize', default=0, type=int, help='if > 0, read log file in chunks of this many register writes')
     parser.add_argument('--wavfile', default='', help='WAV file to write')
     parser.add_argument('--samplerate', default=SID_SAMPLE_FREQ, type=int, help='sample rate')
+    parser.add_argument('--window', default=60, type=int, help='write WAV file in windows of this many seconds')
     timer_args(parser)
     args = parser.parse_args()
     wavfile = args.wavfile
@@ -29,9 +31,9 @@ def main():
         wavfile = wav_path(args.logfile)
 
     sid = get_sid(args.pal, args.cia, sampling_frequency=args.samplerate)
-    df = reg2state(args.logfile, nrows=int(args.maxstates))
-    raw_samples = state2samples(df, sid)
-    write_wav(wavfile, sid, raw_samples)
+    dfs = reg2state_chunks(args.logfile, nrows=int(args.maxstates), chunksize=args.chunksize)
+    sample_chunks = states2sample_chunks(dfs, sid, window_clocks=int(args.window * sid.clock_freq))
+    write_wav_stream(wavfile, sid, sample_chunks)
 
 
 if __name__ == '__main__':
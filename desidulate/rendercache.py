@@ -0,0 +1,116 @@
+# Copyright 2020-2022 Josh Bailey (josh@vandervecken.com)
+
+## Permission is hereby granted, free of charge, to any person obtaining a copy of this software and associated documentation files (the "Software"), to deal in the Software without restriction, including without limitation the rights to use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of the Software, and to permit persons to whom the Software is furnished to do so, subject to the following conditions:
+
+## The above copyright notice and this permission notice shall be included in all copies or substantial portions of the Software.
+
+import hashlib
+import logging
+import os
+import tempfile
+import numpy as np
+from desidulate.sidwav import state2regs, state2samples
+
+RENDER_CACHE_EXT = '.npy'
+RENDER_CACHE_VERSION = 1
+
+
+def render_cache_args(parser):
+    parser.add_argument('--render-cache', default='', help='if set, directory to cache rendered SSF samples in')
+    parser.add_argument('--render-cache-mb', default=1024, type=int, help='maximum size of render cache in MB')
+
+
+def get_render_cache(args):
+    if args.render_cache:
+        return RenderCache(args.render_cache, max_bytes=args.render_cache_mb * 1024 * 1024)
+    return None
+
+
+# Rendered int16 samples, one .npy file per render, addressed by a hash of the
+# SID parameters and the register state that would be rendered. Least recently
+# used renders are evicted when the cache is larger than max_bytes.
+class RenderCache:
+
+    def __init__(self, cache_dir, max_bytes=1024 * 1024 * 1024):
+        self.cache_dir = os.path.expanduser(cache_dir)
+        self.max_bytes = max_bytes
+        os.makedirs(self.cache_dir, exist_ok=True)
+        self.cache_bytes = sum(size for _, _, size in self._entries())
+        self.hits = 0
+        self.misses = 0
+
+    def _entries(self):
+        with os.scandir(self.cache_dir) as entries:
+            for entry in entries:
+                if entry.name.endswith(RENDER_CACHE_EXT):
+                    try:
+                        stat = entry.stat()
+                    except FileNotFoundError:
+                        continue
+                    yield (entry.path, stat.st_mtime, stat.st_size)
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, key + RENDER_CACHE_EXT)
+
+    @staticmethod
+    def key(df, sid, skiptest=False, maxclock=None):
+        if maxclock is not None:
+            df = df[df.index <= maxclock]
+        key_hash = hashlib.sha256(repr((RENDER_CACHE_VERSION, sid.args, bool(skiptest))).encode())
+        key_hash.update(np.ascontiguousarray(df.index.to_numpy(dtype=np.int64)).tobytes())
+        key_hash.update(state2regs(df).tobytes())
+        return key_hash.hexdigest()
+
+    def get(self, key):
+        path = self._path(key)
+        try:
+            samples = np.load(path)
+            os.utime(path)
+        except (FileNotFoundError, ValueError, OSError):
+            return None
+        return samples
+
+    def put(self, key, samples):
+        path = self._path(key)
+        with tempfile.NamedTemporaryFile(dir=self.cache_dir, suffix='.tmp', delete=False) as f:
+            np.save(f, np.asarray(samples, dtype=np.int16))
+        # a render already cached under this key is replaced, not added to.
+        try:
+            replaced_bytes = os.path.getsize(path)
+        except FileNotFoundError:
+            replaced_bytes = 0
+        os.replace(f.name, path)
+        self.cache_bytes += os.path.getsize(path) - replaced_bytes
+        if self.cache_bytes > self.max_bytes:
+            self.evict()
+
+    # Evict least recently used renders, down to 90% of the maximum size.
+    def evict(self):
+        entries = sorted(self._entries(), key=lambda entry: entry[1])
+        self.cache_bytes = sum(size for _, _, size in entries)
+        for path, _, size in entries:
+            if self.cache_bytes <= self.max_bytes * 0.9:
+                break
+            try:
+                os.unlink(path)
+            except FileNotFoundError:
+                pass
+            self.cache_bytes -= size
+        logging.debug('evicted render cache %s to %u bytes', self.cache_dir, self.cache_bytes)
+
+    def state2samples(self, df, sid, skiptest=False, maxclock=None):
+        key = self.key(df, sid, skiptest=skiptest, maxclock=maxclock)
+        samples = self.get(key)
+        if samples is not None:
+            self.hits += 1
+            return samples
+        self.misses += 1
+        samples = state2samples(df, sid, skiptest=skiptest, maxclock=maxclock)
+        self.put(key, samples)
+        return samples
+
+
+def cached_state2samples(render_cache, df, sid, skiptest=False, maxclock=None):
+    if render_cache is None:
+        return state2samples(df, sid, skiptest=skiptest, maxclock=maxclock)
+    return render_cache.state2samples(df, sid, skiptest=skiptest, maxclock=maxclock)
@@ -6,21 +6,24 @@
 
 ## THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABL E FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
 
-import copy
 import logging
+import time
 import warnings
+from bisect import bisect_left
 warnings.simplefilter(action='ignore', category=FutureWarning)
 from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager
+from functools import lru_cache
 import pandas as pd
 import numpy as np
-from desidulate.fileio import read_csv
+from desidulate.fileio import read_csv, read_csv_chunks, is_reg_log_bin, read_reg_log_bin
+from desidulate.sidstate import SID_REGS, CONTROL_BITS, SidRegState
 
-# use of external filter will be non deterministic.
-FLTEXT = False
 ADSR_COLS = ['atk1', 'dec1', 'sus1', 'rel1']
-CONTROL_BITS = ['gate', 'sync', 'ring', 'test', 'tri', 'saw', 'pulse', 'noise']
 V1_CONTROL_BITS = [bit + '1' for bit in CONTROL_BITS]
 V1_CONTROL_BITS_LABELS = {'gate1': 'g', 'sync1': 'S', 'ring1': 'R', 'test1': 'T', 'tri1': 't', 'saw1': 's', 'pulse1': 'p', 'noise1': 'n'}
+MOD_COLS = ['freq3', 'test3', 'sync1', 'ring1']
 CANON_REG_ORDER = (
     'gate1', 'freq1', 'pwduty1', 'pulse1', 'noise1', 'tri1', 'saw1', 'test1',
     'sync1', 'ring1', 'freq3', 'test3',
@@ -29,49 +32,72 @@ CANON_REG_ORDER = (
 
 
 def bits2byte(df, cols, startbit=0):
-    byte_col = df[cols[0]].copy()
-    byte_col.loc[:] = 0
+    byte_col = np.zeros(len(df), dtype=np.int64)
     for i, col in enumerate(cols[startbit:], start=startbit):
-        byte_col += df[col].fillna(0) * 2**i
-    return byte_col.rename(None)
+        byte_col += df[col].to_numpy(dtype=np.int64, na_value=0) << i
+    return pd.Series(byte_col, index=df.index).astype(df[cols[0]].dtype)
 
 
+RATE_COLS = ['freq1', 'pwduty1', 'freq3', 'test3', 'fltcoff', 'fltres', 'vol']
+RATE_BYTE_COLS = [V1_CONTROL_BITS, ['flt1', 'fltlo', 'fltband', 'flthi']]
+
+
+# The shortest interval between changes to any rate column, control or filter bits, for each SSF.
 def calc_rates(sid, maxprspeed, vdf, ratemin=128):
-    rate_cols = []
-    rate_col_pairs = []
-    for col in {'freq1', 'pwduty1', 'freq3', 'test3', 'fltcoff', 'fltres', 'vol'}:
+    if 'ssf' in vdf.index.names:
+        ssfs = vdf.index.get_level_values('ssf')
+    else:
+        ssfs = vdf['ssf']
+    ssf_codes, ssf_index = pd.factorize(ssfs)
+    rows = len(vdf)
+    clocks = vdf['clock'].to_numpy(dtype=np.int64)
+
+    # state rows grouped by SSF, and the previous state of the same SSF.
+    order = np.argsort(ssf_codes, kind='stable')
+    first_in_ssf = np.ones(rows, dtype=bool)
+    first_in_ssf[1:] = ssf_codes[order][1:] != ssf_codes[order][:-1]
+    prev = np.roll(order, 1)
+    prev[first_in_ssf] = -1
+
+    # clocks at which each column changes, in SSF order.
+    changes = []
+    for col in RATE_COLS:
         col_max = vdf[col].max()
-        if pd.notna(col_max) and col_max:
-            rate_col = '%s_rate' % col
-            rate_cols.append(rate_col)
-            rate_col_pairs.append((col, rate_col))
-
-    rate_col_df = pd.DataFrame(vdf[['clock', 'clock_start']])
-
-    for col, rate_col in rate_col_pairs:
-        diff = vdf.astype(pd.Int64Dtype()).groupby(['ssf'], sort=False)[col].diff()
-        rate_col_df[rate_col] = rate_col_df['clock']
-        rate_col_df.loc[(diff == 0) | diff.isna(), [rate_col]] = pd.NA
-
-    control_col = bits2byte(vdf, V1_CONTROL_BITS)
-    filter_col = bits2byte(vdf, ['flt1', 'fltlo', 'fltband', 'flthi'])
-    for rate_col, col in (('control_rate', control_col), ('filter_rate', filter_col)):
-        diff = col.groupby(['ssf'], sort=False).diff()
-        rate_col_df[rate_col] = rate_col_df['clock']
-        rate_col_df.loc[diff == 0, [rate_col]] = pd.NA
-        rate_cols.append(rate_col)
-
-    rate_col_df[rate_cols] = rate_col_df.groupby(['ssf'], sort=False)[rate_cols].fillna(
-        method='ffill').diff().astype(pd.Int64Dtype())
-    # remove diffs that cross SSF boundaries.
-    rate_col_df.loc[rate_col_df.clock == rate_col_df.clock_start, rate_cols] = pd.NA
-    rate_col_df.drop(['clock', 'clock_start'], axis=1, inplace=True)
-
-    for col in rate_col_df.columns:
-        rate_col_df.loc[rate_col_df[col] <= ratemin, col] = pd.NA
-
-    rate_cols = [col for col in rate_col_df.columns if not rate_col_df[rate_col_df[col].notna()].empty]
-    rate = rate_col_df.groupby(['ssf'], sort=False)[rate_cols].min().min(axis=1).astype(pd.Int64Dtype()).clip(upper=sid.clockq)
+        if pd.isna(col_max) or not col_max:
+            continue
+        col_vals = vdf[col].to_numpy(dtype=np.float64, na_value=np.nan)[order]
+        prev_vals = col_vals[np.maximum(prev, 0)]
+        # a change to or from no value is not a change.
+        changes.append((prev >= 0) & (col_vals != prev_vals) & ~np.isnan(col_vals) & ~np.isnan(prev_vals))
+    for bits in RATE_BYTE_COLS:
+        byte_vals = np.zeros(rows, dtype=np.int64)
+        for i, col in enumerate(bits):
+            byte_vals += vdf[col].fillna(0).to_numpy(dtype=np.int64) * 2**i
+        byte_vals = byte_vals[order]
+        changes.append((prev < 0) | (byte_vals != byte_vals[np.maximum(prev, 0)]))
+    changes = np.column_stack(changes)
+
+    # the clock of the last change in the same SSF, at each state.
+    positions = np.arange(rows)[:, np.newaxis]
+    last_change = np.maximum.accumulate(np.where(changes, positions, -1), axis=0)
+    ssf_starts = np.maximum.accumulate(np.where(first_in_ssf, np.arange(rows), 0))[:, np.newaxis]
+    last_change_clocks = np.where(last_change >= ssf_starts, clocks[order][np.maximum(last_change, 0)], -1)
+    unordered_clocks = np.empty_like(last_change_clocks)
+    unordered_clocks[order] = last_change_clocks
+
+    # intervals between last changes, in state order, except at SSF starts.
+    intervals = np.full(unordered_clocks.shape, np.iinfo(np.int64).max, dtype=np.int64)
+    valid = (unordered_clocks[1:] >= 0) & (unordered_clocks[:-1] >= 0)
+    intervals[1:] = np.where(valid, unordered_clocks[1:] - unordered_clocks[:-1], intervals[1:])
+    clock_starts = vdf['clock_start'].to_numpy(dtype=np.int64)
+    intervals[clocks == clock_starts] = np.iinfo(np.int64).max
+    intervals[intervals <= ratemin] = np.iinfo(np.int64).max
+
+    ssf_rates = np.full(len(ssf_index), np.iinfo(np.int64).max, dtype=np.int64)
+    np.minimum.at(ssf_rates, ssf_codes, intervals.min(axis=1, initial=np.iinfo(np.int64).max))
+    rate = pd.Series(
+        pd.arrays.IntegerArray(ssf_rates, ssf_rates == np.iinfo(np.int64).max),
+        index=pd.Index(ssf_index, name='ssf')).clip(upper=sid.clockq)
     pr_speed = rate.rdiv(sid.clockq).round().astype(pd.UInt8Dtype())
     pr_speed.loc[pr_speed == 0] = int(1)
     pr_speed.loc[pr_speed.isna()] = 0
@@ -92,15 +118,58 @@ def remove_end_repeats(waveforms):
     return waveforms
 
 
+REPEAT_HASH_MOD = 2**61 - 1
+REPEAT_HASH_BASE = 1000003
+
+
+# Equivalent to calling remove_end_repeats() after appending each element that differs from the last.
+# As the last two elements always end the sequence, a repeat can only end where that pair was seen
+# before, and repeats are compared by prefix hashes (confirmed by comparing elements).
 def remove_repeats(seq):
-    non_repeats = seq[:1]
-    for i in seq[1:]:
-        if i != non_repeats[-1]:
-            non_repeats.append(i)
-            non_repeats = remove_end_repeats(non_repeats)
+    non_repeats = []
+    ids = {}
+    prefix_hashes = [0]
+    powers = [1]
+    pair_positions = defaultdict(list)
+
+    def seq_hash(start, end):
+        return (prefix_hashes[end] - prefix_hashes[start] * powers[end - start]) % REPEAT_HASH_MOD
+
+    for i in seq:
+        if non_repeats and i == non_repeats[-1]:
+            continue
+        i_id = ids.setdefault(i, len(ids) + 1)
+        if non_repeats:
+            pair_positions[(non_repeats[-1], i)].append(len(non_repeats))
+        non_repeats.append(i)
+        prefix_hashes.append((prefix_hashes[-1] * REPEAT_HASH_BASE + i_id) % REPEAT_HASH_MOD)
+        if len(powers) < len(prefix_hashes):
+            powers.append((powers[-1] * REPEAT_HASH_BASE) % REPEAT_HASH_MOD)
+        max_lookback = len(non_repeats) // 2
+        if max_lookback < 2:
+            continue
+        end_positions = pair_positions[(non_repeats[-2], i)]
+        while max_lookback > 1:
+            n = len(non_repeats)
+            lookback_limit = min(max_lookback, n // 2)
+            # longest lookback up to the limit, with the last pair before the repeat.
+            p = bisect_left(end_positions, n - 1 - lookback_limit)
+            lookback = n - 1 - end_positions[p]
+            if lookback < 2:
+                break
+            if (seq_hash(n - lookback, n) == seq_hash(n - 2 * lookback, n - lookback) and
+                    non_repeats[-lookback:] == non_repeats[-(lookback * 2):-lookback]):
+                for j in range(n - lookback, n):
+                    pair_positions[(non_repeats[j - 1], non_repeats[j])].pop()
+                del non_repeats[-lookback:]
+                del prefix_hashes[-lookback:]
+                max_lookback = lookback
+            else:
+                max_lookback = lookback - 1
     return non_repeats
 
 
+@lru_cache(maxsize=256)
 def bits2control(val):
     labels = []
     for i, bit in enumerate(V1_CONTROL_BITS):
@@ -114,21 +183,64 @@ def bits2control(val):
 def control_label(df):
     control_reg = bits2byte(df, V1_CONTROL_BITS, startbit=1)
     df['control'] = control_reg
-    control_df = pd.DataFrame([{'control': val, 'control_label': bits2control(val)} for val in control_reg.unique()])
-    return df.merge(control_df, how='left', on='control')
+    labels = {val: bits2control(val) for val in control_reg.unique().tolist()}
+    df = df.reset_index(drop=True)
+    df['control_label'] = df['control'].map(labels).astype(object)
+    return df
+
+
+# Map labels by hashid onto df's rows (hashids without labels get an empty label).
+def map_hashid_labels(df, labels, name):
+    labels = labels.reindex(df['hashid'].dropna().unique(), fill_value='')
+    df = df.reset_index(drop=True)
+    df[name] = df['hashid'].map(labels).astype(object)
+    return df
 
 
 def control_labels(df):
     df = control_label(df)
-    labels = df.groupby('hashid').apply(lambda ssf_df: '-'.join(remove_repeats(list(squeeze_diffs(ssf_df, ['control'])['control_label']))))
-    labels.name = 'control_labels'
-    return df.merge(labels, how='left', on='hashid')
+    # as squeeze_diffs() on each SSF, states where control changes.
+    changes = df.loc[df['control'] != df.groupby('hashid')['control'].shift(fill_value=0), ['hashid', 'control_label']]
+    changes = changes[changes['hashid'].notna()]
+    hashid_codes, hashids = pd.factorize(changes['hashid'], sort=True)
+    order = np.argsort(hashid_codes, kind='stable')
+    change_labels = changes['control_label'].to_numpy()[order]
+    bounds = np.searchsorted(hashid_codes[order], np.arange(len(hashids) + 1)).tolist()
+    # many SSFs share the same control changes.
+    seq_labels = {}
+    labels = []
+    for start, end in zip(bounds[:-1], bounds[1:]):
+        seq = tuple(change_labels[start:end])
+        label = seq_labels.get(seq, None)
+        if label is None:
+            label = '-'.join(remove_repeats(seq))
+            seq_labels[seq] = label
+        labels.append(label)
+    return map_hashid_labels(df, pd.Series(labels, index=hashids, dtype=object), 'control_labels')
+
+
+# As control_labels(), for the states of one SSF.
+def ssf_control_labels(df):
+    control = bits2byte(df, V1_CONTROL_BITS, startbit=1)
+    control_vals = control.to_numpy(dtype=np.int64)
+    labels = np.array([bits2control(val) for val in control_vals.tolist()], dtype=object)
+    changes = control_vals != np.r_[0, control_vals[:-1]]
+    return df.assign(
+        control=control,
+        control_label=labels,
+        control_labels=seq_control_labels(tuple(labels[changes].tolist())))
+
+
+@lru_cache(maxsize=4096)
+def seq_control_labels(seq):
+    return '-'.join(remove_repeats(seq))
 
 
 def unique_control_labels(df):
-    labels = df.groupby('hashid').apply(lambda ssf_df: '-'.join(sorted(waveform for waveform in ssf_df['control_label'].unique() if 'T' not in waveform)))
-    labels.name = 'unique_control_labels'
-    return df.merge(labels, on='hashid', how='left')
+    labels_df = df[['hashid', 'control_label']].drop_duplicates()
+    labels_df = labels_df[~labels_df['control_label'].str.contains('T', regex=False)]
+    labels = labels_df.sort_values('control_label', kind='stable').groupby('hashid')['control_label'].agg('-'.join)
+    return map_hashid_labels(df, labels, 'unique_control_labels')
 
 
 def timer_args(parser):
@@ -139,309 +251,419 @@ def timer_args(parser):
     parser.set_defaults(pal=True, skiptest=True)
 
 
+def sid_dtype(col):
+    if col.startswith('freq') or col.startswith('pwduty') or col == 'fltcoff':
+        return pd.UInt16Dtype()
+    if col[-1].isdigit() or col.startswith('flt') or col == 'vol':
+        return pd.UInt8Dtype()
+    return None
+
+
 def set_sid_dtype(df):
     df.dtype = pd.UInt64Dtype()
     for col in df.columns:
-        if col.startswith('freq') or col.startswith('pwduty') or col == 'fltcoff':
-            col_type = pd.UInt16Dtype()
-        elif col[-1].isdigit() or col.startswith('flt') or col == 'vol':
-            col_type = pd.UInt8Dtype()
-        else:
-            continue
-        df[col] = df[col].astype(col_type)
+        col_type = sid_dtype(col)
+        if col_type is not None and df[col].dtype != col_type:
+            df[col] = df[col].astype(col_type)
     return df
 
 
+# Nullable array of float vals, NaN as NA.
+def nullable_array(vals, dtype):
+    na = np.isnan(vals)
+    return dtype.construct_array_type()(np.where(na, 0, vals).astype(dtype.numpy_dtype), na)
+
+
+# For each position, the position of the next (or same) valid value, or len(valid) if none.
+def next_valid(valid):
+    positions = np.where(valid, np.arange(len(valid)), len(valid))
+    return np.minimum.accumulate(positions[::-1])[::-1]
+
+
+def bfill(vals, valid=None):
+    if valid is None:
+        valid = ~np.isnan(vals)
+    return np.append(vals, np.nan)[next_valid(valid)]
+
+
 def squeeze_diffs(df, diff_cols, fill_value=0):
     return df.loc[(df[diff_cols].shift(fill_value=fill_value) != df[diff_cols]).any(axis=1)]
 
 
-# Read a VICE "-sounddev dump" register dump (emulator or vsid)
-def reg2state(snd_log_name, nrows=(10 * 1e6)):
-
-    def compress_writes():
-        logging.debug('reading %s', snd_log_name)
-        # TODO: pyarrow can't do nrows
-        df = read_csv(
-            snd_log_name,
-            sep=' ',
-            names=['clock_offset', 'reg', 'val'],
-            dtype={'clock_offset': np.uint64, 'reg': np.uint8, 'val': np.uint8})[:int(nrows)]
-        logging.debug('read %u rows from %s', len(df), snd_log_name)
-        df['clock'] = df['clock_offset'].cumsum()
-        assert df['reg'].min() >= 0
-        df = df[['clock', 'reg', 'val']]
-        # remove consecutive repeated register writes
-        reg_dfs = []
-        reg_cols = ['reg', 'val']
-        for reg in sorted(df.reg.unique()):
-            reg_df = df[df['reg'] == reg]
-            reg_df = squeeze_diffs(reg_df, reg_cols)
-            reg_dfs.append(reg_df)
-        df = pd.concat(reg_dfs)
-        df = df.set_index('clock').sort_index()
-        return df
-
-    def set_bit(df, val, b, bit_name):
-        df[bit_name] = np.uint8(val & 2**b)
-        df[bit_name] = df[bit_name].clip(0, 1)
-
-    def set_bits(reg_df, val, names, start=0):
-        for b, name in enumerate(names, start=start):
-            set_bit(reg_df, val, b, name)
-
-    def set_hi_lo_nib(reg_df, val, hi, lo):
-        reg_df[hi] = np.right_shift(val, 4)
-        reg_df[lo] = val & 15
-
-    def set_voice(reg_df, v):
-        vb = (v - 1) * 7
-        freq_lo = reg_df[vb]
-        freq_hi = np.left_shift(reg_df[vb + 1].astype(np.uint16), 8)
-        reg_df['freq%u' % v] = np.uint16(freq_hi + freq_lo)
-        pwduty_lo = reg_df[vb + 2]
-        pwduty_hi = np.left_shift(reg_df[vb + 3].astype(np.uint16) & 15, 8)
-        reg_df['pwduty%u' % v] = np.uint16(pwduty_hi + pwduty_lo)
-        control = reg_df[vb + 4]
-        for b, name in enumerate(CONTROL_BITS):
-            set_bit(reg_df, control, b, '%s%u' % (name, v))
-        set_hi_lo_nib(reg_df, reg_df[vb + 5], 'atk%u' % v, 'dec%u' % v)
-        set_hi_lo_nib(reg_df, reg_df[vb + 6], 'sus%u' % v, 'rel%u' % v)
-
-    def set_common(reg_df):
-        main = reg_df[24]
-        reg_df['vol'] = main & 15
-        set_bits(reg_df, main, ['fltlo', 'fltband', 'flthi', 'mute3'], start=4)
-        filter_route = reg_df[23]
-        set_bits(reg_df, filter_route, ['flt1', 'flt2', 'flt3', 'fltext'])
-        if not FLTEXT:
-            reg_df['fltext'] = 0
-        reg_df['fltres'] = np.right_shift(filter_route, 4)
-        filter_cutoff_lo = reg_df[21] & 7
-        filter_cutoff_hi = np.left_shift(reg_df[22].astype(np.uint16), 3)
-        reg_df['fltcoff'] = np.uint16(filter_cutoff_hi + filter_cutoff_lo)
-
-    def decode_regs(df):
-        max_reg = max(24, df['reg'].max())
-        reg_df = df.pivot(columns='reg', values='val').fillna(
-            method='ffill').fillna(0).astype(np.uint8)
-        all_regs = [c for c in range(max_reg + 1)]
-        for reg in all_regs:
-            if reg not in reg_df.columns:
-                reg_df[reg] = 0
-        for v in (1, 2, 3):
-            set_voice(reg_df, v)
-        set_common(reg_df)
-        reg_df.drop(all_regs, axis=1, inplace=True)
-        return reg_df
-
-    df = compress_writes()
-    reg_df = decode_regs(df)
-    df.drop(['reg', 'val'], axis=1, inplace=True)
-    df = df.join(reg_df, on='clock')
-    logging.debug('%u rows from %s after compression', len(df), snd_log_name)
-    return df
+def read_reg_log(snd_log_name, nrows=None, chunksize=None):
+    logging.debug('reading %s', snd_log_name)
+    kwargs = {
+        'sep': ' ',
+        'names': ['clock_offset', 'reg', 'val'],
+        'dtype': {'clock_offset': np.uint64, 'reg': np.uint8, 'val': np.uint8}}
+    if nrows:
+        nrows = int(nrows)
+    else:
+        nrows = None
+    if is_reg_log_bin(snd_log_name):
+        writes = read_reg_log_bin(snd_log_name)[:nrows]
+        logging.debug('mapped %u rows from %s', len(writes), snd_log_name)
+        if not chunksize:
+            chunksize = max(len(writes), 1)
+        for i in range(0, len(writes), int(chunksize)):
+            chunk = writes[i:i + int(chunksize)]
+            yield pd.DataFrame({
+                'clock_offset': chunk['clock_offset'].astype(np.uint64),
+                'reg': chunk['reg'],
+                'val': chunk['val']}, copy=False)
+        return
+    if chunksize:
+        yield from read_csv_chunks(snd_log_name, chunksize=int(chunksize), nrows=nrows, **kwargs)
+        return
+    # TODO: pyarrow can't do nrows
+    df = read_csv(snd_log_name, **kwargs)[:nrows]
+    logging.debug('read %u rows from %s', len(df), snd_log_name)
+    yield df
+
+
+# Remove consecutive repeated writes to the same register, in a single pass
+# over a clock ordered frame of writes. last_vals holds the last value
+# written to each register (or -1 if none), and is updated in place.
+def compress_writes(df, last_vals):
+    reg = df['reg'].to_numpy()
+    val = df['val'].to_numpy()
+    order = np.argsort(reg, kind='stable')
+    reg_sorted = reg[order]
+    val_sorted = val[order].astype(np.int16)
+    reg_first = np.ones(len(reg_sorted), dtype=bool)
+    reg_first[1:] = reg_sorted[1:] != reg_sorted[:-1]
+    prev_val = np.empty_like(val_sorted)
+    prev_val[1:] = val_sorted[:-1]
+    prev_val[reg_first] = last_vals[reg_sorted[reg_first]]
+    reg_last = np.ones(len(reg_sorted), dtype=bool)
+    reg_last[:-1] = reg_first[1:]
+    last_vals[reg_sorted[reg_last]] = val_sorted[reg_last]
+    keep = np.empty_like(reg_first)
+    keep[order] = val_sorted != prev_val
+    return df[keep].set_index('clock')
+
+
+# Read a VICE "-sounddev dump" register dump (emulator or vsid), in chunks of
+# chunksize writes if requested. Clock, register values and writes at the
+# last clock of a chunk are carried into the next chunk, so the concatenated
+# chunks are the same as the state from reading the whole dump at once.
+def reg2regstate_chunks(snd_log_name, nrows=(10 * 1e6), chunksize=None):
+
+    def decode_writes(df, regs):
+        # registers not written in this chunk keep their last value.
+        reg_df = df.pivot(columns='reg', values='val').reindex(
+            columns=regs.index).ffill().fillna(regs).astype(np.uint8)
+        regs = reg_df.iloc[-1]
+        state = SidRegState(df.index.to_numpy(), reg_df.to_numpy()[reg_df.index.get_indexer(df.index)])
+        logging.debug('%u rows from %s after compression', len(state), snd_log_name)
+        return (state, regs)
+
+    clock = 0
+    last_vals = np.full(256, -1, dtype=np.int16)
+    # a first write of 0 to register 0 is redundant.
+    last_vals[0] = 0
+    regs = pd.Series(0, index=range(SID_REGS), dtype=np.uint8)
+    held_df = None
+
+    for df in read_reg_log(snd_log_name, nrows=nrows, chunksize=chunksize):
+        if df.empty:
+            continue
+        df['clock'] = df['clock_offset'].cumsum() + clock
+        clock = df['clock'].iat[-1]
+        df = compress_writes(df[['clock', 'reg', 'val']], last_vals)
+        if held_df is not None:
+            df = pd.concat([held_df, df])
+        # more writes at the last clock may follow in the next chunk.
+        held = df.index == clock
+        held_df = df[held]
+        df = df[~held]
+        if not df.empty:
+            state, regs = decode_writes(df, regs)
+            yield state
+
+    if held_df is not None and not held_df.empty:
+        state, regs = decode_writes(held_df, regs)
+        yield state
+
+
+def reg2state_chunks(snd_log_name, nrows=(10 * 1e6), chunksize=None):
+    for state in reg2regstate_chunks(snd_log_name, nrows=nrows, chunksize=chunksize):
+        yield state.to_df()
+
+
+# The whole state, in memory (only parsing is bounded by chunksize).
+def reg2regstate(snd_log_name, nrows=(10 * 1e6), chunksize=None):
+    return SidRegState.concat(reg2regstate_chunks(snd_log_name, nrows=nrows, chunksize=chunksize))
+
+
+def reg2state(snd_log_name, nrows=(10 * 1e6), chunksize=None):
+    return reg2regstate(snd_log_name, nrows=nrows, chunksize=chunksize).to_df()
 
 
 def coalesce_near_writes(vdf, cols, near=16):
     vdf = vdf.reset_index()
-    clock_diff = vdf['clock'].astype(np.int64).diff(-1).astype(pd.Int64Dtype())
-    near_cond = ((clock_diff < 0) & (clock_diff >= -near))
+    clock_diff = np.diff(vdf['clock'].to_numpy(dtype=np.int64))
+    near_next = (clock_diff > 0) & (clock_diff <= near)
     for b2_reg in cols:
         logging.debug('coalesce %s', b2_reg)
-        b2_next = vdf[b2_reg].shift(-1)
-        b2_cond = near_cond & (vdf[b2_reg] != b2_next)
-        vdf.loc[b2_cond, [b2_reg]] = pd.NA
-        vdf[b2_reg] = vdf[b2_reg].fillna(method='bfill')
+        col = vdf[b2_reg]
+        vals = col.to_numpy(dtype=np.float64, na_value=np.nan)
+        na = np.isnan(vals)
+        changed = vals[:-1] != vals[1:]
+        if isinstance(col.dtype, pd.api.extensions.ExtensionDtype):
+            # comparison with pd.NA is not a change.
+            changed &= ~(na[:-1] | na[1:])
+        # a value changed by a near write, takes the value from the last near write.
+        valid = ~na
+        valid[:-1] &= ~(near_next & changed)
+        vals = bfill(vals, valid)
+        if isinstance(col.dtype, pd.api.extensions.ExtensionDtype):
+            vdf[b2_reg] = nullable_array(vals, col.dtype)
+        else:
+            vdf[b2_reg] = vals
     vdf = vdf.set_index('clock')
     return vdf
 
 
-def calc_pr_frames(ssf_df, sid, first_clock_start):
+def calc_pr_frames(ssf_df, sid, first_clock_start, by=None):
     pr_speed = ssf_df['pr_speed'].clip(lower=1)
     pr_speed_q = (sid.clockq / pr_speed).astype(pd.Int32Dtype())
     pr_clock = ssf_df['clock'] + ssf_df['clock_start'] - first_clock_start
     ssf_df['pr_frame'] = pr_clock.floordiv(pr_speed_q).astype(pd.Int32Dtype())
-    ssf_df['pr_frame'] -= ssf_df['pr_frame'].min()
+    if by is None:
+        ssf_df['pr_frame'] -= ssf_df['pr_frame'].min()
+    else:
+        ssf_df['pr_frame'] -= ssf_df.groupby(by, sort=False)['pr_frame'].transform('min')
     return ssf_df
 
 
-def hash_tuple(s):
-    return hash(tuple(s))
+# Hashes are computed with fixed keys, so are stable across runs and processes.
+HASH_PRIME = np.uint64(0x100000001b3)
+
+
+def mix64(x):
+    x = x ^ (x >> np.uint64(30))
+    x = x * np.uint64(0xbf58476d1ce4e5b9)
+    x = x ^ (x >> np.uint64(27))
+    x = x * np.uint64(0x94d049bb133111eb)
+    return x ^ (x >> np.uint64(31))
+
+
+# Order dependent combination of uint64 hashes within groups, returning the group's hash for each row.
+def hash_ordered(hashes, groups):
+    codes, _ = pd.factorize(groups, sort=False)
+    if not len(codes):
+        return np.empty(0, dtype=np.uint64)
+    order = np.argsort(codes, kind='stable')
+    starts = np.flatnonzero(np.diff(codes[order], prepend=-1))
+    lengths = np.diff(starts, append=len(codes))
+    pos = np.arange(len(codes)) - np.repeat(starts, lengths)
+    powers = np.cumprod(np.full(lengths.max(), HASH_PRIME, dtype=np.uint64))
+    group_hashes = np.add.reduceat(np.asarray(hashes, dtype=np.uint64)[order] * powers[pos], starts)
+    group_hashes = mix64(group_hashes ^ lengths.astype(np.uint64))
+    return group_hashes[codes]
+
+
+def hash_ints(ints):
+    return int(hash_ordered(np.array(ints, dtype=np.int64).view(np.uint64), np.zeros(len(ints), dtype=np.int64)).view(np.int64)[0])
+
+
+# hash_ints() of each (a, b) pair.
+def hash_int_pairs(a, b):
+    ints = np.column_stack((a, b)).astype(np.int64).ravel()
+    return hash_ordered(ints.view(np.uint64), np.repeat(np.arange(len(a)), 2))[::2].view(np.int64)
 
 
 def hash_vdf(vdf, meta_cols, hashid='hashid_noclock', ssf='ssf'):
-    uniq = vdf.drop(list(meta_cols), axis=1).drop_duplicates(ignore_index=True)
-    merge_cols = list(uniq.columns)
-    dtypes = set(uniq.dtypes.to_dict().values())
+    hash_cols = [col for col in vdf.columns if col not in meta_cols]
+    dtypes = set(vdf[hash_cols].dtypes.to_dict().values())
     valid_dtypes = {pd.UInt8Dtype(), pd.UInt16Dtype(), pd.Int64Dtype()}
     if dtypes - valid_dtypes:
         logging.error('invalid dtypes to hash_vdf: %s', dtypes - valid_dtypes)
         raise ValueError
-    uniq['row_hash'] = uniq.apply(hash_tuple, axis=1)
-    logging.debug('%u unique voice states', len(uniq))
-    vdf = vdf.merge(uniq, how='left', on=merge_cols)
-    vdf[hashid] = vdf.groupby([ssf], sort=False)['row_hash'].transform(hash_tuple).astype(np.int64)
-    vdf.drop(['row_hash'], inplace=True, axis=1)
+    vdf = vdf.reset_index(drop=True)
+    row_hashes = pd.util.hash_pandas_object(vdf[hash_cols], index=False).to_numpy()
+    logging.debug('%u unique voice states', len(np.unique(row_hashes)))
+    vdf[hashid] = hash_ordered(row_hashes, vdf[ssf].to_numpy()).view(np.int64)
     return vdf
 
 
-def split_vdf(sid, df, near=16, guard=96, maxprspeed=8):
-    fltcols = [col for col in df.columns if col.startswith('flt') and not col[-1].isdigit()]
-    mod_cols = ['freq3', 'test3', 'sync1', 'ring1']
-
-    def v_cols(v):
-        sync_map = {
-           1: 3,
-           2: 1,
-           3: 2,
-        }
-
-        def append_voicenum(cols, v):
-            return ['%s%u' % (col, v) for col in cols]
-
-        cols = [col for col in df.columns if not col[-1].isdigit() or (col[-1] == str(v) and col != 'mute3')]
-        cols.extend(append_voicenum(['freq', 'test'], sync_map[v]))
-        return cols
-
-    def renamed_cols(v, cols):
-        if v == 1:
-            return cols
-        new_cols = []
-        for col in cols:
-            prefix, suffix = col[:-1], col[-1]
-            if suffix.isdigit():
-                if int(suffix) == v:
-                    suffix = str(1)
-                else:
-                    suffix = str(3)
-                col = ''.join((prefix, suffix))
-            new_cols.append(col)
-        return new_cols
-
-    def split_gate_to_ssfs(v, v_df):
-        logging.debug('splitting to SSFs for voice %u', v)
-        v_df['diff_gate1'] = v_df['gate1'].astype(np.int8).diff(periods=1).fillna(0).astype(pd.Int8Dtype()).fillna(0)
-        v_df['ssf'] = v_df['diff_gate1']
-        v_df.loc[v_df['ssf'] != 1, ['ssf']] = 0
-        v_df['ssf'] = v_df['ssf'].cumsum().astype(np.uint64)
-        v_df = v_df.reset_index()
-        logging.debug('%u raw SSFs for voice %u', v_df['ssf'].tail(1), v)
-        return v_df
-
-    def remove_redundant_state(v, v_df):
-        if v_df['atk1'].max() or v_df['dec1'].max():
-            logging.debug('removing redundant AD for voice %u', v)
-            # select AD from when gate on
-            ad_df = v_df[v_df['diff_gate1'] == 1][['ssf', 'atk1', 'dec1']]
-            v_df.drop(['atk1', 'dec1'], axis=1, inplace=True)
-            v_df = v_df.merge(ad_df, on='ssf', right_index=False)
-
-        if v_df['rel1'].max():
-            logging.debug('removing redundant R for voice %u', v)
-            # select R from when gate off
-            r_df = v_df[v_df['diff_gate1'] == -1][['ssf', 'rel1']]
-            if not r_df.empty:
-                v_df.drop(['rel1'], axis=1, inplace=True)
-                v_df = v_df.merge(r_df, on='ssf', right_index=False)
-
-        # use first non-zero S while gate on.
-        logging.debug('removing redundant S for voice %u', v)
-        v_df.loc[v_df['sus1'] == 0, 'sus1'] = pd.NA
-        v_df['sus1'] = v_df['sus1'].fillna(method='bfill').fillna(0)
-        v_df.loc[(v_df['diff_gate1'] == 1) & (v_df['sus1'] == 0) & (v_df['atk1'] == 0), ['sus1']] = 15
-
-        v_df.loc[v_df['diff_gate1'] != 1, ['atk1', 'dec1', 'sus1', 'rel1']] = pd.NA
-        v_df.drop(['diff_gate1'], axis=1, inplace=True)
-
-        # http://www.ffd2.com/fridge/chacking/c=hacking20.txt
-        # http://www.ffd2.com/fridge/chacking/c=hacking21.txt
-        # https://codebase64.org/doku.php?id=base:vicious_sid_demo_routine_explained
-        # https://bitbucket.org/wothke/websid/src/master/docs/digi-samples.txt
-
-        v_df.set_index('ssf', inplace=True)
-
-        logging.debug('removing redundant state for voice %u', v)
-        # If test1 is set only at the start of the SSF, remove inaudible state.
-        v_df['test1_first'] = v_df['clock']
-        v_df.loc[v_df['test1'] == 1, ['test1_first']] = pd.NA
-        v_df['test1_first'] = v_df.groupby(['ssf'], sort=False)['test1_first'].min()
-        v_df.loc[(v_df['test1'] == 1) & (v_df['clock'] <= v_df['test1_first']), ['freq1', 'pwduty1', 'flt1']] = pd.NA
-        v_df.drop(['test1_first'], axis=1, inplace=True)
-
-        # remove modulator voice state while sync1/ring1 not set
-        v_df.loc[(v_df['freq3'] == 0), ['ring1', 'sync1']] = 0
-        v_df.loc[(v_df['ring1'] == 1) & (v_df['tri1'] == 0), ['ring1']] = 0
-        v_df.loc[~((v_df['sync1'] == 1) | ((v_df['ring1'] == 1) & (v_df['tri1'] == 1))), mod_cols] = pd.NA
-        # remove carrier state when waveform 0
-        v_df.loc[~((v_df['tri1'] == 1) | (v_df['saw1'] == 1) | (v_df['noise1'] == 1) | (v_df['pulse1'] == 1)), ['freq1'] + mod_cols] = pd.NA
-        # remove filter state when no filter.
-        v_df.loc[(v_df['flt1'] == 0) | v_df['flt1'].isna(), fltcols] = pd.NA
-        # remove pwduty state when no pulse1 set.
-        v_df.loc[(v_df['pulse1'] == 0) | v_df['pulse1'].isna(), ['pwduty1']] = pd.NA
-
-        # remove trailing rows when test1 set.
-        v_df['test1_last'] = v_df['clock']
-        v_df.loc[v_df['test1'] == 1, ['test1_last']] = pd.NA
-        v_df['test1_last'] = v_df.groupby(['ssf'], sort=False)['test1_last'].max()
-        v_df = v_df[(v_df['clock'] <= v_df['test1_last'])]
-        v_df.drop(['test1_last'], axis=1, inplace=True)
-
-        # remove trailing rows when no waveform set.
-        v_df['waveform_last'] = v_df['clock']
-        v_df.loc[(v_df['pulse1'] == 0) & (v_df['tri1'] == 0) & (v_df['noise1'] == 0) & (v_df['saw1'] == 0), ['waveform_last']] = pd.NA
-        v_df['waveform_last'] = v_df.groupby(['ssf'], sort=False)['waveform_last'].max()
-        # also removes SSFs with no waveform.
-        v_df = v_df[(v_df['clock'] <= v_df['waveform_last'])]
-        v_df.drop(['waveform_last'], axis=1, inplace=True)
-        return v_df
-
-    df = set_sid_dtype(df)
-    df = coalesce_near_writes(df, ('fltcoff',), near=near)
+# State for voice v, with filter state that does not matter removed.
+def voice_state_df(state, v, near):
+    v_df = set_sid_dtype(state.voice(v).to_df())
+    v_df = coalesce_near_writes(v_df, ('fltcoff',), near=near)
     # when filter is not routed, cutoff and resonance do not matter.
-    df.loc[(df['flthi'] == 0) & (df['fltband'] == 0) & (df['fltlo'] == 0), ['fltcoff', 'fltres']] = pd.NA
+    v_df.loc[(v_df['flthi'] == 0) & (v_df['fltband'] == 0) & (v_df['fltlo'] == 0), ['fltcoff', 'fltres']] = pd.NA
     # never use externally filtered audio
-    df.loc[:, 'fltext'] = pd.NA
-    df = set_sid_dtype(df)
-    v_dfs = []
-    ssfs = 0
-    non_meta_cols = set()
+    v_df.loc[:, 'fltext'] = pd.NA
+    return set_sid_dtype(v_df)
 
-    for v in (0, 1, 2, 3):
-        logging.debug('splitting voice %u', v)
 
-        if v:
-            if df['gate%u' % v].max() == 0:
-                continue
-            cols = v_cols(v)
-            v_df = df[cols].copy()
-            v_df.loc[:, 'vol'] = pd.NA
-            v_df.columns = renamed_cols(v, cols)
+def split_gate_to_ssfs(v, v_df):
+    logging.debug('splitting to SSFs for voice %u', v)
+    v_df['diff_gate1'] = v_df['gate1'].astype(np.int8).diff(periods=1).fillna(0).astype(pd.Int8Dtype()).fillna(0)
+    v_df['ssf'] = v_df['diff_gate1']
+    v_df.loc[v_df['ssf'] != 1, ['ssf']] = 0
+    v_df['ssf'] = v_df['ssf'].cumsum().astype(np.uint64)
+    v_df = v_df.reset_index()
+    logging.debug('%u raw SSFs for voice %u', v_df['ssf'].tail(1), v)
+    return v_df
+
+
+# Reduce vals over each SSF (ssfs must be sorted), returning the reduction for each row.
+def ssf_reduce(ufunc, ssfs, vals):
+    if not len(ssfs):
+        return vals
+    starts = np.flatnonzero(np.r_[True, ssfs[1:] != ssfs[:-1]])
+    return np.repeat(ufunc.reduceat(vals, starts), np.diff(np.r_[starts, len(ssfs)]))
+
+
+# For each row, the row in the same SSF where event is true (at most one per SSF), or -1.
+def ssf_event_rows(ssfs, event):
+    event_rows = np.flatnonzero(event)
+    if not len(event_rows):
+        return np.full(len(ssfs), -1)
+    event_ssfs = ssfs[event_rows]
+    i = np.searchsorted(event_ssfs, ssfs).clip(0, len(event_rows) - 1)
+    return np.where(event_ssfs[i] == ssfs, event_rows[i], -1)
 
-            logging.debug('coalescing near writes for voice %u', v)
+
+def select_rows(state, rows):
+    for col, vals in state.items():
+        state[col] = vals[rows]
+
+
+def set_na(state, cond, cols):
+    for col in cols:
+        state[col] = np.where(cond, np.nan, state[col])
+
+
+# Operates on columns as arrays (NaN as NA) rather than merging per SSF dataframes.
+def remove_redundant_state(v, v_df):
+    fltcols = [col for col in v_df.columns if col.startswith('flt') and not col[-1].isdigit()]
+    state = {}
+    for col in v_df.columns:
+        if col in ('clock', 'ssf'):
+            state[col] = v_df[col].to_numpy()
+        else:
+            state[col] = v_df[col].to_numpy(dtype=np.float64, na_value=np.nan)
+
+    if np.nanmax(state['atk1'], initial=0) or np.nanmax(state['dec1'], initial=0):
+        logging.debug('removing redundant AD for voice %u', v)
+        # select AD from when gate on
+        ad_rows = ssf_event_rows(state['ssf'], state['diff_gate1'] == 1)
+        ad = {col: state.pop(col)[ad_rows[ad_rows >= 0]] for col in ('atk1', 'dec1')}
+        select_rows(state, ad_rows >= 0)
+        state.update(ad)
+
+    if np.nanmax(state['rel1'], initial=0):
+        logging.debug('removing redundant R for voice %u', v)
+        # select R from when gate off
+        r_rows = ssf_event_rows(state['ssf'], state['diff_gate1'] == -1)
+        if (r_rows >= 0).any():
+            r = {'rel1': state.pop('rel1')[r_rows[r_rows >= 0]]}
+            select_rows(state, r_rows >= 0)
+            state.update(r)
+
+    # use first non-zero S while gate on.
+    logging.debug('removing redundant S for voice %u', v)
+    gate_on = state.pop('diff_gate1') == 1
+    sus = np.nan_to_num(bfill(np.where(state['sus1'] == 0, np.nan, state['sus1'])))
+    sus[gate_on & (sus == 0) & (state['atk1'] == 0)] = 15
+    state['sus1'] = sus
+    set_na(state, ~gate_on, ADSR_COLS)
+
+    # http://www.ffd2.com/fridge/chacking/c=hacking20.txt
+    # http://www.ffd2.com/fridge/chacking/c=hacking21.txt
+    # https://codebase64.org/doku.php?id=base:vicious_sid_demo_routine_explained
+    # https://bitbucket.org/wothke/websid/src/master/docs/digi-samples.txt
+
+    logging.debug('removing redundant state for voice %u', v)
+    # If test1 is set only at the start of the SSF, remove inaudible state.
+    clock = state['clock'].astype(np.float64)
+    test1 = state['test1'] == 1
+    test1_first = ssf_reduce(np.fmin, state['ssf'], np.where(test1, np.nan, clock))
+    set_na(state, test1 & (clock <= test1_first), ['freq1', 'pwduty1', 'flt1'])
+
+    # remove modulator voice state while sync1/ring1 not set
+    no_mod3 = state['freq3'] == 0
+    for col in ('ring1', 'sync1'):
+        state[col] = np.where(no_mod3, 0, state[col])
+    state['ring1'] = np.where((state['ring1'] == 1) & (state['tri1'] == 0), 0, state['ring1'])
+    set_na(state, ~((state['sync1'] == 1) | ((state['ring1'] == 1) & (state['tri1'] == 1))), MOD_COLS)
+    # remove carrier state when waveform 0
+    waveform = (state['tri1'] == 1) | (state['saw1'] == 1) | (state['noise1'] == 1) | (state['pulse1'] == 1)
+    set_na(state, ~waveform, ['freq1'] + MOD_COLS)
+    # remove filter state when no filter.
+    set_na(state, (state['flt1'] == 0) | np.isnan(state['flt1']), fltcols)
+    # remove pwduty state when no pulse1 set.
+    set_na(state, (state['pulse1'] == 0) | np.isnan(state['pulse1']), ['pwduty1'])
+
+    # remove trailing rows when test1 set.
+    test1_last = ssf_reduce(np.fmax, state['ssf'], np.where(test1, np.nan, clock))
+    select_rows(state, clock <= test1_last)
+
+    # remove trailing rows when no waveform set.
+    clock = state['clock'].astype(np.float64)
+    no_waveform = (state['pulse1'] == 0) & (state['tri1'] == 0) & (state['noise1'] == 0) & (state['saw1'] == 0)
+    waveform_last = ssf_reduce(np.fmax, state['ssf'], np.where(no_waveform, np.nan, clock))
+    # also removes SSFs with no waveform.
+    select_rows(state, clock <= waveform_last)
+
+    ssfs = state.pop('ssf')
+    for col, vals in state.items():
+        col_type = sid_dtype(col)
+        if col_type is not None:
+            state[col] = nullable_array(vals, col_type)
+    return pd.DataFrame(state, index=pd.Index(ssfs, name='ssf'))
+
+
+@contextmanager
+def timed(msg, *args):
+    start_time = time.time()
+    yield
+    logging.debug(msg + ' in %.2fs', *args, time.time() - start_time)
+
+
+# Split one voice's state into SSFs (SSFs numbered from 0 within the voice).
+# Returns (v, SSF state or None, non meta columns or None if the voice is unused).
+def split_voice(sid, state, v, near, guard, maxprspeed):
+    logging.debug('splitting voice %u', v)
+
+    if v:
+        if not state.voice(v)['gate1'].any():
+            return (v, None, None)
+        v_df = voice_state_df(state, v, near)
+        v_df.loc[:, 'vol'] = pd.NA
+
+        with timed('coalesced near writes for voice %u', v):
             v_df = coalesce_near_writes(v_df, ('freq1', 'pwduty1', 'freq3'), near=near)
+        with timed('split to SSFs for voice %u', v):
             v_df = split_gate_to_ssfs(v, v_df)
+        with timed('removed redundant state for voice %u', v):
             v_df = remove_redundant_state(v, v_df)
-            non_meta_cols = set(v_df.columns)
-        else:
-            cols = v_cols(1)
-            v_df = df[cols].copy()
-            non_vol_cols = copy.deepcopy(cols)
-            non_vol_cols.remove('vol')
-            v_df.columns = renamed_cols(1, cols)
-            v_df.loc[:, non_vol_cols] = pd.NA
-
-            diff_vol = v_df['vol'].astype(np.int8).diff(periods=1).fillna(0).astype(pd.Int8Dtype()).fillna(0)
-            v_df['ssf'] = diff_vol
-            v_df.loc[v_df['ssf'] != 0, ['ssf']] = 1
-            v_df['ssf'] = v_df['ssf'].cumsum().astype(np.uint64)
-            v_df = v_df.reset_index()
-            v_df.set_index('ssf', inplace=True)
-            non_meta_cols = {'vol'}
-
-        non_meta_cols -= {'clock'}
+        non_meta_cols = set(v_df.columns)
+    else:
+        v_state = state.voice(1)
+        v_df = v_state.to_df(['vol'])
+        for col in v_state.columns:
+            if col == 'vol':
+                continue
+            v_df[col] = nullable_array(np.full(len(v_df), np.nan), sid_dtype(col))
+        v_df = v_df[v_state.columns]
+
+        diff_vol = v_df['vol'].astype(np.int8).diff(periods=1).fillna(0).astype(pd.Int8Dtype()).fillna(0)
+        v_df['ssf'] = diff_vol
+        v_df.loc[v_df['ssf'] != 0, ['ssf']] = 1
+        v_df['ssf'] = v_df['ssf'].cumsum().astype(np.uint64)
+        v_df = v_df.reset_index()
+        v_df.set_index('ssf', inplace=True)
+        non_meta_cols = {'vol'}
+
+    non_meta_cols -= {'clock'}
+    with timed('set dtypes for voice %u', v):
         v_df = set_sid_dtype(v_df)
-        logging.debug('calculating clock for voice %u', v)
+    with timed('calculated clock for voice %u', v):
         v_df['clock_start'] = v_df.groupby(['ssf'], sort=False)['clock'].min()
         v_df['next_clock_start'] = v_df['clock_start'].shift(-1).astype(pd.Int64Dtype())
         v_df['next_clock_start'] = v_df.groupby(['ssf'], sort=False)['next_clock_start'].max()
@@ -451,29 +673,71 @@ def split_vdf(sid, df, near=16, guard=96, maxprspeed=8):
         guard_start = v_df['next_clock_start'] - v_df['clock'].astype(pd.Int64Dtype())
         v_df = v_df[~((guard_start > 0) & (guard_start < guard))]
 
-        # extract only changes
-        logging.debug('extracting only state changes for voice %u (rows before %u)', v, len(v_df))
+    # extract only changes
+    logging.debug('extracting only state changes for voice %u (rows before %u)', v, len(v_df))
+    with timed('extracted only state changes for voice %u', v):
         v_df = v_df.reset_index().set_index('clock')
         v_df = squeeze_diffs(v_df, list(non_meta_cols))
 
-        logging.debug('extracted only state changes for voice %u (rows after %u)', v, len(v_df))
-        v_df = v_df.reset_index().set_index('ssf')
+    logging.debug('extracted only state changes for voice %u (rows after %u)', v, len(v_df))
+    v_df = v_df.reset_index().set_index('ssf')
 
-        if v_df.empty:
-            continue
+    if v_df.empty:
+        return (v, None, non_meta_cols)
 
-        logging.debug('calculating rates for voice %u', v)
+    with timed('calculated rates for voice %u', v):
         v_df['rate'], v_df['pr_speed'] = calc_rates(sid, maxprspeed, v_df)
-        pr_speeds = v_df['pr_speed'].unique()
-        logging.debug('pr_speeds for voice %u: %s', v, sorted(pr_speeds))
-        pr_speeds = v_df.reset_index()[['ssf', 'pr_speed']].groupby('pr_speed')['ssf'].nunique().to_dict()
-        sorted_pr_speeds = sorted(pr_speeds.items(), key=lambda x: x[1], reverse=True)
-        logging.debug(f'min/mean/max rate {v_df.rate.min()}/{v_df.rate.mean()}/{v_df.rate.max()} for voice {v} (counts {sorted_pr_speeds})')
+    pr_speeds = v_df['pr_speed'].unique()
+    logging.debug('pr_speeds for voice %u: %s', v, sorted(pr_speeds))
+    pr_speeds = v_df.reset_index()[['ssf', 'pr_speed']].groupby('pr_speed')['ssf'].nunique().to_dict()
+    sorted_pr_speeds = sorted(pr_speeds.items(), key=lambda x: x[1], reverse=True)
+    logging.debug(f'min/mean/max rate {v_df.rate.min()}/{v_df.rate.mean()}/{v_df.rate.max()} for voice {v} (counts {sorted_pr_speeds})')
+
+    v_df['clock'] -= v_df['clock_start']
+    v_df.reset_index(level=0, inplace=True)
+
+    v_df['v'] = v
+    return (v, v_df, non_meta_cols)
+
+
+SPLIT_VOICE_ARGS = {}
+
+
+def init_split_voice(sid, state, near, guard, maxprspeed):
+    SPLIT_VOICE_ARGS.update({'sid': sid, 'state': state, 'near': near, 'guard': guard, 'maxprspeed': maxprspeed})
+
+
+def split_voice_worker(v):
+    return split_voice(v=v, **SPLIT_VOICE_ARGS)
+
+
+def split_voices(sid, state, near, guard, maxprspeed, workers):
+    voices = (0, 1, 2, 3)
+    if workers > 1:
+        # when workers are forked, state is inherited and not copied.
+        with ProcessPoolExecutor(
+                max_workers=min(workers, len(voices)), initializer=init_split_voice,
+                initargs=(sid, state, near, guard, maxprspeed)) as pool:
+            for result in pool.map(split_voice_worker, voices):
+                yield result
+    else:
+        for v in voices:
+            yield split_voice(sid, state, v, near, guard, maxprspeed)
 
-        v_df['clock'] -= v_df['clock_start']
-        v_df.reset_index(level=0, inplace=True)
 
-        v_df['v'] = v
+# Split state (a SidRegState, or a DataFrame of decoded state) into SSFs per voice.
+def split_vdf(sid, state, near=16, guard=96, maxprspeed=8, workers=1):
+    if isinstance(state, pd.DataFrame):
+        state = SidRegState.from_df(state)
+    v_dfs = []
+    ssfs = 0
+    non_meta_cols = set()
+
+    for v, v_df, v_non_meta_cols in split_voices(sid, state, near, guard, maxprspeed, workers):
+        if v_non_meta_cols is not None:
+            non_meta_cols = v_non_meta_cols
+        if v_df is None:
+            continue
         v_df['ssf'] += ssfs
         ssfs = v + v_df['ssf'].max()
         v_dfs.append(v_df)
@@ -490,65 +754,88 @@ def split_vdf(sid, df, near=16, guard=96, maxprspeed=8):
             yield (v, v_df.drop(['v'], axis=1))
 
 
-def ssf_start_duration(sid, ssf_df):
-    clock_duration = ssf_df['clock'].max() + sid.clockq
-    next_clock_start = ssf_df['next_clock_start'].iat[-1]
-    clock_start = ssf_df['clock_start'].iat[-1]
-
-    if pd.notna(next_clock_start):
-        if next_clock_start > clock_start:
-            clock_duration = next_clock_start - clock_start - 1
-    return (clock_start, clock_duration)
-
-
-def pad_ssf_duration(sid, ssf_df, first_clock_duration):
-    _clock_start, clock_duration = ssf_start_duration(sid, ssf_df)
-    last_row_df = ssf_df[-1:].copy()
-    last_row_df['clock'] = clock_duration
-    last_row_df = last_row_df.astype(ssf_df.dtypes.to_dict())
-    ssf_df = pd.concat([ssf_df, last_row_df], ignore_index=True).reset_index(drop=True)
-    ssf_df = calc_pr_frames(ssf_df, sid, first_clock_duration).drop(['ssf', 'clock_start', 'next_clock_start'], axis=1)
-    return ssf_df
-
-
-def state2ssfs(sid, df, maxprspeed=8, near=16):
-    ssf_log = []
-    ssf_dfs = {}
-    ssf_count = defaultdict(int)
-
-    for v, v_df in split_vdf(sid, df, maxprspeed=maxprspeed, near=near):
-        ssfs = v_df['ssf'].nunique()
-        voice_ssfs = set()
-        logging.debug('splitting %u SSFs for voice %u', ssfs, v)
-        first_clock_start = int(v_df['clock_start'].iat[0] / sid.clockq) * sid.clockq
-        for hashid_noclock_pr_speed, hashid_noclock_df in v_df.groupby(['hashid_noclock', 'pr_speed'], sort=False):
-            hashid_noclock, pr_speed = hashid_noclock_pr_speed
-            hashid = hash((hashid_noclock, pr_speed))
-            group_ssf_dfs = [ssf_df for _, ssf_df in hashid_noclock_df.groupby('ssf', sort=True)]
-            ssf_df = group_ssf_dfs[0]
-            ssf_dfs[hashid] = pad_ssf_duration(sid, ssf_df, first_clock_start)
-            ssf_count[hashid] += len(group_ssf_dfs)
-            clock_starts = [ssf_df['clock_start'].iat[0] for ssf_df in group_ssf_dfs]
-            ssf_log.extend([{'clock': clock_start, 'hashid': hashid, 'voice': v} for clock_start in clock_starts])
-            voice_ssfs.add(hashid)
-        logging.debug('reduced to unique %u SSFs for voice %u', len(voice_ssfs), v)
-
-    for hashid, count in ssf_count.items():
-        ssf_dfs[hashid]['count'] = count
-        ssf_dfs[hashid]['hashid'] = hashid
-
-    def concat_dfs(x, y):
-        if x and y:
-            return pd.concat([
-                x[hashid] for hashid, count in sorted(y.items(), key=lambda i: i[1], reverse=True)]).set_index('hashid')
-        return pd.DataFrame()
-
-    ssf_log_df = pd.DataFrame()
-    if ssf_log:
-        ssf_log_df = pd.DataFrame(
-            ssf_log, dtype=pd.Int64Dtype()).set_index('clock').sort_index()
-
-    ssf_df = concat_dfs(ssf_dfs, ssf_count)
+# Append a row to each SSF, repeating its last state, at the clock where the SSF ends.
+def pad_ssfs_duration(sid, ssfs_df):
+    ssfs = ssfs_df['ssf'].to_numpy()
+    last = np.r_[ssfs[1:] != ssfs[:-1], True]
+    clock_duration = ssf_reduce(np.maximum, ssfs, ssfs_df['clock'].to_numpy(dtype=np.int64))[last] + sid.clockq
+    pad_df = ssfs_df[last].copy()
+    next_clock_start = pad_df['next_clock_start'].to_numpy(dtype=np.float64, na_value=np.nan)
+    clock_start = pad_df['clock_start'].to_numpy(dtype=np.float64)
+    next_ssf = next_clock_start > clock_start
+    clock_duration[next_ssf] = (next_clock_start - clock_start - 1)[next_ssf]
+    pad_df['clock'] = clock_duration.astype(ssfs_df['clock'].dtype)
+    # pad rows follow the last row of their SSF.
+    order = np.argsort(np.r_[np.arange(len(ssfs_df)), np.flatnonzero(last)], kind='stable')
+    return pd.concat([ssfs_df, pad_df], ignore_index=True).take(order).reset_index(drop=True)
+
+
+# Returns a voice's SSF log, and for each (hashid_noclock, pr_speed) group, the group's hashid
+# and count of SSFs, and its first SSF (padded to its duration) as a representative.
+def voice_ssfs(sid, v, v_df):
+    v_df = v_df.reset_index(drop=True)
+    first_clock_start = int(v_df['clock_start'].iat[0] / sid.clockq) * sid.clockq
+    groups = v_df.groupby(['hashid_noclock', 'pr_speed'], sort=False).ngroup().to_numpy()
+    _, group_rows = np.unique(groups, return_index=True)
+    group_hashids = hash_int_pairs(
+        v_df['hashid_noclock'].to_numpy(dtype=np.int64)[group_rows],
+        v_df['pr_speed'].to_numpy(dtype=np.int64)[group_rows])
+
+    ssfs = v_df['ssf'].to_numpy()
+    ssf_ids, ssf_rows = np.unique(ssfs, return_index=True)
+    ssf_groups = groups[ssf_rows]
+    group_counts = np.bincount(ssf_groups, minlength=len(group_rows))
+    log_order = np.lexsort((ssf_ids, ssf_groups))
+    ssf_log_df = pd.DataFrame({
+        'clock': v_df['clock_start'].to_numpy()[ssf_rows][log_order],
+        'hashid': group_hashids[ssf_groups][log_order],
+        'voice': v})
+
+    _, first_ssfs = np.unique(ssf_groups, return_index=True)
+    first_ssf_rows = ssfs == ssf_ids[first_ssfs][groups]
+    ssf_df = v_df[first_ssf_rows].copy()
+    ssf_df['hashid'] = group_hashids[groups[first_ssf_rows]]
+    ssf_df = calc_pr_frames(pad_ssfs_duration(sid, ssf_df), sid, first_clock_start, by='ssf')
+    return (ssf_log_df, group_hashids, group_counts, ssf_df)
+
+
+def state2ssfs(sid, state, maxprspeed=8, near=16, workers=1):
+    ssf_logs = []
+    hashids = []
+    counts = []
+    ssf_dfs = []
+
+    for v, v_df in split_vdf(sid, state, maxprspeed=maxprspeed, near=near, workers=workers):
+        logging.debug('splitting %u SSFs for voice %u', v_df['ssf'].nunique(), v)
+        ssf_log_df, group_hashids, group_counts, ssf_df = voice_ssfs(sid, v, v_df)
+        logging.debug('reduced to unique %u SSFs for voice %u', len(np.unique(group_hashids)), v)
+        ssf_df['voice_order'] = len(ssf_dfs)
+        ssf_logs.append(ssf_log_df)
+        hashids.append(group_hashids)
+        counts.append(group_counts)
+        ssf_dfs.append(ssf_df)
+
+    if not ssf_dfs:
+        return pd.DataFrame(), pd.DataFrame()
+
+    ssf_log_df = pd.concat(ssf_logs, ignore_index=True).astype(pd.Int64Dtype()).set_index('clock').sort_index()
+
+    # a hashid common to voices is counted over all of them, but represented by its SSF
+    # from the last voice, and SSFs are ordered by most common first, then first seen.
+    voice_orders = np.repeat(np.arange(len(hashids)), [len(group_hashids) for group_hashids in hashids])
+    hashid_orders, unique_hashids = pd.factorize(np.concatenate(hashids), sort=False)
+    hashid_counts = np.bincount(hashid_orders, weights=np.concatenate(counts)).astype(np.int64)
+    last_voice_orders = np.zeros(len(unique_hashids), dtype=np.int64)
+    np.maximum.at(last_voice_orders, hashid_orders, voice_orders)
+
+    ssf_df = pd.concat(ssf_dfs, ignore_index=True)
+    row_orders = pd.Index(unique_hashids).get_indexer(ssf_df['hashid'].to_numpy())
+    last_voice = ssf_df['voice_order'].to_numpy() == last_voice_orders[row_orders]
+    row_orders = row_orders[last_voice]
+    rows = np.lexsort((row_orders, -hashid_counts[row_orders]))
+    ssf_df = ssf_df.take(np.flatnonzero(last_voice)[rows]).drop(['ssf', 'clock_start', 'next_clock_start', 'voice_order'], axis=1)
+    ssf_df['count'] = hashid_counts[row_orders[rows]]
+    ssf_df = ssf_df.set_index('hashid')
 
     logging.debug('%u SSFs', ssf_df.index.nunique())
     return ssf_log_df, ssf_df
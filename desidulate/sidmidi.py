@@ -7,15 +7,15 @@
 import logging
 from collections import defaultdict
 from functools import lru_cache
+import numpy as np
 from music21 import midi
 from desidulate.sidlib import timer_args
+from desidulate.sidwrap import MIDI_N_TO_F
 
-A = 440
 MAX_MIDI_VEL = 127
 MAX_VEL = 116
 MIN_VEL = 32
 VEL_RANGE = MAX_VEL - MIN_VEL
-MIDI_N_TO_F = {n: (A / 32) * (2 ** ((n - 9) / 12)) for n in range(128)}
 MIDI_F_TO_N = {f: n for n, f in MIDI_N_TO_F.items()}
 VOICES = 3
 
@@ -41,6 +41,8 @@ CYMBAL_DRUMS = [PEDAL_HIHAT, CLOSED_HIHAT, OPEN_HIHAT, ACCOUSTIC_SNARE, ELECTRIC
 BASS_SPLIT_PITCH = 60
 DRUM_CHANNEL = 10
 
+NOTE_COLS = ['gate1', 'test1', 'closest_note', 'real_freq', 'atk1', 'dec1', 'sus1', 'rel1']
+
 
 def midi_args(parser):
     timer_args(parser)
@@ -321,3 +323,104 @@ class SidMidiFile:
         notes_starts = self.get_note_starts(row_states)
         notes = self.get_notes(notes_starts)
         return notes
+
+    # Velocities as sid_adsr_to_velocity() would return, for arrays of note start state.
+    def _adsr_velocities(self, clocks, last_gate_clocks, atk1, dec1, sus1, rel1, gate1):
+        attack_clock = np.array([self.sid.attack_clock[i] for i in range(self.sid_env_max + 1)], dtype=np.int64)
+        decay_release_clock = np.array(
+            [self.sid.decay_release_clock[i] for i in range(self.sid_env_max + 1)], dtype=np.int64)
+        sid_velocity = np.array([self.sid_velocity[i] for i in range(self.sid_env_max + 1)], dtype=np.int64)
+        attack_clocks = np.where(atk1 > 0, attack_clock[atk1], 0)
+        decay_clocks = attack_clocks + decay_release_clock[dec1]
+        rel_clocks = decay_release_clock[rel1]
+        rel_times = clocks - last_gate_clocks
+        with np.errstate(divide='ignore', invalid='ignore'):
+            attack_vel = np.rint((clocks / attack_clocks) * MAX_MIDI_VEL)
+            decay_vel = np.rint((1.0 - ((clocks - attack_clocks) / decay_clocks)) * MAX_MIDI_VEL)
+            rel_vel = np.rint(np.rint((1.0 - (rel_times / rel_clocks)) * MAX_MIDI_VEL) * (sus1 / self.sid_env_max))
+        in_attack = (atk1 > 0) & (clocks < attack_clocks)
+        in_decay = ~in_attack & (dec1 > 0) & (clocks < decay_clocks)
+        gate_vel = np.where(in_attack, attack_vel, np.where(in_decay, decay_vel, sid_velocity[sus1]))
+        in_release = (last_gate_clocks >= 0) & (rel_times < rel_clocks)
+        return np.where(gate1 != 0, gate_vel, np.where(in_release, rel_vel, 0)).astype(np.int64)
+
+    # Columnar get_midi_notes_from_events(), for many SSF dataframes at once.
+    def get_midi_notes_from_dfs(self, dfs):
+        dfs = list(dfs)
+        midi_notes = [None] * len(dfs)
+        batch = []
+        batch_states = []
+        note_cols = set(NOTE_COLS)
+        for i, df in enumerate(dfs):
+            if not df.empty and note_cols.issubset(df.columns):
+                states = np.column_stack([df[col].to_numpy(dtype=np.float64, na_value=np.nan) for col in NOTE_COLS])
+                if not np.isnan(states).any():
+                    batch.append(i)
+                    batch_states.append(states)
+                    continue
+            # the row by row path handles missing state as it always has.
+            midi_notes[i] = self.get_midi_notes_from_events(df.itertuples())
+        if not batch:
+            return midi_notes
+
+        lengths = np.array([len(states) for states in batch_states], dtype=np.int64)
+        ends = np.cumsum(lengths)
+        starts = ends - lengths
+        groups = np.repeat(np.arange(len(batch)), lengths)
+        group_starts = starts[groups]
+        batch_states = np.concatenate(batch_states)
+        real_freqs = batch_states[:, NOTE_COLS.index('real_freq')]
+
+        def col(name):
+            return batch_states[:, NOTE_COLS.index(name)].astype(np.int64)
+
+        clocks = np.concatenate([dfs[i].index.to_numpy(dtype=np.int64) for i in batch])
+        gate1 = col('gate1')
+        notes = col('closest_note')
+        first_in_group = np.zeros(len(clocks), dtype=bool)
+        first_in_group[starts] = True
+
+        # most recent clock at which the gate was cleared, if any.
+        gate_cleared = np.zeros(len(clocks), dtype=bool)
+        gate_cleared[1:] = (gate1[1:] == 0) & (gate1[:-1] != 0)
+        gate_cleared &= ~first_in_group
+        last_cleared = np.maximum.accumulate(np.where(gate_cleared, np.arange(len(clocks)), -1))
+        last_gate_clocks = np.where(last_cleared >= group_starts, clocks[last_cleared], -1)
+
+        # notes start on state not in test, where the note differs from the previous state not in test.
+        not_test = np.flatnonzero(col('test1') == 0)
+        note_start = np.ones(len(not_test), dtype=bool)
+        note_start[1:] = (notes[not_test][1:] != notes[not_test][:-1]) | (groups[not_test][1:] != groups[not_test][:-1])
+        note_starts = not_test[note_start]
+
+        start_groups = groups[note_starts]
+        first_rows = starts[start_groups]
+        velocities = self._adsr_velocities(
+            clocks[note_starts], last_gate_clocks[note_starts],
+            col('atk1')[first_rows], col('dec1')[first_rows], col('sus1')[first_rows], col('rel1')[first_rows],
+            gate1[note_starts])
+        velocities = np.rint((velocities / MAX_MIDI_VEL) * VEL_RANGE).astype(np.int64) + MIN_VEL
+        assert ((velocities >= MIN_VEL) & (velocities <= MAX_VEL)).all(), velocities
+
+        # notes last until the next note, or the last state.
+        next_clocks = clocks[ends[start_groups] - 1]
+        same_group_next = np.flatnonzero(start_groups[1:] == start_groups[:-1])
+        next_clocks[same_group_next] = clocks[note_starts[same_group_next + 1]]
+        durations = (np.rint((next_clocks - clocks[note_starts]) / self.sid.clockq) * self.sid.clockq).astype(np.int64)
+
+        group_note_starts = np.searchsorted(start_groups, np.arange(len(batch) + 1))
+        for g, i in enumerate(batch):
+            df = dfs[i]
+            first, last = group_note_starts[g], group_note_starts[g + 1]
+            keep = first + np.flatnonzero(durations[first:last])
+            rows = note_starts[keep] - starts[g]
+            midi_notes[i] = list(zip(
+                df.index[rows],
+                notes[note_starts[keep]].tolist(),
+                durations[keep].tolist(),
+                velocities[keep].tolist(),
+                real_freqs[note_starts[keep]]))
+        return midi_notes
+
+    def get_midi_notes_from_df(self, df):
+        return self.get_midi_notes_from_dfs([df])[0]
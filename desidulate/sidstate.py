@@ -0,0 +1,167 @@
+# Copyright 2020-2022 Josh Bailey (josh@vandervecken.com)
+
+## Permission is hereby granted, free of charge, to any person obtaining a copy of this software and associated documentation files (the "Software"), to deal in the Software without restriction, including without limitation the rights to use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of the Software, and to permit persons to whom the Software is furnished to do so, subject to the following conditions:
+
+## The above copyright notice and this permission notice shall be included in all copies or substantial portions of the Software.
+
+import numpy as np
+import pandas as pd
+from pyresidfp import ControlBits, ModeVolBits, ResFiltBits, Voice, WritableRegister
+
+# use of external filter will be non deterministic.
+FLTEXT = False
+SID_REGS = 25
+VOICE_REGS = 7
+CONTROL_BITS = ['gate', 'sync', 'ring', 'test', 'tri', 'saw', 'pulse', 'noise']
+VOICE_FIELDS = ['freq', 'pwduty'] + CONTROL_BITS + ['atk', 'dec', 'sus', 'rel']
+COMMON_COLS = ['vol', 'fltlo', 'fltband', 'flthi', 'mute3', 'flt1', 'flt2', 'flt3', 'fltext', 'fltres', 'fltcoff']
+STATE_COLS = ['%s%u' % (field, v) for v in (1, 2, 3) for field in VOICE_FIELDS] + COMMON_COLS
+# voice whose oscillator syncs or ring modulates each voice.
+SYNC_VOICE = {
+    1: 3,
+    2: 1,
+    3: 2,
+}
+
+
+def reg_word(lo_reg, hi_reg, hi_mask=0xff, hi_shift=8, lo_mask=0xff):
+    return lambda regs: ((regs[:, hi_reg] & hi_mask).astype(np.uint16) << hi_shift) + (regs[:, lo_reg] & lo_mask)
+
+
+def reg_bit(reg, bit):
+    return lambda regs: (regs[:, reg] >> bit) & 1
+
+
+def reg_nibble(reg, hi):
+    if hi:
+        return lambda regs: regs[:, reg] >> 4
+    return lambda regs: regs[:, reg] & 15
+
+
+def fltext(regs):
+    if FLTEXT:
+        return reg_bit(23, 3)(regs)
+    return np.zeros(len(regs), dtype=np.uint8)
+
+
+def state_decoders():
+    decoders = {}
+    for v in (1, 2, 3):
+        vb = (v - 1) * VOICE_REGS
+        decoders['freq%u' % v] = reg_word(vb, vb + 1)
+        decoders['pwduty%u' % v] = reg_word(vb + 2, vb + 3, hi_mask=15)
+        for b, name in enumerate(CONTROL_BITS):
+            decoders['%s%u' % (name, v)] = reg_bit(vb + 4, b)
+        decoders['atk%u' % v] = reg_nibble(vb + 5, True)
+        decoders['dec%u' % v] = reg_nibble(vb + 5, False)
+        decoders['sus%u' % v] = reg_nibble(vb + 6, True)
+        decoders['rel%u' % v] = reg_nibble(vb + 6, False)
+    decoders['vol'] = reg_nibble(24, False)
+    for b, name in enumerate(['fltlo', 'fltband', 'flthi', 'mute3'], start=4):
+        decoders[name] = reg_bit(24, b)
+    for b, name in enumerate(['flt1', 'flt2', 'flt3']):
+        decoders[name] = reg_bit(23, b)
+    decoders['fltext'] = fltext
+    decoders['fltres'] = reg_nibble(23, True)
+    decoders['fltcoff'] = reg_word(21, 22, hi_shift=3, lo_mask=7)
+    return decoders
+
+
+STATE_DECODERS = state_decoders()
+
+
+# SID state as the raw register bytes at each clock (rather than one column per field),
+# with fields such as gate1 or fltcoff decoded on demand. A voice's projection shares
+# the registers, naming that voice's fields as voice 1 and its sync source's as voice 3.
+class SidRegState:
+
+    def __init__(self, clock, regs, cols=None):
+        self.clock = clock
+        self.regs = regs
+        if cols is None:
+            cols = {col: col for col in STATE_COLS}
+        self.cols = cols
+
+    def __len__(self):
+        return len(self.clock)
+
+    def __getitem__(self, col):
+        return STATE_DECODERS[self.cols[col]](self.regs)
+
+    @property
+    def columns(self):
+        return list(self.cols)
+
+    def voice(self, v):
+        cols = {}
+        for col in STATE_COLS:
+            prefix, suffix = col[:-1], col[-1]
+            if not suffix.isdigit():
+                cols[col] = col
+            elif int(suffix) == v and col != 'mute3':
+                cols[prefix + '1'] = col
+        for field in ('freq', 'test'):
+            cols[field + '3'] = '%s%u' % (field, SYNC_VOICE[v])
+        return SidRegState(self.clock, self.regs, cols)
+
+    def to_df(self, cols=None):
+        if cols is None:
+            cols = self.columns
+        return pd.DataFrame({col: self[col] for col in cols}, index=pd.Index(self.clock, name='clock'))
+
+    @classmethod
+    def from_df(cls, df):
+        return cls(df.index.to_numpy(), state2regs(df))
+
+    @classmethod
+    def concat(cls, states):
+        states = list(states)
+        if not states:
+            return cls(np.empty(0, dtype=np.uint64), np.empty((0, SID_REGS), dtype=np.uint8))
+        return cls(np.concatenate([state.clock for state in states]), np.concatenate([state.regs for state in states]))
+
+
+def state2regs(df):
+    def col(name):
+        if name in df:
+            return df[name].fillna(0).to_numpy(dtype=np.int64)
+        return np.zeros(len(df), dtype=np.int64)
+
+    def bits(bit_cols):
+        return np.bitwise_or.reduce([col(name) * bit.value for name, bit in bit_cols])
+
+    regs = np.zeros((len(df), SID_REGS), dtype=np.uint8)
+    for voice in Voice:
+        v = voice.value + 1
+        base = voice.value * VOICE_REGS
+        freq = col('freq%u' % v)
+        pwduty = col('pwduty%u' % v)
+        regs[:, base] = freq & 0xff
+        regs[:, base + 1] = (freq >> 8) & 0xff
+        regs[:, base + 2] = pwduty & 0xff
+        regs[:, base + 3] = (pwduty >> 8) & 0x0f
+        regs[:, base + 4] = bits([
+            ('gate%u' % v, ControlBits.GATE),
+            ('sync%u' % v, ControlBits.SYNC),
+            ('ring%u' % v, ControlBits.RING_MOD),
+            ('test%u' % v, ControlBits.TEST),
+            ('tri%u' % v, ControlBits.TRIANGLE),
+            ('saw%u' % v, ControlBits.SAWTOOTH),
+            ('pulse%u' % v, ControlBits.PULSE),
+            ('noise%u' % v, ControlBits.NOISE)])
+        regs[:, base + 5] = (col('atk%u' % v) << 4) + col('dec%u' % v)
+        regs[:, base + 6] = (col('sus%u' % v) << 4) + col('rel%u' % v)
+    fltcoff = col('fltcoff')
+    regs[:, WritableRegister.Filter_Fc_Lo.value] = fltcoff & 0x07
+    regs[:, WritableRegister.Filter_Fc_Hi.value] = (fltcoff >> 3) & 0xff
+    regs[:, WritableRegister.Filter_Res_Filt.value] = bits([
+        ('flt1', ResFiltBits.Filt1),
+        ('flt2', ResFiltBits.Filt2),
+        ('flt3', ResFiltBits.Filt3),
+        ('fltext', ResFiltBits.FiltEX)]) + (col('fltres') << 4)
+    regs[:, WritableRegister.Filter_Mode_Vol.value] = bits([
+        ('fltlo', ModeVolBits.LP),
+        ('fltband', ModeVolBits.BP),
+        ('flthi', ModeVolBits.HP),
+        ('mute3', ModeVolBits.THREE_OFF)]) + col('vol')
+    return regs
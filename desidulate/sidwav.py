@@ -4,26 +4,46 @@
 
 ## The above copyright notice and this permission notice shall be included in all copies or substantial portions of the Software.
 
+import logging
+import time
+import wave
 from collections import defaultdict
+from functools import lru_cache
 import numpy as np
-import pandas as pd
 from scipy import signal
 from scipy.io import wavfile
 from scipy.fft import rfft, rfftfreq  # pylint: disable=no-name-in-module
-from pyresidfp import ControlBits, ModeVolBits, ResFiltBits, Voice
+from pyresidfp import ControlBits, WritableRegister
+from desidulate.sidstate import state2regs
 
 
+@lru_cache
+def highpass_sos(samplerate, highpass=15):
+    return signal.butter(10, highpass, 'hp', fs=samplerate, output='sos')
+
+
+# Returns (frequencies, magnitudes) of the highpassed samples' spectrum.
 def psfromsamples(samplerate, samples, highpass=15):
-    sos = signal.butter(10, highpass, 'hp', fs=samplerate, output='sos')
-    data = signal.sosfilt(sos, samples)
+    data = signal.sosfilt(highpass_sos(samplerate, highpass), samples)
     y = np.abs(rfft(data))
     x = rfftfreq(len(data), 1 / samplerate)
-    e = defaultdict(int)
-    for f, n in zip(x, y):
-        if not n:
-            continue
-        e[f] = n
-    return e
+    return (x, y)
+
+
+# Spectra of many sample buffers, computed together for buffers of the same length.
+def psfromsamples_batch(samplerate, samples_list, highpass=15):
+    sos = highpass_sos(samplerate, highpass)
+    spectra = [None] * len(samples_list)
+    lengths = defaultdict(list)
+    for i, samples in enumerate(samples_list):
+        lengths[len(samples)].append(i)
+    for length, indexes in lengths.items():
+        data = signal.sosfilt(sos, np.stack([samples_list[i] for i in indexes]), axis=-1)
+        y = np.abs(rfft(data, axis=-1))
+        x = rfftfreq(length, 1 / samplerate)
+        for i, y_i in zip(indexes, y):
+            spectra[i] = (x, y_i)
+    return spectra
 
 
 def readwav(wav_file_name):
@@ -36,213 +56,196 @@ def psfromwav(wav_file_name):
 
 
 def mostf(wav_file_name, threshold=0.65):
-    e = psfromwav(wav_file_name)
-    s = sum(e.values())
-    if not s:
+    x, y = psfromwav(wav_file_name)
+    nonzero = np.flatnonzero(y)
+    if not len(nonzero):
         return 0
-    t = 0
-    for f, n in sorted(e.items()):
-        t += (n / s)
-        if t >= threshold:
-            return f
-    return f
+    # sequential sums, as cumulative energy is compared to the threshold.
+    t = np.cumsum(y / np.cumsum(y)[-1])
+    over = np.flatnonzero((t >= threshold) & (y != 0))
+    if len(over):
+        return x[over[0]]
+    return x[nonzero[-1]]
 
 
-def _loudest(e):
-    for f, _ in sorted(e.items(), key=lambda x: x[1], reverse=True):
-        return int(f)
-    return 0
+def _loudest(spectrum):
+    x, y = spectrum
+    if not len(y):
+        return 0
+    i = np.argmax(y)
+    if not y[i]:
+        return 0
+    return int(x[i])
 
 
 def loudestf(wav_file_name):
-    e = psfromwav(wav_file_name)
-    return _loudest(e)
+    return _loudest(psfromwav(wav_file_name))
 
 
 def samples_loudestf(data, sample_rate):
-    e = psfromsamples(sample_rate, data)
-    return _loudest(e)
+    return _loudest(psfromsamples(sample_rate, data))
 
 
-def state2samples(orig_df, sid, skiptest=False, maxclock=None):
+def samples_loudestf_batch(data_list, sample_rate):
+    return [_loudest(spectrum) for spectrum in psfromsamples_batch(sample_rate, data_list)]
 
-    def nib2byte(hi, lo):
-        return (hi << 4) + lo
-
-    def control(gate, sync, ring, test, tri, saw, pulse, noise):
-        return (
-            (ControlBits.GATE.value * gate) |
-            (ControlBits.SYNC.value * sync) |
-            (ControlBits.RING_MOD.value * ring) |
-            (ControlBits.TEST.value * test) |
-            (ControlBits.TRIANGLE.value * tri) |
-            (ControlBits.SAWTOOTH.value * saw) |
-            (ControlBits.PULSE.value * pulse) |
-            (ControlBits.NOISE.value * noise))
-
-    def control1(row):
-        sid.resid.control(
-            Voice.ONE, control(
-                row.gate1, row.sync1, row.ring1, row.test1, row.tri1, row.saw1, row.pulse1, row.noise1))
-
-    def control2(row):
-        sid.resid.control(
-            Voice.TWO, control(
-                row.gate2, row.sync2, row.ring2, row.test2, row.tri2, row.saw2, row.pulse2, row.noise2))
-
-    def control3(row):
-        sid.resid.control(
-            Voice.THREE, control(
-                row.gate3, row.sync3, row.ring3, row.test3, row.tri3, row.saw3, row.pulse3, row.noise3))
-
-    def flt(row):
-        sid.resid.Filter_Res_Filt = (
-            (ResFiltBits.Filt1.value * row.flt1) |
-            (ResFiltBits.Filt2.value * row.flt2) |
-            (ResFiltBits.Filt3.value * row.flt3) |
-            (ResFiltBits.FiltEX.value * row.fltext)) + (row.fltres << 4)
-
-    def main(row):
-        sid.resid.Filter_Mode_Vol = (
-            (ModeVolBits.LP.value * row.fltlo) |
-            (ModeVolBits.BP.value * row.fltband) |
-            (ModeVolBits.HP.value * row.flthi) |
-            (ModeVolBits.THREE_OFF.value * row.mute3)) + row.vol
-
-    funcs = {
-        'atk1': lambda row: sid.resid.attack_decay(Voice.ONE, nib2byte(row.atk1, row.dec1)),
-        'atk2': lambda row: sid.resid.attack_decay(Voice.TWO, nib2byte(row.atk2, row.dec2)),
-        'atk3': lambda row: sid.resid.attack_decay(Voice.THREE, nib2byte(row.atk3, row.dec3)),
-        'dec1': lambda row: sid.resid.attack_decay(Voice.ONE, nib2byte(row.atk1, row.dec1)),
-        'dec2': lambda row: sid.resid.attack_decay(Voice.TWO, nib2byte(row.atk2, row.dec2)),
-        'dec3': lambda row: sid.resid.attack_decay(Voice.THREE, nib2byte(row.atk3, row.dec3)),
-        'flt1': flt,
-        'flt2': flt,
-        'flt3': flt,
-        'fltband': main,
-        'fltcoff': lambda row: sid.resid.filter_cutoff(row.fltcoff),
-        'flthi': main,
-        'fltlo': main,
-        'fltres': flt,
-        'fltext': flt,
-        'freq1': lambda row: sid.resid.oscillator(Voice.ONE, row.freq1),
-        'freq2': lambda row: sid.resid.oscillator(Voice.TWO, row.freq2),
-        'freq3': lambda row: sid.resid.oscillator(Voice.THREE, row.freq3),
-        'gate1': control1,
-        'gate2': control2,
-        'gate3': control3,
-        'mute3': main,
-        'noise1': control1,
-        'noise2': control2,
-        'noise3': control3,
-        'pulse1': control1,
-        'pulse2': control2,
-        'pulse3': control3,
-        'pwduty1': lambda row: sid.resid.pulse_width(Voice.ONE, row.pwduty1),
-        'pwduty2': lambda row: sid.resid.pulse_width(Voice.TWO, row.pwduty2),
-        'pwduty3': lambda row: sid.resid.pulse_width(Voice.THREE, row.pwduty3),
-        'rel1': lambda row: sid.resid.sustain_release(Voice.ONE, nib2byte(row.sus1, row.rel1)),
-        'rel2': lambda row: sid.resid.sustain_release(Voice.TWO, nib2byte(row.sus2, row.rel2)),
-        'rel3': lambda row: sid.resid.sustain_release(Voice.THREE, nib2byte(row.sus3, row.rel3)),
-        'ring1': control1,
-        'ring2': control2,
-        'ring3': control3,
-        'saw1': control1,
-        'saw2': control2,
-        'saw3': control3,
-        'sus1': lambda row: sid.resid.sustain_release(Voice.ONE, nib2byte(row.sus1, row.rel1)),
-        'sus2': lambda row: sid.resid.sustain_release(Voice.TWO, nib2byte(row.sus2, row.rel2)),
-        'sus3': lambda row: sid.resid.sustain_release(Voice.THREE, nib2byte(row.sus3, row.rel3)),
-        'sync1': control1,
-        'sync2': control2,
-        'sync3': control3,
-        'test1': control1,
-        'test2': control2,
-        'test3': control3,
-        'tri1': control1,
-        'tri2': control2,
-        'tri3': control3,
-        'vol': main,
-    }
-
-    sid.resid.reset()
-    sid.add_samples(sid.clock_freq)
-    df = orig_df.copy()
-    for col in funcs:
-        if col not in df:
-            df[col] = 0
-    df = df.fillna(0).astype(pd.Int64Dtype())
-    df['clock'] = df.index
-    if maxclock is not None:
-        df = df[df['clock'] <= maxclock]
-
-    raw_samples = []
-
-    diff_cols = {}
-    diffs = ['diff_clock']
-    cols = ['clock']
-    for col in df.columns:
-        diff_col = 'diff_%s' % col
-        if col in funcs:
-            diff_cols[diff_col] = col
-            diffs.append(diff_col)
-            cols.append(col)
-    diff_df = df[cols].diff().astype(pd.Int32Dtype())
-    diff_df.columns = diffs
-    diff_df['diff_funcs'] = np.empty((len(df), 0)).tolist()
-    df = df.join(diff_df)
-    drop_diff_cols = []
-    for diff_col, col in diff_cols.items():
-        diff_max = df[diff_col].abs().max()
-        if pd.isna(diff_max) or diff_max == 0:
-            drop_diff_cols.append(diff_col)
-    for diff_col in drop_diff_cols:
-        del diff_cols[diff_col]
-
-    for diff_col, col in diff_cols.items():
-        mask = (df[diff_col] != 0)
-        func = funcs[col]
-        df.loc[mask, 'diff_funcs'] = df.loc[mask, 'diff_funcs'].apply(lambda row: row + [func])
-
-    diffs.remove('diff_clock')
-    df['diff_clock'] = df['diff_clock'].fillna(0)
-    dtypes = {'diff_clock': np.uint32, 'diff_funcs': object}
-    for col in funcs:
-        if col.startswith('freq') or col.startswith('pwduty') or col == 'fltcoff':
-            dtypes[col] = np.uint16
-            continue
-        dtypes[col] = np.uint8
-    df = df.drop(diffs, axis=1).astype(dtypes)
 
-    row = df.iloc[0]
-    for f in funcs.values():
-        f(row)
-    in_test = row.test1
-    df = df[1:]
+def regs2writes(regs, clocks):
+    diff_clocks = np.diff(clocks)
+    write_rows, write_regs = np.nonzero(regs[1:] != regs[:-1])
+    write_vals = regs[1:][write_rows, write_regs]
+    write_starts = np.searchsorted(write_rows, np.arange(len(diff_clocks) + 1))
+    return (diff_clocks, write_starts, write_regs, write_vals)
+
+
+# Compile state into a stream of register writes: for each state after the first, clocks
+# since the previous state and the writes for only the registers that changed
+# (as (register, value) pairs starting at write_starts).
+def state2writes(df):
+    regs = state2regs(df)
+    return (regs,) + regs2writes(regs, df.index.to_numpy(dtype=np.int64))
+
 
-    if skiptest and in_test and not df.empty:
-        for i, row in enumerate(df.itertuples(), start=1):
-            sid.add_samples(row.diff_clock)
-            for func in row.diff_funcs:
-                func(row)
-            if not row.test1:
-                break
-        df = df[i:]
+# Grows by doubling, if the initial size estimate was too small.
+class SampleBuffer:
 
-    for row in df.itertuples():
-        raw_samples.extend(sid.add_samples(row.diff_clock))
-        for func in row.diff_funcs:
-            func(row)
+    def __init__(self, size):
+        self.buf = np.empty(max(size, 1), dtype=np.int16)
+        self.size = 0
 
-    if not raw_samples:
-        raw_samples.extend(sid.add_samples(sid.clockq))
+    def __len__(self):
+        return self.size
 
-    return np.array(raw_samples, dtype=np.int16)
+    def extend(self, samples):
+        end = self.size + len(samples)
+        if end > len(self.buf):
+            buf = np.empty(max(end, len(self.buf) * 2), dtype=np.int16)
+            buf[:self.size] = self.buf[:self.size]
+            self.buf = buf
+        self.buf[self.size:end] = samples
+        self.size = end
+
+    def samples(self):
+        return self.buf[:self.size]
+
+
+def test1_regs(regs):
+    return regs[:, WritableRegister.Voice1_Control_Reg.value] & ControlBits.TEST.value
+
+
+# Render consecutive state dataframes, continuing SID state between them, yielding
+# samples each window_clocks of state (or for each state dataframe, if no window).
+def states2sample_chunks(dfs, sid, skiptest=False, maxclock=None, window_clocks=None):
+    start_time = time.time()
+    registers = list(WritableRegister)
+    write_register = None
+    add_samples = sid.add_samples
+    last_regs = None
+    last_clock = None
+    window_end = None
+    skipping = False
+    raw_samples = None
+    rendered_samples = 0
+    rendered_clocks = 0
+
+    for df in dfs:
+        if maxclock is not None:
+            df = df[df.index <= maxclock]
+        if df.empty:
+            continue
+        regs = state2regs(df)
+        clocks = df.index.to_numpy(dtype=np.int64)
+        if last_regs is None:
+            sid.reset()
+            write_register = sid.resid.write_register
+            add_samples(sid.clock_freq)
+            for reg, val in enumerate(regs[0].tolist()):
+                write_register(registers[reg], val)
+            # if the SSF starts in test, skip samples up to and including the first state without test.
+            skipping = skiptest and test1_regs(regs)[0]
+            if window_clocks:
+                window_end = clocks[0] + window_clocks
+        else:
+            regs = np.concatenate((last_regs, regs))
+            clocks = np.concatenate(([last_clock], clocks))
+        last_regs = regs[-1:]
+        last_clock = clocks[-1]
+
+        diff_clocks, write_starts, write_regs, write_vals = regs2writes(regs, clocks)
+        skip_states = 0
+        if skipping:
+            not_test = np.flatnonzero(test1_regs(regs[1:]) == 0)
+            if len(not_test):
+                skip_states = not_test[0] + 1
+                skipping = False
+            else:
+                skip_states = len(diff_clocks)
+        rendered_clocks += int(diff_clocks.sum())
+
+        state_clocks = clocks[1:]
+        diff_clocks = diff_clocks.tolist()
+        write_regs = [registers[reg] for reg in write_regs.tolist()]
+        write_vals = write_vals.tolist()
+        write_starts = write_starts.tolist()
+        i = 0
+        while i < len(diff_clocks):
+            j = len(diff_clocks)
+            if window_end is not None:
+                j = int(np.searchsorted(state_clocks, window_end))
+            if raw_samples is None:
+                # add_samples() may return one more sample per call than the clock span suggests.
+                render_clocks = sum(diff_clocks[max(i, skip_states):j])
+                raw_samples = SampleBuffer(int(render_clocks / sid.clock_freq * sid.resid.sampling_frequency) + j - i)
+            for k in range(i, j):
+                samples = add_samples(diff_clocks[k])
+                if k >= skip_states:
+                    raw_samples.extend(samples)
+                for w in range(write_starts[k], write_starts[k + 1]):
+                    write_register(write_regs[w], write_vals[w])
+            if j < len(diff_clocks):
+                window_end += ((state_clocks[j] - window_end) // window_clocks + 1) * window_clocks
+                if raw_samples:
+                    rendered_samples += len(raw_samples)
+                    yield raw_samples.samples()
+                raw_samples = None
+            i = j
+        if window_end is None and raw_samples:
+            rendered_samples += len(raw_samples)
+            yield raw_samples.samples()
+            raw_samples = None
+
+    if raw_samples:
+        rendered_samples += len(raw_samples)
+        yield raw_samples.samples()
+    if last_regs is not None and not rendered_samples:
+        yield np.array(add_samples(sid.clockq), dtype=np.int16)
+
+    elapsed = time.time() - start_time
+    if elapsed:
+        emulated = sid.clock_to_s(rendered_clocks)
+        logging.debug('rendered %.1fs in %.1fs (%.1f emulated seconds per second)', emulated, elapsed, emulated / elapsed)
+
+
+def state2samples(orig_df, sid, skiptest=False, maxclock=None):
+    sample_chunks = list(states2sample_chunks([orig_df], sid, skiptest=skiptest, maxclock=maxclock))
+    if len(sample_chunks) == 1:
+        return sample_chunks[0]
+    return np.concatenate(sample_chunks + [np.empty(0, dtype=np.int16)])
 
 
 def write_wav(wav_file_name, sid, raw_samples):
     wavfile.write(wav_file_name, int(sid.resid.sampling_frequency), raw_samples)
 
 
+# Write samples to a WAV file as they are rendered, so they need not all be in memory.
+def write_wav_stream(wav_file_name, sid, sample_chunks):
+    with wave.Wave_write(wav_file_name) as wav:
+        wav.setnchannels(1)
+        wav.setsampwidth(2)
+        wav.setframerate(int(sid.resid.sampling_frequency))
+        for samples in sample_chunks:
+            wav.writeframes(samples.astype('<i2', copy=False).tobytes())
+
+
 def df2wav(df, sid, wav_file_name, skiptest=False):
     write_wav(wav_file_name, sid, state2samples(df, sid, skiptest=skiptest))
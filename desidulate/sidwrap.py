@@ -7,11 +7,34 @@
 ## THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABL E FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
 
 import logging
+import threading
+from collections import defaultdict
+from contextlib import contextmanager
 from datetime import timedelta
+from functools import lru_cache
+import numpy as np
 from pyresidfp import SoundInterfaceDevice
 from pyresidfp.sound_interface_device import ChipModel
 
 SID_SAMPLE_FREQ = 11025
+A = 440
+MIDI_N_TO_F = {n: (A / 32) * (2 ** ((n - 9) / 12)) for n in range(128)}
+SID_FREQS = 2 ** 16
+
+
+# For all frequency register values, the real frequency and the closest MIDI note.
+@lru_cache
+def freq_note_table(freq_scaler):
+    real_freqs = np.arange(SID_FREQS) * freq_scaler
+    midi_freqs = np.array(list(MIDI_N_TO_F.values()))
+    hi = np.searchsorted(midi_freqs, real_freqs).clip(1, len(midi_freqs) - 1)
+    lo = hi - 1
+    # prefer the lower note when equally close.
+    closest_notes = np.where(
+        np.abs(midi_freqs[hi] - real_freqs) < np.abs(midi_freqs[lo] - real_freqs), hi, lo).astype(np.uint8)
+    real_freqs.setflags(write=False)
+    closest_notes.setflags(write=False)
+    return (real_freqs, closest_notes)
 
 
 class SidWrap:
@@ -55,6 +78,7 @@ class SidWrap:
     }
 
     def __init__(self, pal, cia, model, sampling_frequency):
+        self.args = (pal, cia, model, sampling_frequency)
         # https://codebase64.org/doku.php?id=magazines:chacking17
         # https://codebase64.org/doku.php?id=base:making_stable_raster_routines
         if pal:
@@ -81,14 +105,25 @@ class SidWrap:
         logging.info('one sample lasts %u cycles (one sample lasts %fus)', self.one_sample_cycles, us_per_sample)
 
         logging.info('using PR frequency %f Hz (%u cycles)', self.int_freq, self.clockq)
-        self.resid = SoundInterfaceDevice(
-            model=model, clock_frequency=self.clock_freq,
-            sampling_frequency=sampling_frequency)
+        self.resid = None
+        self.reset()
         self.attack_clock = {
             k: int(v / 1e3 * self.clock_freq) for k, v in self.ATTACK_MS.items()}
         self.decay_release_clock = {
             k: int(v / 1e3 * self.clock_freq) for k, v in self.DECAY_RELEASE_MS.items()}
 
+    def reset(self):
+        # reSID's reset() does not reset all emulation state (e.g. oscillator phase, so rendering would
+        # depend on what was previously rendered), and costs about as much as a new instance anyway.
+        _pal, _cia, model, sampling_frequency = self.args
+        self.resid = SoundInterfaceDevice(
+            model=model, clock_frequency=self.clock_freq,
+            sampling_frequency=sampling_frequency)
+
+    def __reduce__(self):
+        # reSID state is not picklable, so a copy starts with a new SID.
+        return (self.__class__, self.args)
+
     def qn_to_clock(self, qn, bpm):
         return self.clock_freq * 60 / bpm * qn
 
@@ -105,6 +140,9 @@ class SidWrap:
         # http://www.sidmusic.org/sid/sidtech2.html
         return freq_reg * self.freq_scaler
 
+    def freq_notes(self):
+        return freq_note_table(self.freq_scaler)
+
     def add_samples(self, offset):
         timeoffset_seconds = offset / self.clock_freq
         return self.resid.clock(timedelta(seconds=timeoffset_seconds))
@@ -112,3 +150,34 @@ class SidWrap:
 
 def get_sid(pal, cia, model=ChipModel.MOS8580, sampling_frequency=SID_SAMPLE_FREQ):
     return SidWrap(pal, cia, model, sampling_frequency)
+
+
+# Per process pool of idle SIDs, by SidWrap args.
+SID_POOL = defaultdict(list)
+SID_POOL_LOCK = threading.Lock()
+
+
+# Return a SID from the pool, or a new one if none are idle. A pooled SID is not reset here,
+# as rendering (see states2sample_chunks()) resets it anyway before writing any registers.
+def acquire_sid(pal, cia, model=ChipModel.MOS8580, sampling_frequency=SID_SAMPLE_FREQ):
+    args = (pal, cia, model, sampling_frequency)
+    with SID_POOL_LOCK:
+        idle = SID_POOL[args]
+        sid = idle.pop() if idle else None
+    if sid is None:
+        return SidWrap(*args)
+    return sid
+
+
+def release_sid(sid):
+    with SID_POOL_LOCK:
+        SID_POOL[sid.args].append(sid)
+
+
+@contextmanager
+def pooled_sid(pal, cia, model=ChipModel.MOS8580, sampling_frequency=SID_SAMPLE_FREQ):
+    sid = acquire_sid(pal, cia, model=model, sampling_frequency=sampling_frequency)
+    try:
+        yield sid
+    finally:
+        release_sid(sid)
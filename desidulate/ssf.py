@@ -10,33 +10,56 @@
 # http://www.ucapps.de/howto_sid_wavetables_1.html
 
 import logging
+from collections.abc import Mapping
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache
+import numpy as np
 import pandas as pd
-from desidulate.fileio import out_path, read_csv
-from desidulate.sidlib import set_sid_dtype, control_labels
-from desidulate.sidmidi import closest_midi, MEMBRANE_DRUM_MAP, CYMBAL_DRUMS
-from desidulate.sidwav import state2samples, samples_loudestf, readwav
+from desidulate.fileio import df_ext, out_path, read_df, read_df_hashids
+from desidulate.sidlib import set_sid_dtype, ssf_control_labels
+from desidulate.sidmidi import MEMBRANE_DRUM_MAP, CYMBAL_DRUMS
+from desidulate.rendercache import cached_state2samples
+from desidulate.sidwav import samples_loudestf, samples_loudestf_batch, readwav
 
 INITIAL_FRAMES = 4
 
 
 def add_freq_notes_df(sid, ssfs_df):
-    real_freqs = {
-        freq: freq * sid.freq_scaler for freq in ssfs_df['freq1'].unique() if pd.notna(freq)}
-    closest_notes = {
-        real_freq: closest_midi(real_freq)[1] for real_freq in real_freqs.values()}
-    freq_map = [
-        (freq, real_freq, closest_notes[real_freq]) for freq, real_freq in real_freqs.items()]
-    freq_map.extend([(pd.NA, pd.NA, pd.NA)])
-    freq_notes_df = pd.DataFrame.from_records(
-        freq_map, columns=['freq1', 'real_freq', 'closest_note']).astype(pd.Float64Dtype())
-    freq_notes_df['freq1'] = freq_notes_df['freq1'].astype(pd.UInt16Dtype())
-    freq_notes_df['closest_note'] = freq_notes_df['closest_note'].astype(pd.UInt8Dtype())
-    return set_sid_dtype(ssfs_df).merge(freq_notes_df, how='left', on='freq1')
+    ssfs_df = set_sid_dtype(ssfs_df).reset_index(drop=True)
+    real_freqs, closest_notes = sid.freq_notes()
+    freq_na = ssfs_df['freq1'].isna().to_numpy()
+    freqs = ssfs_df['freq1'].fillna(0).to_numpy(dtype=np.int64)
+    ssfs_df['real_freq'] = pd.arrays.FloatingArray(real_freqs[freqs], freq_na.copy())
+    ssfs_df['closest_note'] = pd.arrays.IntegerArray(closest_notes[freqs], freq_na.copy())
+    return ssfs_df
+
+
+# Returns (sample rate, samples) to analyze an SSF: initial samples from a WAV file if present, otherwise rendered.
+def ssf_samples(sid, df, smf, wav_file=None, initial_frames=INITIAL_FRAMES, render_cache=None):
+    if wav_file is not None:
+        rate, samples = readwav(wav_file)
+        max_samples = int(sid.clock_to_s(sid.clockq * (initial_frames + 1)) * rate)
+        return (rate, samples[:max_samples])
+    return (sid.resid.sampling_frequency, cached_state2samples(
+        render_cache, df.drop(['control_labels', 'control_label'], axis=1), sid, skiptest=True, maxclock=smf.one_2n_clocks))
+
+
+# Loudest frequency of each of many SSFs' (sample rate, samples).
+def ssf_loudestfs(rate_samples):
+    loudestfs = [0] * len(rate_samples)
+    rates = {}
+    for i, (rate, samples) in enumerate(rate_samples):
+        if len(samples):
+            rates.setdefault(rate, []).append(i)
+    for rate, indexes in rates.items():
+        for i, loudestf in zip(indexes, samples_loudestf_batch([rate_samples[i][1] for i in indexes], rate)):
+            loudestfs[i] = loudestf
+    return loudestfs
 
 
 class SidSoundFragment:
 
-    def __init__(self, percussion, sid, df, smf, wav_file=None, initial_frames=INITIAL_FRAMES):
+    def __init__(self, percussion, sid, df, smf, wav_file=None, initial_frames=INITIAL_FRAMES, render_cache=None, rate_samples=None, loudestf=None, midi_notes=None):
         self.df = df
         self.initial_clocks = sid.clockq * (initial_frames + 1)
         self.percussion = percussion
@@ -45,7 +68,9 @@ class SidSoundFragment:
         self.noisephases = len([waveforms for waveforms in self.waveform_order if 'n' in waveforms])
         self.pulsephases = len([waveforms for waveforms in self.waveform_order if 'p' in waveforms])
         self.all_noise = self.waveforms == {'n'}
-        self.midi_notes = tuple(smf.get_midi_notes_from_events(self.df.itertuples()))
+        if midi_notes is None:
+            midi_notes = smf.get_midi_notes_from_df(self.df)
+        self.midi_notes = tuple(midi_notes)
         self.midi_pitches = tuple([midi_note[1] for midi_note in self.midi_notes])
         self.total_duration = 0
         self.max_midi_note = 0
@@ -77,15 +102,13 @@ class SidSoundFragment:
         self.one_4n_clocks = smf.one_4n_clocks
         self.one_8n_clocks = smf.one_8n_clocks
         self.one_16n_clocks = smf.one_16n_clocks
-        if wav_file is not None:
-            rate, samples = readwav(wav_file)
-            max_samples = int(sid.clock_to_s(self.initial_clocks) * rate)
-            self.samples = samples[:max_samples]
-        else:
-            rate = sid.resid.sampling_frequency
-            self.samples = state2samples(self.df.drop(['control_labels', 'control_label'], axis=1), sid, skiptest=True, maxclock=self.one_2n_clocks)
+        if rate_samples is None:
+            rate_samples = ssf_samples(sid, df, smf, wav_file=wav_file, initial_frames=initial_frames, render_cache=render_cache)
+        rate, self.samples = rate_samples
         if len(self.samples):
-            self.loudestf = samples_loudestf(self.samples, rate)
+            if loudestf is None:
+                loudestf = samples_loudestf(self.samples, rate)
+            self.loudestf = loudestf
             self._set_pitches(sid)
             if self.drum_pitches:
                 self.drum_instrument = self.drum_pitches[0][2]
@@ -154,6 +177,107 @@ class SidSoundFragment:
         return base_instrument
 
 
+# Parse (hashid, df, wav_file) SSFs, rendering all their samples and then finding their loudest frequencies and notes together.
+def parse_ssfs(percussion, sid, smf, ssf_dfs, render_cache=None):
+    rate_samples = [
+        ssf_samples(sid, ssf_df, smf, wav_file=wav_file, render_cache=render_cache) for _, ssf_df, wav_file in ssf_dfs]
+    loudestfs = ssf_loudestfs(rate_samples)
+    midi_notes = smf.get_midi_notes_from_dfs([ssf_df for _, ssf_df, _ in ssf_dfs])
+    return [
+        (hashid, SidSoundFragment(
+            percussion, sid, ssf_df, smf, rate_samples=ssf_rate_samples, loudestf=loudestf, midi_notes=ssf_midi_notes))
+        for (hashid, ssf_df, _), ssf_rate_samples, loudestf, ssf_midi_notes in zip(ssf_dfs, rate_samples, loudestfs, midi_notes)]
+
+
+PARSE_SSFS_ARGS = {}
+
+
+def init_parse_ssfs(percussion, sid, smf, render_cache):
+    PARSE_SSFS_ARGS.update({'percussion': percussion, 'sid': sid, 'smf': smf, 'render_cache': render_cache})
+
+
+# Returns parsed SSFs, and render cache (hits, misses) while parsing them.
+def parse_ssfs_worker(ssf_dfs):
+    render_cache = PARSE_SSFS_ARGS['render_cache']
+    if render_cache is not None:
+        render_cache.hits = 0
+        render_cache.misses = 0
+    parsed = parse_ssfs(ssf_dfs=ssf_dfs, **PARSE_SSFS_ARGS)
+    if render_cache is not None:
+        return (parsed, render_cache.hits, render_cache.misses)
+    return (parsed, 0, 0)
+
+
+# Most SSFs parsed in one chunk (so most SSFs' samples in memory at once, per process).
+MAX_PARSE_CHUNK_SSFS = 64
+
+
+# Parse (hashid, df, wav_file) SSFs in chunks, in order, in a pool of workers if more than one.
+def parse_ssfs_chunks(
+        percussion, sid, smf, ssf_dfs, render_cache=None, workers=1, chunks_per_worker=4, max_chunk_ssfs=MAX_PARSE_CHUNK_SSFS):
+    chunksize = max(1, min(max_chunk_ssfs, -(-len(ssf_dfs) // (max(1, workers) * chunks_per_worker))))
+    chunks = [ssf_dfs[i:i + chunksize] for i in range(0, len(ssf_dfs), chunksize)]
+    if workers <= 1:
+        for chunk in chunks:
+            yield from parse_ssfs(percussion, sid, smf, chunk, render_cache=render_cache)
+        return
+    with ProcessPoolExecutor(
+            max_workers=workers, initializer=init_parse_ssfs,
+            initargs=(percussion, sid, smf, render_cache)) as pool:
+        for parsed, hits, misses in pool.map(parse_ssfs_worker, chunks):
+            if render_cache is not None:
+                render_cache.hits += hits
+                render_cache.misses += misses
+            yield from parsed
+
+
+# SSF dataframes by hashid, kept as one table sorted by hashid with each SSF's first row and rows.
+# An SSF's dataframe (with control labels, indexed by clock, with NAs filled forward) is made when
+# looked up, and then kept in an LRU of up to maxsize SSFs (None for no limit).
+SSF_CACHE_SIZE = 256
+
+
+class SsfDfs(Mapping):
+
+    def __init__(self, ssfs_df, maxsize=SSF_CACHE_SIZE):
+        self.ssfs_df = ssfs_df.sort_values('hashid', kind='stable').reset_index(drop=True)
+        ssf_hashids = self.ssfs_df['hashid'].to_numpy(dtype=np.int64)
+        hashids, starts, rows = np.unique(ssf_hashids, return_index=True, return_counts=True)
+        # SSFs where every state sets the volume are skipped.
+        playable = np.isin(hashids, ssf_hashids[self.ssfs_df['vol'].isna().to_numpy()])
+        self.hashids, self.starts, self.rows = hashids[playable], starts[playable], rows[playable]
+        self.ssf_df = lru_cache(maxsize=maxsize)(self._ssf_df)
+
+    def _ssf_df(self, i):
+        start = self.starts[i]
+        # control labels are of all an SSF's states, including those that set the volume.
+        ssf_df = ssf_control_labels(self.ssfs_df.iloc[start:start + self.rows[i]])
+        # TODO: handle vol/samples
+        ssf_df = ssf_df[ssf_df['vol'].isna()].assign(vol=15)
+        return ssf_df.set_index('clock').ffill()
+
+    def _find(self, hashid):
+        i = int(np.searchsorted(self.hashids, hashid))
+        if i < len(self.hashids) and self.hashids[i] == hashid:
+            return i
+        return None
+
+    def __contains__(self, hashid):
+        return self._find(hashid) is not None
+
+    def __getitem__(self, hashid):
+        i = self._find(hashid)
+        if i is None:
+            raise KeyError(hashid)
+        return self.ssf_df(i)
+
+    def __iter__(self):
+        return iter(self.hashids.tolist())
+
+    def __len__(self):
+        return len(self.hashids)
+
+
 class SidSoundFragmentParser:
 
     def __init__(self, logfile, percussion, sid):
@@ -162,11 +286,12 @@ class SidSoundFragmentParser:
         self.sid = sid
         self.ssf_dfs = {}
 
-    def read_ssfs(self):
-        ssfs_df = add_freq_notes_df(self.sid, read_csv(out_path(self.logfile, 'ssf.zst'), dtype=pd.Int64Dtype()))
-        # TODO: handle vol/samples
-        ssfs_df = control_labels(ssfs_df)
-        ssfs_df = ssfs_df[ssfs_df['vol'].isna()]
-        ssfs_df['vol'] = 15
-        self.ssf_dfs = {hashid: ssf_df.set_index('clock').fillna(method='ffill') for hashid, ssf_df in ssfs_df.groupby('hashid')}
+    # Read all SSFs, or only the given hashids, keeping up to cache_size SSF dataframes once looked up.
+    def read_ssfs(self, hashids=None, cache_size=SSF_CACHE_SIZE):
+        ssf_file = out_path(self.logfile, '.'.join(('ssf', df_ext(self.logfile))))
+        if hashids is None:
+            ssfs_df = read_df(ssf_file)
+        else:
+            ssfs_df = read_df_hashids(ssf_file, hashids)
+        self.ssf_dfs = SsfDfs(add_freq_notes_df(self.sid, ssfs_df), maxsize=cache_size)
         logging.info('read %u patches', len(self.ssf_dfs))
@@ -14,10 +14,11 @@ import logging
 import os
 import sys
 import pandas as pd
-from desidulate.fileio import midi_path, out_path, read_csv
+from desidulate.fileio import midi_path, out_path, read_df_clocks
+from desidulate.rendercache import render_cache_args, get_render_cache
 from desidulate.sidmidi import SidMidiFile, midi_args
 from desidulate.sidwrap import get_sid
-from desidulate.ssf import SidSoundFragment, SidSoundFragmentParser
+from desidulate.ssf import SidSoundFragmentParser, parse_ssfs_chunks
 
 
 def main():
@@ -29,11 +30,13 @@ def main():
     parser.add_argument('--minclock', default=0, type=int, help='Min clock value')
     parser.add_argument('--maxclock', default=0, type=int, help='Max clock value')
     parser.add_argument('--voicemask', default=','.join([str(v) for v in ALL_VOICES]), type=str, help='Voice mask')
+    parser.add_argument('--workers', default=1, type=int, help='workers to use when parsing SSFs')
     midi_args(parser)
+    render_cache_args(parser)
     args = parser.parse_args()
     voicemask = frozenset([int(v) for v in args.voicemask.split(',')])
 
-    ssf_log_df = read_csv(args.ssflogfile, dtype=pd.Int64Dtype())
+    ssf_log_df = read_df_clocks(args.ssflogfile, min_clock=args.minclock, max_clock=args.maxclock)
     cols = set(ssf_log_df.columns)
 
     if len(ssf_log_df) == 0:
@@ -44,10 +47,7 @@ def main():
         print('not an SSF log file (cols %s)' % cols)
         sys.exit(1)
 
-    if args.maxclock:
-        ssf_log_df = ssf_log_df[ssf_log_df['clock'] <= args.maxclock]  # pylint: disable=unsubscriptable-object
     if args.minclock:
-        ssf_log_df = ssf_log_df[ssf_log_df['clock'] >= args.minclock]  # pylint: disable=unsubscriptable-object
         min_clock = ssf_log_df['clock'].min()
         ssf_log_df['clock'] -= min_clock
 
@@ -67,27 +67,41 @@ def main():
     sid = get_sid(args.pal, args.cia)
     smf = SidMidiFile(sid, args.bpm)
     parser = SidSoundFragmentParser(args.ssflogfile, args.percussion, sid)
-    parser.read_ssfs()
+    # only the SSFs played in the clock window.
+    parser.read_ssfs(hashids=ssf_log_df['hashid'].unique())
+    render_cache = get_render_cache(args)
+
+    # SSFs are parsed as first played, to the duration of that first play.
+    ssf_dfs = []
+    first_played = set()
+    for row in ssf_log_df.itertuples():
+        if row.hashid not in parser.ssf_dfs or row.hashid in first_played:
+            continue
+        first_played.add(row.hashid)
+        ssf_df = parser.ssf_dfs[row.hashid]
+        duration = row.duration
+        if pd.notna(duration):
+            ssf_df.rename(index={ssf_df.index[-1]: duration}, inplace=True)
+        wav_file = out_path(args.ssflogfile, '%d.wav' % row.hashid)
+        if not os.path.exists(wav_file):
+            wav_file = None
+        ssf_dfs.append((row.hashid, ssf_df, wav_file))
 
     ssf_cache = {}
     ssf_instruments = []
+    for hashid, ssf in parse_ssfs_chunks(
+            args.percussion, sid, smf, ssf_dfs, render_cache=render_cache, workers=args.workers):
+        ssf_cache[hashid] = ssf
+        ssf_instruments.append(ssf.instrument({'hashid': hashid}))
+        logging.info('parsed ssf %d (%u of %u)', hashid, len(ssf_cache), len(parser.ssf_dfs))
+
     for row in ssf_log_df.itertuples():
-        if row.hashid not in parser.ssf_dfs:
-            continue
         ssf = ssf_cache.get(row.hashid, None)
-        if ssf is None:
-            ssf_df = parser.ssf_dfs[row.hashid]
-            wav_file = out_path(args.ssflogfile, '%d.wav' % row.hashid)
-            if not os.path.exists(wav_file):
-                wav_file = None
-            duration = row.duration
-            if pd.notna(duration):
-                ssf_df.rename(index={ssf_df.index[-1]: duration}, inplace=True)
-            ssf = SidSoundFragment(args.percussion, sid, ssf_df, smf, wav_file=wav_file)
-            ssf_cache[row.hashid] = ssf
-            ssf_instruments.append(ssf.instrument({'hashid': row.hashid}))
-            logging.info('parsed ssf %d (%u of %u)', row.hashid, len(ssf_cache), len(parser.ssf_dfs))
-        ssf.smf_transcribe(smf, row.clock, row.voice, row.duration)
+        if ssf is not None:
+            ssf.smf_transcribe(smf, row.clock, row.voice, row.duration)
+
+    if render_cache is not None:
+        logging.info('render cache hits %u, misses %u', render_cache.hits, render_cache.misses)
 
     ssf_instrument_file = out_path(args.ssflogfile, 'inst.txt.zst')
     ssf_instrument_df = pd.DataFrame(ssf_instruments)
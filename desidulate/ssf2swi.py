@@ -2,6 +2,7 @@
 
 import argparse
 import pandas as pd
+from desidulate.fileio import read_df_hashids
 from desidulate.sidlib import CONTROL_BITS, timer_args
 from desidulate.sidwrap import get_sid
 from desidulate.ssf import add_freq_notes_df
@@ -64,8 +65,8 @@ def filter_from_row(row):
 
 
 def main():
-    df = pd.read_csv(args.ssffile, dtype=pd.Int64Dtype())
-    ssf_df = df[df.hashid == args.hashid].drop(['hashid_noclock', 'count', 'rate', 'vol', 'hashid', 'fltext'], axis=1).reset_index(drop=True)
+    df = read_df_hashids(args.ssffile, [args.hashid])
+    ssf_df = df.drop(['hashid_noclock', 'count', 'rate', 'vol', 'hashid', 'fltext'], axis=1).reset_index(drop=True)
     atk1, dec1, sus1, rel1, pr_speed, test1_initial = ssf_df[['atk1', 'dec1', 'sus1', 'rel1', 'pr_speed', 'test1']].iloc[0]
     ssf_df = ssf_df.drop(['atk1', 'dec1', 'sus1', 'rel1', 'pr_speed'], axis=1)
 
@@ -10,13 +10,16 @@ import argparse
 import logging
 import os
 import sys
-from concurrent.futures import ProcessPoolExecutor
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
 import numpy as np
-import pandas as pd
-from desidulate.fileio import wav_path, out_path, read_csv
-from desidulate.sidwav import df2wav
-from desidulate.sidwrap import get_sid
+from desidulate.fileio import out_path, read_df, read_df_hashids, write_mmap_df, read_mmap_df
+from desidulate.rendercache import render_cache_args, get_render_cache, cached_state2samples
+from desidulate.sidwav import write_wav
+from desidulate.sidwrap import get_sid, pooled_sid
 from desidulate.sidmidi import SidMidiFile, midi_args
+from desidulate.sidlib import control_labels
 from desidulate.ssf import add_freq_notes_df, SidSoundFragment
 
 
@@ -25,23 +28,99 @@ class RenderWav:
     def __init__(self, smf, args):
         self.smf = smf
         self.args = args
+        self.render_cache = get_render_cache(args)
 
     def render(self, ssf_df, wavfile):
         ssf_df = ssf_df.set_index('clock')
         ssf_df = ssf_df.fillna(method='ffill')
-        sid = get_sid(self.args.pal, self.args.cia)
-        df2wav(ssf_df, sid, wavfile, skiptest=self.args.skiptest)
-        logging.info(ssf_df.to_string())
-        if self.args.play:
-            os.system(' '.join(['play', wavfile]))
-        if self.args.skip_ssf_parser:
-            return
-        ssf = SidSoundFragment(self.args.percussion, sid, ssf_df, self.smf)
-        logging.info(ssf.instrument({}))
-
-
-def render_wav(ssf_df, wavfile):
-    rw.render(ssf_df, wavfile)
+        with pooled_sid(self.args.pal, self.args.cia) as sid:
+            samples_df = ssf_df.drop(['control_labels', 'control_label'], axis=1, errors='ignore')
+            write_wav(wavfile, sid, cached_state2samples(self.render_cache, samples_df, sid, skiptest=self.args.skiptest))
+            logging.info(ssf_df.to_string())
+            if self.args.play:
+                os.system(' '.join(['play', wavfile]))
+            if self.args.skip_ssf_parser:
+                return
+            ssf = SidSoundFragment(self.args.percussion, sid, ssf_df, self.smf, render_cache=self.render_cache)
+            logging.info(ssf.instrument({}))
+
+
+# SSFs per worker, per chunk, if SSFs were all the same size.
+CHUNKS_PER_WORKER = 8
+# Chunks submitted but not yet rendered, per worker.
+PENDING_PER_WORKER = 2
+
+RENDER_WAV = None
+SSF_TABLE = None
+
+
+def init_render_wav(smf, args, table_name):
+    global RENDER_WAV, SSF_TABLE
+    RENDER_WAV = RenderWav(smf, args)
+    SSF_TABLE = read_mmap_df(table_name)
+
+
+# Render (hashid, first row, rows) SSFs from the shared SSF table, returning failures.
+def render_wav_chunk(chunk):
+    failures = []
+    for hashid, start, rows in chunk:
+        wavfile = out_path(RENDER_WAV.args.ssffile, '%u.wav' % hashid)
+        try:
+            RENDER_WAV.render(SSF_TABLE.slice(start, rows).to_pandas(), wavfile)
+        except Exception as err:  # pylint: disable=broad-except
+            failures.append((hashid, repr(err)))
+    return failures
+
+
+# Group SSFs, largest first, into chunks of at least chunk_rows rows.
+def ssf_chunks(df, workers):
+    hashids, starts, rows = np.unique(df['hashid'].to_numpy(), return_index=True, return_counts=True)
+    chunk_rows = max(1, len(df) // (workers * CHUNKS_PER_WORKER))
+    chunk = []
+    chunk_size = 0
+    for i in np.argsort(-rows, kind='stable').tolist():
+        chunk.append((int(hashids[i]), int(starts[i]), int(rows[i])))
+        chunk_size += rows[i]
+        if chunk_size >= chunk_rows:
+            yield chunk
+            chunk = []
+            chunk_size = 0
+    if chunk:
+        yield chunk
+
+
+# Render all SSFs in workers, which share a memory mapped copy of the SSF table.
+def render_wavs(df, smf, args):
+    df = df.sort_values('hashid', kind='stable')
+    ssfs = df['hashid'].nunique()
+    rendered = 0
+    failures = []
+    start_time = time.time()
+
+    def collect(done):
+        nonlocal rendered
+        for future in done:
+            chunk = pending.pop(future)
+            try:
+                failures.extend(future.result())
+            except Exception as err:  # pylint: disable=broad-except
+                failures.extend([(hashid, repr(err)) for hashid, _, _ in chunk])
+            rendered += len(chunk)
+        elapsed = time.time() - start_time
+        logging.info('rendered %u/%u SSFs (%.1f SSFs per second)', rendered, ssfs, rendered / elapsed if elapsed else 0)
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        table_name = os.path.join(tmpdir, 'ssf.arrow')
+        write_mmap_df(df, table_name)
+        with ProcessPoolExecutor(
+                max_workers=args.workers, initializer=init_render_wav, initargs=(smf, args, table_name)) as pool:
+            pending = {}
+            for chunk in ssf_chunks(df, args.workers):
+                if len(pending) >= args.workers * PENDING_PER_WORKER:
+                    collect(wait(pending, return_when=FIRST_COMPLETED).done)
+                pending[pool.submit(render_wav_chunk, chunk)] = chunk
+            collect(wait(pending).done)
+    return failures
 
 
 def main():
@@ -61,9 +140,13 @@ def main():
     ssf_parser.add_argument('--skip-ssf-parser', dest='skip_ssf_parser', action='store_true', help='skip parsing of SSF')
     ssf_parser.add_argument('--no-skip-ssf-parser', dest='skip_ssf_parser', action='store_false', help='do not skip parsing of SSF')
     midi_args(parser)
+    render_cache_args(parser)
     args = parser.parse_args()
 
-    df = read_csv(args.ssffile, dtype=pd.Int64Dtype())
+    if args.hashid:
+        df = read_df_hashids(args.ssffile, [np.int64(args.hashid)])
+    else:
+        df = read_df(args.ssffile)
     if df.empty:
         print('empty SSF file')
         sys.exit(0)
@@ -75,22 +158,18 @@ def main():
     smf = None
 
     if not args.skip_ssf_parser:
-        df = add_freq_notes_df(sid, df)
+        df = control_labels(add_freq_notes_df(sid, df))
         smf = SidMidiFile(sid, args.bpm)
 
-    if args.hashid:
-        df = df[df['hashid'] == np.int64(args.hashid)].copy()
-
     # TODO: handle vol/samples.
     df = df[df['vol'].isna()]
     df['vol'] = 15
 
-    global rw
-    rw = RenderWav(smf, args)
-    with ProcessPoolExecutor(max_workers=args.workers) as pool:
-        for hashid, ssf_df in df.groupby('hashid'):
-            wavfile = out_path(args.ssffile, '%u.wav' % hashid)
-            pool.submit(render_wav, ssf_df.copy(), wavfile)
+    failures = render_wavs(df, smf, args)
+    for hashid, err in failures:
+        logging.error('failed to render %d: %s', hashid, err)
+    if failures:
+        sys.exit(1)
 
 
 if __name__ == '__main__':
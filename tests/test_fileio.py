@@ -0,0 +1,137 @@
+#!/usr/bin/python3
+
+import os
+import tempfile
+import unittest
+import numpy as np
+import pandas as pd
+from desidulate.fileio import (
+    read_df, write_df, df_ext, out_path, write_mmap_df, read_mmap_df, wide2long_df, long2wide_df,
+    write_indexed_df, read_df_hashids, read_df_clocks, read_df_index, df_index_path)
+
+
+class FileIOTestCase(unittest.TestCase):
+
+    def test_df_ext(self):
+        self.assertEqual('zst', df_ext('/tmp/x.log.zst'))
+        self.assertEqual('parquet', df_ext('/tmp/x.ssf.parquet'))
+        self.assertEqual('zst', df_ext('/tmp/x.dump'))
+        self.assertEqual('/tmp/x.log.parquet', out_path('/tmp/x.ssf.parquet', 'log.parquet'))
+
+    def test_write_read_df(self):
+        df = pd.DataFrame(
+            {'hashid': [-1, 2, 3], 'clock': [0, 100, 200], 'freq1': [None, 1000, 2000]},
+        ).astype({'clock': 'uint64', 'freq1': pd.UInt16Dtype()}).set_index('hashid')
+        with tempfile.TemporaryDirectory() as tmpdir:
+            for ext in ('zst', 'parquet'):
+                df_name = os.path.join(tmpdir, 'test.ssf.%s' % ext)
+                write_df(df, df_name)
+                read = read_df(df_name)
+                self.assertEqual(['hashid', 'clock', 'freq1'], list(read.columns))
+                self.assertEqual([-1, 2, 3], read['hashid'].tolist())
+                self.assertEqual([0, 100, 200], read['clock'].tolist())
+                self.assertTrue(pd.isna(read['freq1'].iat[0]))
+                self.assertEqual([1000, 2000], read['freq1'].iloc[1:].tolist())
+                read = read_df(df_name, columns=['hashid', 'freq1'])
+                self.assertEqual(['hashid', 'freq1'], list(read.columns))
+
+    def test_long_df(self):
+        df = pd.DataFrame({
+            'hashid': [2**62 + 1, 2**62 + 1, 2**62 + 1, 2**62 + 1, -5, -5],
+            'pr_speed': [1, 1, 1, 1, 2, 2],
+            'clock': [0, 100, 200, 300, 0, 50],
+            'freq1': [1000, None, 1000, 1000, None, 7],
+            'gate1': [1, 1, 0, 0, None, None],
+            'hashid_noclock': [-2**62, -2**62, -2**62, -2**62, 3, 3]},
+        ).astype(pd.Int64Dtype()).set_index('hashid')
+        long_df = wide2long_df(df)
+        # the row at clock 300 has no changes, so records pr_speed.
+        self.assertEqual(5 + 4 + 1 + 2 + 1 + 2 + 1, len(long_df))
+        self.assertTrue(df.reset_index().equals(long2wide_df(long_df)))
+        with tempfile.TemporaryDirectory() as tmpdir:
+            for ext in ('zst', 'parquet'):
+                df_name = os.path.join(tmpdir, 'test.ssf.%s' % ext)
+                write_df(long_df, df_name)
+                self.assertTrue(df.reset_index().equals(read_df(df_name)))
+                self.assertTrue(df.reset_index()[['hashid', 'freq1']].equals(read_df(df_name, columns=['hashid', 'freq1'])))
+
+    def test_indexed_df(self):
+        # enough SSFs for several frames.
+        hashids = np.repeat(np.arange(-500, 500, dtype=np.int64) * 2**40, 20)
+        df = pd.DataFrame({
+            'hashid': hashids,
+            'clock': np.tile(np.arange(20) * 100, 1000),
+            'freq1': np.tile([None, 1000, 2000, 2000] * 5, 1000)},
+        ).astype(pd.Int64Dtype()).set_index('hashid')
+        lookups = [hashids[0], hashids[-1], 3 * 2**40, 42, -7 * 2**40]
+        with tempfile.TemporaryDirectory() as tmpdir:
+            for ssf_df in (df, wide2long_df(df)):
+                df_name = os.path.join(tmpdir, 'test.ssf.zst')
+                write_indexed_df(ssf_df, df_name)
+                self.assertTrue(df.reset_index().equals(read_df(df_name)))
+                for lookup in lookups + [lookups]:
+                    read = read_df_hashids(df_name, np.atleast_1d(lookup))
+                    expected = df[df.index.isin(np.atleast_1d(lookup))].reset_index()
+                    self.assertTrue(expected.equals(read))
+                read = read_df_hashids(df_name, lookups, columns=['freq1'])
+                self.assertEqual(['freq1'], list(read.columns))
+                self.assertEqual(4 * 20, len(read))
+                # a missing or stale index reads the whole dataframe.
+                write_df(ssf_df, df_name)
+                self.assertEqual(4 * 20, len(read_df_hashids(df_name, lookups)))
+                os.remove(df_index_path(df_name))
+                self.assertEqual(4 * 20, len(read_df_hashids(df_name, lookups)))
+
+    def test_clock_indexed_df(self):
+        clocks = np.arange(50000, dtype=np.int64) * 1000
+        df = pd.DataFrame({
+            'clock': clocks,
+            'hashid': (clocks // 7000) * 2**40,
+            'voice': clocks % 3 + 1},
+        ).astype(pd.Int64Dtype()).set_index('clock')
+        with tempfile.TemporaryDirectory() as tmpdir:
+            for ext in ('zst', 'parquet'):
+                df_name = os.path.join(tmpdir, 'test.log.%s' % ext)
+                write_indexed_df(df, df_name)
+                self.assertTrue(df.reset_index().equals(read_df(df_name)))
+                self.assertTrue(df.reset_index().equals(read_df_clocks(df_name)))
+                for min_clock, max_clock in ((0, 0), (1500, 999999), (12345000, 12345000), (49000000, 0), (10**12, 0)):
+                    expected = df.loc[min_clock:max_clock if max_clock else None].reset_index()
+                    self.assertTrue(expected.equals(read_df_clocks(df_name, min_clock=min_clock, max_clock=max_clock)))
+                read = read_df_clocks(df_name, min_clock=1500, max_clock=999999, columns=['hashid'])
+                self.assertEqual(['hashid'], list(read.columns))
+            # a window reads only the frames it overlaps.
+            _, index = read_df_index(os.path.join(tmpdir, 'test.log.zst'), 'clock')
+            self.assertGreater(len(index), 1)
+            self.assertTrue(np.all(index['last'][:-1] < index['first'][1:]))
+            self.assertIsNone(read_df_index(os.path.join(tmpdir, 'test.log.zst'), 'hashid'))
+
+    def test_empty_indexed_df(self):
+        empty_log_df = pd.DataFrame(
+            {'clock': [0], 'hashid': [1], 'voice': [1]}).astype(pd.Int64Dtype()).set_index('clock').iloc[:0]
+        with tempfile.TemporaryDirectory() as tmpdir:
+            for ext in ('zst', 'parquet'):
+                # state2ssfs() returns dataframes without columns or index name, when there are no SSFs.
+                for df in (pd.DataFrame(), empty_log_df):
+                    df_name = os.path.join(tmpdir, 'test.log.%s' % ext)
+                    write_indexed_df(df, df_name)
+                    self.assertFalse(os.path.exists(df_index_path(df_name)))
+                    for read in (read_df(df_name), read_df_clocks(df_name), read_df_hashids(df_name, [1])):
+                        self.assertTrue(read.empty)
+                        if len(df.columns):
+                            self.assertEqual(['clock', 'hashid', 'voice'], list(read.columns))
+
+    def test_mmap_df(self):
+        df = pd.DataFrame(
+            {'hashid': [1, 1, 2], 'clock': [0, 100, 0], 'freq1': [None, 1000, 2000]},
+        ).astype({'hashid': pd.Int64Dtype(), 'clock': pd.Int64Dtype(), 'freq1': pd.UInt16Dtype()})
+        with tempfile.TemporaryDirectory() as tmpdir:
+            df_name = os.path.join(tmpdir, 'test.arrow')
+            write_mmap_df(df, df_name)
+            table = read_mmap_df(df_name)
+            self.assertTrue(df.equals(table.to_pandas()))
+            self.assertTrue(df.iloc[1:].reset_index(drop=True).equals(table.slice(1, 2).to_pandas()))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,73 @@
+#!/usr/bin/python3
+
+import os
+import tempfile
+import unittest
+import numpy as np
+import pandas as pd
+from desidulate.rendercache import RenderCache
+from desidulate.sidwav import state2samples
+from desidulate.sidwrap import get_sid
+
+
+class RenderCacheTestCase(unittest.TestCase):
+
+    @staticmethod
+    def _make_wav_df(rows):
+        return pd.DataFrame(rows, dtype=pd.UInt64Dtype()).set_index('clock').ffill().astype(pd.UInt64Dtype())
+
+    def test_state2samples(self):
+        df = self._make_wav_df([
+            {'clock': 0, 'freq1': 4000, 'sus1': 15, 'vol': 15, 'gate1': 1, 'test1': 1},
+            {'clock': 20000, 'test1': 0, 'tri1': 1},
+            {'clock': 50000, 'gate1': 0},
+            {'clock': 90000},
+        ])
+        sid = get_sid(pal=True, cia=0)
+        with tempfile.TemporaryDirectory() as tmpdir:
+            render_cache = RenderCache(tmpdir)
+            samples = render_cache.state2samples(df, sid, skiptest=True)
+            self.assertEqual((0, 1), (render_cache.hits, render_cache.misses))
+            self.assertTrue(np.array_equal(samples, state2samples(df, sid, skiptest=True)))
+            self.assertTrue(np.array_equal(samples, render_cache.state2samples(df, sid, skiptest=True)))
+            self.assertEqual((1, 1), (render_cache.hits, render_cache.misses))
+            key = render_cache.key(df, sid, skiptest=True)
+            self.assertEqual(key, render_cache.key(df, get_sid(pal=True, cia=0), skiptest=True))
+            self.assertEqual(key, render_cache.key(df, sid, skiptest=True, maxclock=90000))
+            self.assertNotEqual(key, render_cache.key(df, sid, skiptest=False))
+            self.assertNotEqual(key, render_cache.key(df, sid, skiptest=True, maxclock=50000))
+            self.assertNotEqual(key, render_cache.key(df, get_sid(pal=False, cia=0), skiptest=True))
+            changed_df = df.copy()
+            changed_df.loc[50000, 'freq1'] = 4001
+            self.assertNotEqual(key, render_cache.key(changed_df, sid, skiptest=True))
+
+    def test_evict(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            render_cache = RenderCache(tmpdir, max_bytes=10000)
+            samples = np.zeros(1000, dtype=np.int16)
+            for i in range(10):
+                render_cache.put(str(i), samples)
+                os.utime(os.path.join(tmpdir, '%u.npy' % i), (i, i))
+            self.assertLessEqual(render_cache.cache_bytes, 10000)
+            self.assertIsNone(render_cache.get('0'))
+            self.assertTrue(np.array_equal(samples, render_cache.get('9')))
+            self.assertEqual(render_cache.cache_bytes, RenderCache(tmpdir).cache_bytes)
+
+    def test_put_existing(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            render_cache = RenderCache(tmpdir, max_bytes=10000)
+            render_cache.put('0', np.zeros(1000, dtype=np.int16))
+            render_cache.put('0', np.zeros(1000, dtype=np.int16))
+            self.assertEqual(os.path.getsize(os.path.join(tmpdir, '0.npy')), render_cache.cache_bytes)
+            render_cache.put('0', np.zeros(500, dtype=np.int16))
+            self.assertEqual(os.path.getsize(os.path.join(tmpdir, '0.npy')), render_cache.cache_bytes)
+            self.assertEqual(render_cache.cache_bytes, RenderCache(tmpdir).cache_bytes)
+            # rewriting a key does not evict other renders.
+            render_cache.put('1', np.zeros(1000, dtype=np.int16))
+            for _ in range(10):
+                render_cache.put('1', np.zeros(1000, dtype=np.int16))
+            self.assertIsNotNone(render_cache.get('0'))
+
+
+if __name__ == '__main__':
+    unittest.main()
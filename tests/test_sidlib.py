@@ -1,10 +1,14 @@
 #!/usr/bin/python3
 
+import os
+import tempfile
+import random
 import unittest
 from io import StringIO
+import numpy as np
 import pandas as pd
-from desidulate.fileio import read_csv
-from desidulate.sidlib import squeeze_diffs, coalesce_near_writes, remove_end_repeats, calc_rates, bits2byte
+from desidulate.fileio import read_csv, write_reg_log_bin
+from desidulate.sidlib import squeeze_diffs, coalesce_near_writes, split_gate_to_ssfs, remove_redundant_state, remove_end_repeats, remove_repeats, control_labels, ssf_control_labels, unique_control_labels, calc_rates, bits2byte, reg2state, compress_writes, read_reg_log, hash_vdf, hash_ints, hash_int_pairs
 from desidulate.sidwrap import get_sid
 
 
@@ -18,6 +22,79 @@ class SIDLibTestCase(unittest.TestCase):
         df = pd.DataFrame([{'col1': 1}])
         self.assertEqual(1, bits2byte(df, df.columns).iat[0])
 
+    def test_compress_writes(self):
+        df = read_csv(StringIO('''
+clock,reg,val
+1,0,0
+2,24,15
+3,7,1
+4,24,15
+5,7,1
+6,7,2
+7,0,1
+8,24,15
+'''))
+        last_vals = np.full(256, -1, dtype=np.int16)
+        last_vals[0] = 0
+        c_df = compress_writes(df, last_vals)
+        self.assertEqual([2, 3, 6, 7], c_df.index.tolist())
+        self.assertEqual(1, last_vals[0])
+        self.assertEqual(2, last_vals[7])
+        self.assertEqual(15, last_vals[24])
+        c_df = compress_writes(df, last_vals)
+        self.assertEqual([1, 3, 6, 7], c_df.index.tolist())
+
+    def test_hash_int_pairs(self):
+        a = [1, -2, 2**62, 0]
+        b = [8, 1, 3, 0]
+        self.assertEqual([hash_ints(pair) for pair in zip(a, b)], hash_int_pairs(np.array(a), np.array(b)).tolist())
+
+    def test_hash_vdf(self):
+        vdf = pd.DataFrame(
+            {'ssf': [1, 1, 2, 2, 3, 3, 4], 'clock': [0, 10, 0, 20, 0, 10, 0], 'freq1': [1, 2, 1, 2, 2, 1, None]},
+        ).astype({'freq1': pd.UInt16Dtype()})
+        vdf = hash_vdf(vdf, {'ssf', 'clock'})
+        hashids = vdf.groupby('ssf')['hashid_noclock'].unique().apply(list).to_dict()
+        self.assertEqual({1: 1, 2: 1, 3: 1, 4: 1}, {ssf: len(h) for ssf, h in hashids.items()})
+        self.assertEqual(hashids[1], hashids[2])
+        self.assertNotEqual(hashids[1], hashids[3])
+        self.assertNotEqual(hashids[1], hashids[4])
+        self.assertEqual(np.int64, vdf['hashid_noclock'].dtype)
+        self.assertEqual(-7237129086473441427, hashids[1][0])
+
+    def test_reg2state_chunks(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            test_log = os.path.join(tmpdir, 'vicesnd.log')
+            with open(test_log, 'w', encoding='utf8') as log:
+                log.write('\n'.join((
+                    '1 0 0',
+                    '1 24 15',
+                    '1 7 255',
+                    '0 8 128',
+                    '0 24 15',
+                    '1 13 255',
+                    '100 11 129',
+                    '8 7 255',
+                    '8 7 254',
+                    '0 8 129',
+                    '0 23 241',
+                    '100000 11 128',
+                    '')))
+            df = reg2state(test_log)
+            self.assertEqual(9, len(df))
+            self.assertEqual(15, df['vol'].iat[0])
+            self.assertEqual(33278, df['freq2'].iat[-1])
+            self.assertEqual([0, 0, 0, 0, 1, 1, 1, 1, 0], df['gate2'].tolist())
+            for chunksize in range(1, 13):
+                chunk_df = reg2state(test_log, chunksize=chunksize)
+                self.assertEqual(df.to_string(), chunk_df.to_string())
+            self.assertEqual(reg2state(test_log, nrows=6).to_string(), reg2state(test_log, nrows=6, chunksize=4).to_string())
+            test_bin_log = os.path.join(tmpdir, 'vicesnd.regbin')
+            self.assertEqual(12, write_reg_log_bin(test_bin_log, read_reg_log(test_log, chunksize=5)))
+            for chunksize in (None, 1, 5):
+                bin_df = reg2state(test_bin_log, chunksize=chunksize)
+                self.assertEqual(df.to_string(), bin_df.to_string())
+
     def str2df(self, df_str):
         return read_csv(StringIO(df_str), dtype=pd.UInt64Dtype()).set_index('clock')
 
@@ -247,12 +324,84 @@ clock,gate1,freq1,pwduty1,pulse1,noise1,tri1,saw1,test1,sync1,ring1,freq3,test3,
         self.assertEqual(19277, rate.iat[-1])
         self.assertEqual(1, pr_speed.iat[-1])
 
+    def test_calc_rates_ssfs(self):
+        sid = get_sid(pal=True, cia=0)
+        df_str = '''
+clock,gate1,freq1,pwduty1,pulse1,noise1,tri1,saw1,test1,sync1,ring1,freq3,test3,flt1,fltcoff,fltres,fltlo,fltband,flthi,fltext,atk1,dec1,sus1,rel1,vol
+%s
+'''
+        dfs = [
+            self.ssfdf(df_str % '\n'.join((
+                '0,1,0,,0,0,1,1,0,,,,,0,,,,,,,0,0,14,0,15',
+                '1245,0,,,0,0,0,0,0,,,,,,,,,,,,,,,,15',
+                '1963,0,,,0,0,0,0,0,,,,,,,,,,,,,,,,8',
+                '13255,0,4864,,0,0,1,1,0,,,,,0,,,,,,,,,,,8')), ssf=3),
+            self.ssfdf(df_str % '\n'.join((
+                '0,1,1536,256,1,0,0,0,0,,,,,0,,,,,,,0,0,15,15,15',
+                '19452,1,63744,,0,1,0,0,0,,,,,0,,,,,,,,,,,15',
+                '39093,0,1536,320,1,0,0,0,0,,,,,0,,,,,,,,,,,15',
+                '58688,0,1536,352,1,0,0,0,0,,,,,0,,,,,,,,,,,15')), ssf=1),
+            self.ssfdf(df_str % '0,1,,,,,,,1,,,,,,,,,,,,9,0,10,0,15', ssf=2),
+        ]
+        rate, pr_speed = calc_rates(sid, 20, pd.concat(dfs))
+        self.assertEqual([3, 1, 2], rate.index.tolist())
+        for df in dfs:
+            ssf_rate, ssf_pr_speed = calc_rates(sid, 20, df)
+            self.assertTrue(ssf_rate.equals(rate.loc[ssf_rate.index]))
+            self.assertTrue(ssf_pr_speed.equals(pr_speed.loc[ssf_pr_speed.index]))
+        self.assertEqual([1245, 19452], rate.iloc[:2].tolist())
+        self.assertTrue(pd.isna(rate.iat[2]))
+        self.assertEqual([16, 1, 0], pr_speed.tolist())
+
 
     def test_remove_end_repeats(self):
         self.assertEqual([1, 2], remove_end_repeats([1, 2]))
         self.assertEqual([1, 2, 3, 1, 2], remove_end_repeats([1, 2, 3, 1, 2, 1, 2, 1, 2]))
         self.assertEqual([1, 2, 3], remove_end_repeats([1, 2, 3, 1, 2, 3]))
 
+    def test_remove_repeats(self):
+        def end_repeats_remove_repeats(seq):
+            non_repeats = seq[:1]
+            for i in seq[1:]:
+                if i != non_repeats[-1]:
+                    non_repeats.append(i)
+                    non_repeats = remove_end_repeats(non_repeats)
+            return non_repeats
+
+        self.assertEqual([], remove_repeats([]))
+        self.assertEqual([1, 2, 3], remove_repeats([1, 1, 2, 3, 1, 2, 3, 1, 2, 3, 3]))
+        self.assertEqual([1, 2, 1, 3], remove_repeats([1, 2, 1, 2, 1, 3]))
+        rng = random.Random(1)
+        for _ in range(1000):
+            motif = [rng.randint(0, 3) for _ in range(rng.randint(1, 5))]
+            seq = []
+            for _ in range(rng.randint(0, 12)):
+                seq.extend(motif if rng.random() < 0.7 else [rng.randint(0, 3)])
+            self.assertEqual(end_repeats_remove_repeats(list(seq)), remove_repeats(seq), seq)
+
+    def test_control_labels(self):
+        df = pd.DataFrame([
+            {'hashid': 1, 'clock': 0, 'gate1': 1, 'tri1': 1},
+            {'hashid': 1, 'clock': 1, 'gate1': 1, 'pulse1': 1},
+            {'hashid': 1, 'clock': 2, 'gate1': 1, 'tri1': 1},
+            {'hashid': 1, 'clock': 3, 'gate1': 1, 'pulse1': 1},
+            {'hashid': 1, 'clock': 4, 'gate1': 0, 'pulse1': 1},
+            {'hashid': 2, 'clock': 0, 'gate1': 1, 'test1': 1},
+            {'hashid': 2, 'clock': 1, 'gate1': 1, 'noise1': 1},
+            {'hashid': 3, 'clock': 0},
+        ]).fillna(0).astype(pd.UInt8Dtype())
+        for col in ('sync1', 'ring1', 'saw1'):
+            df[col] = pd.Series([0] * len(df), dtype=pd.UInt8Dtype())
+        labels_df = control_labels(df.copy())
+        for _, ssf_df in df.groupby('hashid'):
+            self.assertTrue(labels_df[labels_df['hashid'] == ssf_df['hashid'].iat[0]].reset_index(drop=True).equals(
+                ssf_control_labels(ssf_df).reset_index(drop=True)))
+        df = unique_control_labels(labels_df)
+        self.assertEqual(
+            ['t-p', 't-p', 't-p', 't-p', 't-p', 'T-n', 'T-n', ''], df['control_labels'].tolist())
+        self.assertEqual(
+            ['p-t', 'p-t', 'p-t', 'p-t', 'p-t', 'n', 'n', '0'], df['unique_control_labels'].tolist())
+
     def test_squeeze_diffs(self):
         df = self.str2df('''
 clock,gate1,pulse1,noise1
@@ -272,6 +421,29 @@ clock,gate1,pulse1,noise1
         df = df[~df.index.isin((200, 400))]
         self.assertEqual(df.to_string(), s_df.to_string())
 
+    def test_remove_redundant_state(self):
+        df = self.str2df('''
+clock,freq1,pwduty1,gate1,sync1,ring1,test1,tri1,saw1,pulse1,noise1,atk1,dec1,sus1,rel1,vol,flt1,fltlo,freq3,test3
+100,1000,0,0,0,0,0,0,0,0,0,0,0,0,0,15,0,0,0,0
+200,1000,0,1,0,0,0,1,0,0,0,1,2,0,0,15,0,0,0,0
+300,2000,0,1,0,0,0,1,0,0,0,3,4,5,0,15,0,0,0,0
+400,2000,0,0,0,0,0,1,0,0,0,3,4,5,6,15,0,0,0,0
+500,2000,0,0,0,0,0,0,0,0,0,3,4,5,7,15,0,0,0,0
+600,3000,0,1,0,0,0,0,1,0,0,0,9,0,0,15,0,0,0,0
+700,3000,0,0,0,0,0,0,1,0,0,0,9,0,2,15,0,0,0,0
+''')
+        v_df = remove_redundant_state(1, split_gate_to_ssfs(1, df))
+        self.assertEqual([1, 1, 1, 2, 2], v_df.index.tolist())
+        self.assertEqual([200, 300, 400, 600, 700], v_df['clock'].tolist())
+        self.assertEqual([1000, 2000, 2000, 3000, 3000], v_df['freq1'].tolist())
+        self.assertEqual([1, pd.NA, pd.NA, 0, pd.NA], v_df['atk1'].tolist())
+        self.assertEqual([2, pd.NA, pd.NA, 9, pd.NA], v_df['dec1'].tolist())
+        self.assertEqual([5, pd.NA, pd.NA, 15, pd.NA], v_df['sus1'].tolist())
+        self.assertEqual([6, pd.NA, pd.NA, 2, pd.NA], v_df['rel1'].tolist())
+        self.assertTrue(v_df['freq3'].isna().all())
+        self.assertTrue(v_df['fltlo'].isna().all())
+        self.assertTrue(v_df['pwduty1'].isna().all())
+
     def test_coalesce_near_writes(self):
         df = self.str2df('''
 clock,freq1
@@ -0,0 +1,67 @@
+#!/usr/bin/python3
+
+import unittest
+import numpy as np
+import pandas as pd
+from desidulate.sidstate import STATE_COLS, SID_REGS, SidRegState
+
+
+class SidStateTestCase(unittest.TestCase):
+    """Test sidstate."""
+
+    @staticmethod
+    def _random_state(rows=64):
+        rng = np.random.default_rng(1)
+        regs = rng.integers(0, 256, size=(rows, SID_REGS), dtype=np.uint8)
+        # unused bits are not state.
+        regs[:, [3, 10, 17]] &= 15
+        regs[:, 21] &= 7
+        regs[:, 23] &= 0xf7
+        return SidRegState(np.arange(rows, dtype=np.uint64) * 100, regs)
+
+    def test_decode(self):
+        regs = np.zeros((1, SID_REGS), dtype=np.uint8)
+        regs[0, 7:14] = [0x34, 0x12, 0x78, 0x56, 0x41, 0xa5, 0x3c]
+        regs[0, 21:25] = [0x5, 0x80, 0xf2, 0x9f]
+        state = SidRegState(np.array([100], dtype=np.uint64), regs)
+        df = state.to_df()
+        self.assertEqual(STATE_COLS, list(df.columns))
+        row = df.iloc[0]
+        self.assertEqual(0x1234, row['freq2'])
+        self.assertEqual(0x678, row['pwduty2'])
+        self.assertEqual((1, 0, 1), (row['gate2'], row['test2'], row['pulse2']))
+        self.assertEqual((10, 5, 3, 12), (row['atk2'], row['dec2'], row['sus2'], row['rel2']))
+        self.assertEqual((15, 1, 0, 0, 1), (row['vol'], row['fltlo'], row['fltband'], row['flthi'], row['mute3']))
+        self.assertEqual((0, 1, 0, 0, 15), (row['flt1'], row['flt2'], row['flt3'], row['fltext'], row['fltres']))
+        self.assertEqual((0x80 << 3) + 5, row['fltcoff'])
+
+    def test_from_df(self):
+        state = self._random_state()
+        df = state.to_df()
+        from_df_state = SidRegState.from_df(df)
+        self.assertTrue(np.array_equal(state.regs, from_df_state.regs))
+        self.assertTrue(df.equals(from_df_state.to_df()))
+        self.assertTrue(df.equals(SidRegState.concat([
+            SidRegState.from_df(df[:10]), SidRegState.from_df(df[10:])]).to_df()))
+
+    def test_voice(self):
+        state = self._random_state()
+        df = state.to_df()
+        for v, sync_v in ((1, 3), (2, 1), (3, 2)):
+            v_state = state.voice(v)
+            self.assertIs(state.regs, v_state.regs)
+            v_df = v_state.to_df()
+            self.assertEqual('freq1', v_df.columns[0])
+            self.assertNotIn('mute3', v_df.columns)
+            self.assertNotIn('flt2', v_df.columns)
+            self.assertEqual(['freq3', 'test3'], list(v_df.columns[-2:]))
+            for col in ('freq', 'gate', 'rel', 'flt'):
+                self.assertTrue(v_df[col + '1'].equals(df['%s%u' % (col, v)]))
+            for col in ('freq', 'test'):
+                self.assertTrue(v_df[col + '3'].equals(df['%s%u' % (col, sync_v)]))
+            self.assertTrue(v_df['fltcoff'].equals(df['fltcoff']))
+            self.assertTrue(pd.Index(state.clock, name='clock').equals(v_df.index))
+
+
+if __name__ == '__main__':
+    unittest.main()
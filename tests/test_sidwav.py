@@ -5,8 +5,8 @@ import unittest
 import tempfile
 import pandas as pd
 import numpy as np
-from desidulate.sidwav import state2samples, write_wav, loudestf
-from desidulate.sidwrap import get_sid
+from desidulate.sidwav import state2samples, state2writes, states2sample_chunks, write_wav, write_wav_stream, loudestf, mostf, samples_loudestf, samples_loudestf_batch, SampleBuffer
+from desidulate.sidwrap import get_sid, acquire_sid, pooled_sid, release_sid
 
 
 class SidWavTestCase(unittest.TestCase):
@@ -26,6 +26,77 @@ class SidWavTestCase(unittest.TestCase):
         self.assertNotEqual(df1.to_string(), df2.to_string())
         return np.array_equal(raw_samples, raw_samples2)
 
+    def test_loudestf_batch(self):
+        sample_rate = 11025
+        data_list = []
+        for f, length in ((220, 1000), (440, 1000), (1000, 2000), (0, 1000)):
+            data_list.append((np.sin(2 * np.pi * f * np.arange(length) / sample_rate) * 8000).astype(np.int16))
+        loudestfs = [samples_loudestf(data, sample_rate) for data in data_list]
+        self.assertEqual([220, 441, 997, 0], loudestfs)
+        self.assertEqual(loudestfs, samples_loudestf_batch(data_list, sample_rate))
+        with tempfile.TemporaryDirectory() as tmpdir:
+            test_wav = os.path.join(tmpdir, 'test.wav')
+            data = np.concatenate((data_list[0], data_list[2]))
+            write_wav(test_wav, get_sid(pal=True, cia=0), data)
+            self.assertLess(mostf(test_wav, threshold=0.1), 230)
+            self.assertGreater(mostf(test_wav, threshold=0.9), 990)
+
+    def test_sample_buffer(self):
+        buf = SampleBuffer(2)
+        self.assertFalse(buf)
+        buf.extend([1, 2])
+        buf.extend([3])
+        buf.extend([])
+        self.assertEqual(3, len(buf))
+        self.assertEqual(np.int16, buf.samples().dtype)
+        self.assertEqual([1, 2, 3], buf.samples().tolist())
+
+    def test_state2writes(self):
+        df = self._make_wav_df([
+            {'clock': 0, 'freq1': 4000, 'sus1': 15, 'rel1': 15, 'vol': 15, 'gate1': 1, 'test1': 1},
+            {'clock': 100, 'gate1': 0, 'test1': 0, 'tri1': 1},
+            {'clock': 300, 'freq1': 4001},
+            {'clock': 400},
+        ])
+        regs, diff_clocks, write_starts, write_regs, write_vals = state2writes(df)
+        self.assertEqual([160, 15, 0, 0, 9, 0, 255], regs[0][:7].tolist())
+        self.assertEqual(15, regs[0][24])
+        self.assertEqual([100, 200, 100], diff_clocks.tolist())
+        self.assertEqual([0, 1, 2, 2], write_starts.tolist())
+        self.assertEqual([4, 0], write_regs.tolist())
+        self.assertEqual([16, 161], write_vals.tolist())
+
+    def test_reused_sid(self):
+        df = self._make_wav_df([
+            {'clock': 0, 'freq1': 4000, 'sus1': 15, 'vol': 15, 'gate1': 1, 'noise1': 1, 'fltlo': 1, 'flt1': 1, 'fltcoff': 200},
+            {'clock': 50000, 'gate1': 0},
+            {'clock': 90000},
+        ])
+        sid = get_sid(pal=True, cia=0)
+        raw_samples = state2samples(df, sid)
+        self.assertTrue(np.array_equal(raw_samples, state2samples(df, sid)))
+
+    def test_pooled_sid(self):
+        df = self._make_wav_df([
+            {'clock': 0, 'freq1': 4000, 'sus1': 15, 'vol': 15, 'gate1': 1, 'saw1': 1},
+            {'clock': 50000, 'gate1': 0},
+            {'clock': 90000},
+        ])
+        with pooled_sid(pal=True, cia=0) as sid:
+            raw_samples = state2samples(df, sid)
+        resid = sid.resid
+        with pooled_sid(pal=True, cia=0) as pooled:
+            self.assertIs(sid, pooled)
+            # rendering, not acquiring, starts a new reSID instance.
+            self.assertIs(resid, pooled.resid)
+            self.assertTrue(np.array_equal(raw_samples, state2samples(df, pooled)))
+            other = acquire_sid(pal=False, cia=0)
+            self.assertIsNot(sid, other)
+            nested = acquire_sid(pal=True, cia=0)
+            self.assertIsNot(sid, nested)
+            release_sid(nested)
+            release_sid(other)
+
     def test_skiptest(self):
         sid = get_sid(pal=True, cia=0)
 
@@ -248,6 +319,33 @@ class SidWavTestCase(unittest.TestCase):
                 freq_diff = abs(freq_max - test_real_freq)
                 self.assertLessEqual(freq_diff, 3)
 
+    def test_write_wav_stream(self):
+        df = self._make_wav_df([
+            {'clock': 0, 'freq1': 4000, 'sus1': 15, 'vol': 15, 'gate1': 1, 'test1': 1},
+            {'clock': 20000, 'test1': 0, 'tri1': 1},
+            {'clock': 250000, 'pulse1': 1, 'pwduty1': 2048},
+            {'clock': 500000, 'gate1': 0},
+            {'clock': 900000},
+        ])
+        sid = get_sid(pal=True, cia=0)
+        raw_samples = state2samples(df, sid, skiptest=True)
+        for dfs, window_clocks in (
+                ([df], 100000),
+                ([df[:1], df[1:3], df[3:]], None),
+                ([df[:2], df[2:]], 30000)):
+            sid = get_sid(pal=True, cia=0)
+            sample_chunks = list(states2sample_chunks(dfs, sid, skiptest=True, window_clocks=window_clocks))
+            self.assertGreater(len(sample_chunks), 1)
+            self.assertTrue(np.array_equal(raw_samples, np.concatenate(sample_chunks)))
+
+        with tempfile.TemporaryDirectory() as tmpdir:
+            test_wav = os.path.join(tmpdir, 'test.wav')
+            test_stream_wav = os.path.join(tmpdir, 'test_stream.wav')
+            write_wav(test_wav, sid, raw_samples)
+            write_wav_stream(test_stream_wav, sid, [raw_samples[:1000], raw_samples[1000:]])
+            with open(test_wav, 'rb') as wav, open(test_stream_wav, 'rb') as stream_wav:
+                self.assertEqual(wav.read(), stream_wav.read())
+
 
 if __name__ == '__main__':
     unittest.main()
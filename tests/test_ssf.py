@@ -3,11 +3,12 @@
 import os
 import tempfile
 import unittest
+from unittest.mock import patch
 import pandas as pd
 from desidulate.sidlib import reg2state, state2ssfs, control_labels
-from desidulate.sidmidi import SidMidiFile, MAX_VEL
+from desidulate.sidmidi import SidMidiFile, MAX_VEL, closest_midi
 from desidulate.sidwrap import get_sid
-from desidulate.ssf import SidSoundFragment, add_freq_notes_df
+from desidulate.ssf import SidSoundFragment, SsfDfs, add_freq_notes_df, parse_ssfs, parse_ssfs_chunks
 
 
 class SSFTestCase(unittest.TestCase):
@@ -62,6 +63,86 @@ class SSFTestCase(unittest.TestCase):
         smf.add_drum_pitch(1, 1, 100, 1, 127)
         smf.write(os.devnull)
 
+    def test_state2ssfs_workers(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            test_log = os.path.join(tmpdir, 'vicesnd.log')
+            sid = get_sid(pal=True, cia=0)
+            with open(test_log, 'w', encoding='utf8') as log:
+                log.write('\n'.join((
+                    '1 24 15',
+                    '1 7 255',
+                    '1 8 128',
+                    '1 13 255',
+                    '100 11 129',
+                    '100 4 17',
+                    '100000 11 128',
+                    '100 4 16',
+                    '')))
+            df = reg2state(test_log)
+            ssf_log_df, ssf_dfs = state2ssfs(sid, df)
+            w_ssf_log_df, w_ssf_dfs = state2ssfs(sid, df, workers=2)
+            self.assertTrue(ssf_log_df.equals(w_ssf_log_df))
+            self.assertTrue(ssf_dfs.equals(w_ssf_dfs))
+            self.assertEqual([0, 1, 2], sorted(ssf_log_df['voice'].unique()))
+
+    def test_add_freq_notes_df(self):
+        sid = get_sid(pal=True, cia=0)
+        ssfs_df = pd.DataFrame([
+            {'hashid': 1, 'clock': 0, 'freq1': 7382},
+            {'hashid': 1, 'clock': 100, 'freq1': pd.NA},
+            {'hashid': 2, 'clock': 0, 'freq1': 0},
+            {'hashid': 2, 'clock': 100, 'freq1': 65535}])
+        df = add_freq_notes_df(sid, ssfs_df)
+        self.assertEqual(['hashid', 'clock', 'freq1', 'real_freq', 'closest_note'], list(df.columns))
+        for freq, real_freq, closest_note in df[['freq1', 'real_freq', 'closest_note']].itertuples(index=False):
+            if pd.isna(freq):
+                self.assertTrue(pd.isna(real_freq))
+                self.assertTrue(pd.isna(closest_note))
+                continue
+            self.assertEqual(sid.real_sid_freq(freq), real_freq)
+            self.assertEqual(closest_midi(real_freq)[1], closest_note)
+
+    def test_ssf_dfs(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            test_log = os.path.join(tmpdir, 'vicesnd.log')
+            sid = get_sid(pal=True, cia=0)
+            with open(test_log, 'w', encoding='utf8') as log:
+                log.write('\n'.join((
+                    '1 24 15',
+                    '1 7 255',
+                    '1 8 128',
+                    '1 13 255',
+                    '1 0 100',
+                    '1 1 10',
+                    '100 11 129',
+                    '100 4 33',
+                    '100000 11 128',
+                    '100 4 32',
+                    '')))
+            _, ssfs_df = state2ssfs(sid, reg2state(test_log))
+        ssfs_df = add_freq_notes_df(sid, ssfs_df.reset_index())
+        # as all SSFs were labelled and grouped before SSF dataframes were made when looked up.
+        expected_df = control_labels(ssfs_df.copy())
+        expected_df = expected_df[expected_df['vol'].isna()].assign(vol=15)
+        expected = {hashid: ssf_df.set_index('clock').ffill() for hashid, ssf_df in expected_df.groupby('hashid')}
+        self.assertLess(len(expected), ssfs_df['hashid'].nunique())
+        for maxsize in (0, 1, None):
+            ssf_dfs = SsfDfs(ssfs_df, maxsize=maxsize)
+            self.assertEqual(list(expected), list(ssf_dfs))
+            self.assertEqual(len(expected), len(ssf_dfs))
+            for hashid, ssf_df in expected.items():
+                self.assertIn(hashid, ssf_dfs)
+                self.assertTrue(ssf_df.equals(ssf_dfs[hashid]))
+            self.assertNotIn(4, ssf_dfs)
+            with self.assertRaises(KeyError):
+                _ = ssf_dfs[4]
+            hashid = list(expected)[0]
+            self.assertEqual(maxsize != 0, ssf_dfs[hashid] is ssf_dfs[hashid])
+        ssf_dfs = SsfDfs(ssfs_df, maxsize=1)
+        first = ssf_dfs[list(expected)[0]]
+        _ = ssf_dfs[list(expected)[1]]
+        self.assertIsNot(first, ssf_dfs[list(expected)[0]])
+
     def test_ssf_parser(self):
         with tempfile.TemporaryDirectory() as tmpdir:
             test_log = os.path.join(tmpdir, 'vicesnd.log')
@@ -98,6 +179,77 @@ class SSFTestCase(unittest.TestCase):
                 self.assertEqual(ssf.midi_pitches, (95,))
                 self.assertEqual(ssf.total_duration, 117936)
 
+    def test_parse_ssfs_chunks(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            test_log = os.path.join(tmpdir, 'vicesnd.log')
+            sid = get_sid(pal=True, cia=0)
+            smf = SidMidiFile(sid)
+            with open(test_log, 'w', encoding='utf8') as log:
+                log.write('\n'.join((
+                    '1 24 15',
+                    '1 7 255',
+                    '1 8 128',
+                    '1 13 255',
+                    '1 0 100',
+                    '1 1 10',
+                    '100 11 129',
+                    '100 4 33',
+                    '100000 11 128',
+                    '100 4 32',
+                    '')))
+            ssf_log_df, ssf_dfs = state2ssfs(sid, reg2state(test_log))
+            ssf_log_df.reset_index(level=0, inplace=True)
+            ssf_dfs.reset_index(level=0, inplace=True)
+            ssf_dfs = control_labels(add_freq_notes_df(sid, ssf_dfs))
+            ssf_dfs = [
+                (hashid, ssf_dfs[ssf_dfs['hashid'] == hashid].set_index('clock'), None)
+                for hashid in ssf_log_df[ssf_log_df.voice > 0]['hashid'].unique()]
+            self.assertEqual(2, len(ssf_dfs))
+            parsed = list(parse_ssfs_chunks(True, sid, smf, ssf_dfs))
+            w_parsed = list(parse_ssfs_chunks(True, sid, smf, ssf_dfs, workers=2, chunks_per_worker=1))
+            # one SSF at a time, without workers.
+            with patch('desidulate.ssf.parse_ssfs', wraps=parse_ssfs) as chunk_parse_ssfs:
+                c_parsed = list(parse_ssfs_chunks(True, sid, smf, ssf_dfs, max_chunk_ssfs=1))
+            self.assertEqual([1, 1], [len(call.args[3]) for call in chunk_parse_ssfs.call_args_list])
+            self.assertEqual([hashid for hashid, _ in parsed], [hashid for hashid, _ in c_parsed])
+            for (_, ssf), (_, c_ssf) in zip(parsed, c_parsed):
+                self.assertTrue(pd.Series(ssf.instrument({})).equals(pd.Series(c_ssf.instrument({}))))
+                self.assertEqual(ssf.pitches, c_ssf.pitches)
+            self.assertEqual([hashid for hashid, _, _ in ssf_dfs], [hashid for hashid, _ in parsed])
+            self.assertEqual([hashid for hashid, _ in parsed], [hashid for hashid, _ in w_parsed])
+            for (_, ssf), (_, w_ssf) in zip(parsed, w_parsed):
+                self.assertTrue(pd.Series(ssf.instrument({})).equals(pd.Series(w_ssf.instrument({}))))
+                self.assertEqual(ssf.pitches, w_ssf.pitches)
+
+    def test_midi_notes_from_dfs(self):
+        sid = get_sid(pal=True, cia=0)
+        smf = SidMidiFile(sid)
+        base = {'atk1': 2, 'dec1': 3, 'sus1': 8, 'rel1': 4, 'gate1': 1, 'test1': 0}
+        states = [
+            {'clock': 0, 'closest_note': 60},
+            {'clock': 1000, 'closest_note': 60},
+            {'clock': 2000, 'closest_note': 62},
+            {'clock': 9000, 'closest_note': 64, 'test1': 1},
+            {'clock': 12000, 'closest_note': 64},
+            {'clock': 40000, 'closest_note': 65},
+            {'clock': 60000, 'closest_note': 67, 'gate1': 0},
+            {'clock': 70000, 'closest_note': 69, 'gate1': 0},
+            {'clock': 900000, 'closest_note': 70, 'gate1': 0},
+            {'clock': 950000, 'closest_note': 70, 'gate1': 1},
+        ]
+        dfs = []
+        for atk1, dec1 in ((2, 3), (0, 3), (0, 0), (9, 9)):
+            df = pd.DataFrame([{**base, 'atk1': atk1, 'dec1': dec1, **state} for state in states]).set_index('clock')
+            df['real_freq'] = df['closest_note'] * 1.5
+            dfs.append(df.astype({'closest_note': pd.UInt8Dtype(), 'real_freq': pd.Float64Dtype()}))
+        na_df = dfs[0].copy()
+        na_df.loc[9000, 'closest_note'] = pd.NA
+        dfs.extend([na_df, dfs[0].iloc[:1], dfs[0].iloc[:0]])
+        midi_notes = smf.get_midi_notes_from_dfs(dfs)
+        for df, df_midi_notes in zip(dfs, midi_notes):
+            self.assertEqual(smf.get_midi_notes_from_events(df.itertuples()), df_midi_notes)
+        self.assertEqual(6, len(midi_notes[0]))
+
 
 if __name__ == '__main__':
     unittest.main()
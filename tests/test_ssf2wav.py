@@ -0,0 +1,44 @@
+#!/usr/bin/python3
+
+import os
+import sys
+import tempfile
+import unittest
+from unittest.mock import patch
+from desidulate.fileio import write_indexed_df
+from desidulate.sidlib import reg2state, state2ssfs
+from desidulate.sidwrap import get_sid
+from desidulate.ssf2wav import main
+
+
+class SSF2WavTestCase(unittest.TestCase):
+
+    def test_ssf2wav_parser(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            test_log = os.path.join(tmpdir, 'vicesnd.log')
+            with open(test_log, 'w', encoding='utf8') as log:
+                log.write('\n'.join((
+                    '1 24 15',
+                    '1 7 255',
+                    '1 8 128',
+                    '1 13 255',
+                    '100 11 129',
+                    '100000 11 128',
+                    '')))
+            sid = get_sid(pal=True, cia=0)
+            _, ssf_df = state2ssfs(sid, reg2state(test_log))
+            ssf_file = os.path.join(tmpdir, 'vicesnd.ssf.zst')
+            write_indexed_df(ssf_df, ssf_file)
+            # SSFs are parsed (the default) as well as rendered.
+            with patch.object(sys, 'argv', ['ssf2wav', '--pal', '--workers', '1', ssf_file]):
+                try:
+                    main()
+                except SystemExit as err:
+                    self.assertEqual(0, err.code)
+            wavs = [name for name in os.listdir(tmpdir) if name.endswith('.wav')]
+            # SSFs that set the volume are not rendered.
+            self.assertEqual(ssf_df[ssf_df['vol'].isna()].index.nunique(), len(wavs))
+
+
+if __name__ == '__main__':
+    unittest.main()
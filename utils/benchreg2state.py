@@ -0,0 +1,51 @@
+#!/usr/bin/python3
+
+# Benchmark reg2state on a synthetic VICE "-sounddev dump" register dump.
+
+import argparse
+import os
+import tempfile
+import time
+import numpy as np
+import pandas as pd
+from desidulate.sidlib import SID_REGS, compress_writes, read_reg_log, reg2state
+
+
+def synth_dump(dump_name, rows, seed):
+    rng = np.random.default_rng(seed)
+    # players typically rewrite the same few values to all registers every frame.
+    reg = np.tile(np.arange(SID_REGS, dtype=np.uint8), int(rows / SID_REGS) + 1)[:rows]
+    val = rng.integers(0, 4, rows, dtype=np.uint8) * 64
+    clock_offset = rng.integers(1, 16, rows, dtype=np.uint32)
+    clock_offset[reg == 0] += 19000
+    pd.DataFrame({'clock_offset': clock_offset, 'reg': reg, 'val': val}).to_csv(
+        dump_name, sep=' ', header=False, index=False)
+
+
+def bench(name, rows, func):
+    start = time.time()
+    func()
+    elapsed = time.time() - start
+    print('%s: %u rows in %.2fs (%.0f rows/s)' % (name, rows, elapsed, rows / elapsed))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark reg2state')
+    parser.add_argument('--rows', default=int(10 * 1e6), type=int, help='register writes in synthetic dump')
+    parser.add_argument('--chunksize', default=0, type=int, help='if > 0, read dump in chunks of this many register writes')
+    parser.add_argument('--seed', default=0, type=int, help='random seed')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        dump_name = os.path.join(tmpdir, 'bench.dump')
+        synth_dump(dump_name, args.rows, args.seed)
+        df = next(read_reg_log(dump_name, nrows=args.rows))
+        df['clock'] = df['clock_offset'].cumsum()
+        df = df[['clock', 'reg', 'val']]
+        last_vals = np.full(256, -1, dtype=np.int16)
+        bench('compress_writes', len(df), lambda: compress_writes(df, last_vals))
+        bench('reg2state', len(df), lambda: reg2state(dump_name, nrows=args.rows, chunksize=args.chunksize))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,33 @@
+#!/usr/bin/python3
+
+# Benchmark rendering a VICE "-sounddev dump" register dump, in emulated seconds per second.
+
+import argparse
+import resource
+import time
+from desidulate.sidlib import reg2state, timer_args
+from desidulate.sidwav import state2samples
+from desidulate.sidwrap import get_sid
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark state2samples')
+    parser.add_argument('logfile', help='log file to read')
+    parser.add_argument('--maxstates', default=int(10 * 1e6), type=int, help='maximum number of SID states to render')
+    timer_args(parser)
+    args = parser.parse_args()
+
+    sid = get_sid(args.pal, args.cia)
+    df = reg2state(args.logfile, nrows=args.maxstates)
+    start_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    start = time.time()
+    raw_samples = state2samples(df, sid)
+    elapsed = time.time() - start
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - start_rss
+    emulated = len(raw_samples) / sid.resid.sampling_frequency
+    print('state2samples: %u states, %.1fs emulated in %.2fs (%.1f emulated seconds per second, peak RSS grew %u MiB)' % (
+        len(df), emulated, elapsed, emulated / elapsed, rss / 1024))
+
+
+if __name__ == '__main__':
+    main()